@@ -0,0 +1,108 @@
+"""分片合并基准测试：比较各种文件复制方式合并TS分片的吞吐量
+
+用法: python benchmarks/bench_merge.py [--segments 200] [--size-mb 2] [--repeat 3] [--dir /data/tmp]
+
+在指定目录下生成随机内容的分片，分别用原来的 read()/write() 方式和 services.fileops
+支持的各种复制方式合并，输出每种方式的吞吐量。--dir 应位于下载目录所在的文件系统上，
+copy_file_range 在不同文件系统上的表现差别很大。
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.fileops import COPY_METHODS, append_file  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def make_segments(directory, count, size):
+    """生成count个size字节的分片，内容随机（避免文件系统压缩或去重影响结果）"""
+    block = os.urandom(min(size, MB))
+    segments = []
+    for i in range(count):
+        path = os.path.join(directory, f"segment_{i:05d}.ts")
+        with open(path, "wb") as f:
+            remaining = size
+            f.write(i.to_bytes(4, "big"))  # 每个分片内容不同
+            remaining -= 4
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= min(remaining, len(block))
+        segments.append(path)
+    return segments
+
+
+def merge_read_write(segments, output):
+    """原来的合并方式：整个分片读入内存再写出"""
+    with open(output, "wb") as outfile:
+        for segment in segments:
+            with open(segment, "rb") as infile:
+                outfile.write(infile.read())
+
+
+def merge_with(method):
+    def merge(segments, output):
+        with open(output, "wb") as outfile:
+            for segment in segments:
+                append_file(segment, outfile, methods=[method])
+
+    return merge
+
+
+def run(name, merge, segments, output, total, repeat):
+    best = None
+    for _ in range(repeat):
+        if os.path.exists(output):
+            os.remove(output)
+        started = time.perf_counter()
+        merge(segments, output)
+        os.sync()  # 包含写回磁盘的时间
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    if os.path.getsize(output) != total:
+        raise Exception(f"{name} 合并结果大小不正确: {os.path.getsize(output)}")
+    return total / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--segments", type=int, default=200, help="分片数")
+    parser.add_argument("--size-mb", type=float, default=2, help="每个分片大小（MB）")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="每种方式运行次数，取最快"
+    )
+    parser.add_argument("--dir", default=None, help="测试目录，默认使用系统临时目录")
+    args = parser.parse_args()
+
+    size = int(args.size_mb * MB)
+    total = size * args.segments
+    directory = tempfile.mkdtemp(prefix="bench_merge_", dir=args.dir)
+    try:
+        print(f"生成 {args.segments} 个 {args.size_mb}MB 分片: {directory}")
+        segments = make_segments(directory, args.segments, size)
+        output = os.path.join(directory, "output.ts")
+
+        methods = [("read/write", merge_read_write)]
+        methods += [(name, merge_with(name)) for name in COPY_METHODS]
+        baseline = None
+        print(f"{'方式':<16}{'吞吐量':>14}{'加速比':>10}")
+        for name, merge in methods:
+            try:
+                rate = run(name, merge, segments, output, total, args.repeat)
+            except Exception as e:
+                print(f"{name:<16}{'不支持':>14}  {str(e)}")
+                continue
+            baseline = baseline or rate
+            print(f"{name:<16}{rate / MB:>10.1f}MB/s{rate / baseline:>9.2f}x")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""播放列表解析基准测试：比较m3u8库的对象表示与列存储（services.compact_playlist）
+
+用法: python benchmarks/bench_playlist.py [--segments 100000] [--absolute] [--byterange] [--key-every 0] [--repeat 3]
+
+生成一个合成的媒体播放列表（默认10万个1秒分片，相当于约28小时的直播回放），分别用
+m3u8.loads 和 parse_playlist 解析，输出解析耗时、解析后保留的内存（tracemalloc）及
+遍历所有分片生成绝对地址的耗时。
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from urllib.parse import urljoin
+
+import m3u8
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.compact_playlist import parse_playlist  # noqa: E402
+
+MB = 1024 * 1024
+BASE_URI = "https://cdn.example.com/live/channel/1080p/index.m3u8?token=abcdef"
+
+
+def make_playlist(count, absolute=False, byterange=False, key_every=0):
+    """生成包含count个分片的媒体播放列表文本"""
+    prefix = "https://cdn.example.com/live/channel/1080p/" if absolute else ""
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:4",
+        "#EXT-X-TARGETDURATION:1",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+    ]
+    for i in range(count):
+        if key_every and i % key_every == 0:
+            lines.append(
+                f'#EXT-X-KEY:METHOD=AES-128,URI="keys/{i // key_every}.key",'
+                f"IV=0x{i:032x}"
+            )
+        lines.append("#EXTINF:1.001,")
+        if byterange:
+            lines.append(f"#EXT-X-BYTERANGE:{188 * 1000}@{188 * 1000 * i}")
+            lines.append(f"{prefix}stream.ts")
+        else:
+            lines.append(f"{prefix}segment_{i:08d}.ts")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def load_m3u8(text):
+    return m3u8.loads(text, uri=BASE_URI)
+
+
+def load_compact(text):
+    return parse_playlist(text, BASE_URI)
+
+
+def urls_m3u8(playlist):
+    """下载器原来的做法：为每个分片生成绝对地址列表"""
+    return [
+        uri if uri.startswith("http") else urljoin(BASE_URI, uri)
+        for uri in (segment.uri for segment in playlist.segments)
+    ]
+
+
+def urls_compact(playlist):
+    return list(playlist.segment_urls)
+
+
+def measure(load, urls, text, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        load(text)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    playlist = load(text)
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    resolved = urls(playlist)
+    url_time = time.perf_counter() - started
+    return best, retained, peak, url_time, resolved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--segments", type=int, default=100000, help="分片数")
+    parser.add_argument("--absolute", action="store_true", help="分片使用绝对地址")
+    parser.add_argument(
+        "--byterange", action="store_true", help="所有分片为同一文件的字节范围"
+    )
+    parser.add_argument(
+        "--key-every",
+        type=int,
+        default=0,
+        help="每隔多少个分片轮换一次密钥，0表示不加密",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="解析运行次数，取最快")
+    args = parser.parse_args()
+
+    text = make_playlist(args.segments, args.absolute, args.byterange, args.key_every)
+    print(f"播放列表: {args.segments} 个分片，{len(text) / MB:.1f}MB")
+    print(
+        f"{'方式':<10}{'解析耗时':>10}{'保留内存':>12}{'每分片':>10}"
+        f"{'峰值内存':>12}{'生成地址':>10}"
+    )
+    results = {}
+    for name, load, urls in (
+        ("m3u8", load_m3u8, urls_m3u8),
+        ("compact", load_compact, urls_compact),
+    ):
+        elapsed, retained, peak, url_time, resolved = measure(
+            load, urls, text, args.repeat
+        )
+        results[name] = resolved
+        print(
+            f"{name:<10}{elapsed:>9.2f}s{retained / MB:>10.1f}MB"
+            f"{retained / args.segments:>9.0f}B{peak / MB:>10.1f}MB{url_time:>9.2f}s"
+        )
+    if results["m3u8"] != results["compact"]:
+        raise Exception("两种方式生成的分片地址不一致")
+
+
+if __name__ == "__main__":
+    main()
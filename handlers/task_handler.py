@@ -1,9 +1,12 @@
 import os
 import uuid
+import asyncio
 import logging
 from typing import Dict, Optional
 from datetime import datetime
+from config import Config
 from services.m3u8_downloader import M3U8Downloader
+from services.async_m3u8_downloader import get_download_loop
 from models.task import Task, download_tasks, TaskModel
 from models.database import get_session
 
@@ -11,17 +14,17 @@ logger = logging.getLogger(__name__)
 
 
 def create_download_task(
-    url: str, filename: str = None, format_type: str = "mp4"
+    url: str, filename: str = None, format_type: str = "mp4", options: Dict = None
 ) -> Dict:
     """创建下载任务"""
     try:
         task_id = str(uuid.uuid4())
         logger.info(
-            f"创建下载任务: task_id={task_id}, url={url}, filename={filename}, format={format_type}"
+            f"创建下载任务: task_id={task_id}, url={url}, filename={filename}, format={format_type}, options={options}"
         )
 
         # 创建任务
-        task = Task(task_id, url, filename, format_type)
+        task = Task(task_id, url, filename, format_type, options=options)
 
         # 获取任务状态
         task_status = task.get_status()
@@ -45,12 +48,16 @@ def start_download_task(task_id: str) -> bool:
             logger.warning(f"任务状态不正确: {task.status}")
             return False
 
-        # 在新线程中启动下载
-        import threading
+        if Config.DOWNLOAD_ENGINE == "asyncio":
+            # 在共享事件循环上启动下载，不再为每个任务创建线程
+            asyncio.run_coroutine_threadsafe(task.start_async(), get_download_loop())
+        else:
+            # 在新线程中启动下载
+            import threading
 
-        thread = threading.Thread(target=task.start)
-        thread.daemon = True
-        thread.start()
+            thread = threading.Thread(target=task.start)
+            thread.daemon = True
+            thread.start()
 
         logger.info(f"任务启动成功: {task_id}")
         return True
@@ -226,3 +233,64 @@ def resume_task(task_id: str) -> bool:
     except Exception as e:
         logger.error(f"恢复任务失败: {str(e)}", exc_info=True)
         return False
+
+
+def retry_task_handler(task_id: str) -> Optional[Dict]:
+    """重试失败、取消或意外中断的任务
+
+    使用相同的任务ID重新创建任务，已完成的分片通过断点续传日志跳过。
+    """
+    try:
+        task = download_tasks.get(task_id)
+        if task and task.status in ["downloading", "pending", "paused"]:
+            logger.warning(f"任务状态不允许重试: {task.status}")
+            return None
+
+        session = get_session()
+        try:
+            task_model = session.query(TaskModel).filter_by(id=task_id).first()
+            if not task_model:
+                logger.warning(f"任务不存在: {task_id}")
+                return None
+
+            if task_model.status not in ["failed", "cancelled"]:
+                logger.warning(f"任务状态不允许重试: {task_model.status}")
+                return None
+
+            url = task_model.url
+            filename = task_model.filename
+            format_type = task_model.format_type
+            task_model.error_message = None
+            session.commit()
+        finally:
+            session.close()
+
+        options = Task.load_options(task_id)
+        logger.info(f"重试任务: task_id={task_id}, options={options}")
+        task = Task(task_id, url, filename, format_type, options=options)
+        if not start_download_task(task_id):
+            return None
+        return task.get_status()
+    except Exception as e:
+        logger.error(f"重试任务失败: {str(e)}", exc_info=True)
+        return None
+
+
+def set_task_speed_limit_handler(
+    task_id: str, speed_limit: float = None, weight: float = None
+) -> bool:
+    """修改任务的速度上限（MB/s）或带宽权重"""
+    try:
+        task = download_tasks.get(task_id)
+        if not task:
+            logger.warning(f"任务不存在: {task_id}")
+            return False
+
+        task.set_speed_limit(speed_limit, weight)
+        logger.info(
+            f"任务限速已更新: task_id={task_id}, speed_limit={speed_limit}, weight={weight}"
+        )
+        return True
+    except Exception as e:
+        logger.error(f"修改任务限速失败: {str(e)}", exc_info=True)
+        return False
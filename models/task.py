@@ -1,4 +1,5 @@
 import os
+import asyncio
 import time
 import logging
 import threading
@@ -6,7 +7,7 @@ import json
 from datetime import datetime
 from typing import Dict, Optional
 from services.video.detector import VideoDetector
-from services.m3u8_downloader import M3U8Downloader
+from services.m3u8_downloader import create_downloader
 from models.video.metadata import VideoMetadata
 from models.database import TaskModel, get_session
 
@@ -24,12 +25,15 @@ class Task:
         filename: str = None,
         format_type: str = "mp4",
         temp_dir: str = "temp",
+        options: Optional[Dict] = None,
     ):
         self.task_id = task_id
         self.url = url
         self.filename = filename or f"video_{task_id}"
         self.format_type = format_type
         self.temp_dir = os.path.join(temp_dir, task_id)
+        # 下载选项，透传给下载器（如 concurrency）
+        self.options = options or {}
         self.status = "pending"
         self.progress = 0
         self.total_segments = 0
@@ -51,6 +55,9 @@ class Task:
 
         # 创建临时目录
         os.makedirs(self.temp_dir, exist_ok=True)
+        # 保存下载选项，重试任务时恢复
+        if self.options:
+            self._save_options()
 
         # 保存到全局字典
         download_tasks[task_id] = self
@@ -58,6 +65,28 @@ class Task:
         # 保存到数据库
         self._sync_to_db()
 
+    def _save_options(self):
+        try:
+            with open(
+                os.path.join(self.temp_dir, "options.json"), "w", encoding="utf-8"
+            ) as f:
+                json.dump(self.options, f, ensure_ascii=False)
+        except Exception as e:
+            logger.error(f"保存下载选项失败: {str(e)}")
+
+    @staticmethod
+    def load_options(task_id: str, temp_dir: str = "temp") -> Dict:
+        """读取任务保存的下载选项"""
+        options_path = os.path.join(temp_dir, task_id, "options.json")
+        if not os.path.exists(options_path):
+            return {}
+        try:
+            with open(options_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"读取下载选项失败: {str(e)}")
+            return {}
+
     def _sync_to_db(self):
         """同步任务状态到数据库"""
         try:
@@ -101,66 +130,74 @@ class Task:
         except Exception as e:
             logger.error(f"数据库操作失败: {str(e)}", exc_info=True)
 
+    def _prepare_download(self):
+        """更新任务状态并创建下载器"""
+        logger.info(f"开始下载任务: task_id={self.task_id}, url={self.url}")
+
+        # 设置开始时间
+        self.start_time = datetime.now()
+        self.status = "downloading"
+        self._sync_to_db()
+        logger.info(f"任务状态已更新: {self.status}")
+
+        # 创建下载器
+        logger.info("创建下载器...")
+        output_file = os.path.join(self.temp_dir, f"output.{self.format_type}")
+        self.downloader = create_downloader(
+            url=self.url, output_path=output_file, **self.options
+        )
+        logger.info(f"下载器创建成功，输出文件: {output_file}")
+
+    def _progress_callback(self, downloaded, total, segment_size):
+        """下载进度回调"""
+        self.downloaded_segments = downloaded
+        self.total_segments = total
+        self.progress = (downloaded / total * 100) if total > 0 else 0
+        self.downloaded_size += segment_size
+
+        # 计算下载速度和预计剩余时间
+        elapsed_time = (datetime.now() - self.start_time).total_seconds()
+        if elapsed_time > 0:
+            self.download_speed = self.downloaded_size / elapsed_time
+            if self.download_speed > 0:
+                remaining_segments = total - downloaded
+                estimated_remaining_size = (
+                    (self.downloaded_size / downloaded) * remaining_segments
+                    if downloaded > 0
+                    else 0
+                )
+                self.estimated_time = estimated_remaining_size / self.download_speed
+
+        self._sync_to_db()
+        logger.debug(f"下载进度: {downloaded}/{total} ({self.progress:.1f}%)")
+
+    def _finish_download(self, success):
+        """根据下载结果更新任务状态"""
+        logger.info(f"下载执行结果: {success}")
+
+        if success:
+            self.status = "completed"
+            self.end_time = datetime.now()
+            logger.info(f"下载完成: task_id={self.task_id}")
+        else:
+            self.status = "failed"
+            logger.error(f"下载失败: task_id={self.task_id}")
+
+        self._sync_to_db()
+
     def start(self):
         """开始下载任务"""
         try:
-            logger.info(f"开始下载任务: task_id={self.task_id}, url={self.url}")
-
-            # 设置开始时间
-            self.start_time = datetime.now()
-            self.status = "downloading"
-            self._sync_to_db()
-            logger.info(f"任务状态已更新: {self.status}")
-
-            # 创建下载器
-            logger.info("创建下载器...")
-            output_file = os.path.join(self.temp_dir, f"output.{self.format_type}")
-            self.downloader = M3U8Downloader(url=self.url, output_path=output_file)
-            logger.info(f"下载器创建成功，输出文件: {output_file}")
-
-            # 定义进度回调
-            def progress_callback(downloaded, total, segment_size):
-                self.downloaded_segments = downloaded
-                self.total_segments = total
-                self.progress = (downloaded / total * 100) if total > 0 else 0
-                self.downloaded_size += segment_size
-
-                # 计算下载速度和预计剩余时间
-                elapsed_time = (datetime.now() - self.start_time).total_seconds()
-                if elapsed_time > 0:
-                    self.download_speed = self.downloaded_size / elapsed_time
-                    if self.download_speed > 0:
-                        remaining_segments = total - downloaded
-                        estimated_remaining_size = (
-                            (self.downloaded_size / downloaded) * remaining_segments
-                            if downloaded > 0
-                            else 0
-                        )
-                        self.estimated_time = (
-                            estimated_remaining_size / self.download_speed
-                        )
-
-                self._sync_to_db()
-                logger.debug(f"下载进度: {downloaded}/{total} ({self.progress:.1f}%)")
+            self._prepare_download()
 
             # 开始下载
             logger.info("开始执行下载...")
             success = self.downloader.download_segment(
-                progress_callback=progress_callback,
+                progress_callback=self._progress_callback,
                 cancel_event=self.cancel_event,
                 pause_event=self.metadata_ready,  # 使用 metadata_ready 作为暂停事件
             )
-            logger.info(f"下载执行结果: {success}")
-
-            if success:
-                self.status = "completed"
-                self.end_time = datetime.now()
-                logger.info(f"下载完成: task_id={self.task_id}")
-            else:
-                self.status = "failed"
-                logger.error(f"下载失败: task_id={self.task_id}")
-
-            self._sync_to_db()
+            self._finish_download(success)
 
         except Exception as e:
             self.status = "failed"
@@ -169,6 +206,36 @@ class Task:
             self._sync_to_db()
             raise
 
+    async def start_async(self):
+        """在共享事件循环上执行下载任务，数据库操作放到线程池中执行"""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._prepare_download)
+
+            if not hasattr(self.downloader, "download_segment_async"):
+                # 下载器不支持asyncio（如未安装aiohttp），在线程池中执行
+                success = await loop.run_in_executor(
+                    None,
+                    lambda: self.downloader.download_segment(
+                        progress_callback=self._progress_callback,
+                        cancel_event=self.cancel_event,
+                        pause_event=self.metadata_ready,
+                    ),
+                )
+            else:
+                logger.info("开始执行下载...")
+                success = await self.downloader.download_segment_async(
+                    progress_callback=self._progress_callback,
+                    cancel_event=self.cancel_event,
+                    pause_event=self.metadata_ready,
+                )
+            await loop.run_in_executor(None, self._finish_download, success)
+
+        except Exception as e:
+            self.status = "failed"
+            logger.error(f"下载失败: {str(e)}", exc_info=True)
+            await loop.run_in_executor(None, self._sync_to_db)
+
     def cancel(self):
         """取消任务"""
         if self.downloader:
@@ -193,6 +260,16 @@ class Task:
         self.status = "downloading"
         self._sync_to_db()
 
+    def set_speed_limit(self, speed_limit=None, weight=None):
+        """修改任务的速度上限（MB/s）或带宽权重，正在下载时立即生效"""
+        if speed_limit is not None:
+            self.options["speed_limit"] = float(speed_limit)
+        if weight is not None:
+            self.options["weight"] = float(weight)
+        self._save_options()
+        if self.downloader:
+            self.downloader.set_rate_limit(speed_limit, weight)
+
     def get_status(self) -> Dict:
         """获取任务状态"""
         if self.downloader:
@@ -215,6 +292,7 @@ class Task:
             "url": self.url,
             "filename": self.filename,
             "format_type": self.format_type,
+            "options": self.options,
             "status": self.status,
             "progress": self.progress,
             "segments": {
@@ -230,4 +308,19 @@ class Task:
             "downloaded_size": self.downloaded_size,
             "download_speed": self.download_speed,
             "estimated_time": self.estimated_time,
+            "variants": (
+                self.downloader.get_variant_info() if self.downloader else None
+            ),
+            "rate_limit": (
+                self.downloader.get_rate_limit_info() if self.downloader else None
+            ),
+            "concurrency": (
+                self.downloader.get_concurrency_info() if self.downloader else None
+            ),
+            "retries": (self.downloader.get_retry_info() if self.downloader else None),
+            "hedging": (self.downloader.get_hedge_info() if self.downloader else None),
+            "mirrors": (self.downloader.get_mirror_info() if self.downloader else None),
+            "pipeline": (
+                self.downloader.get_pipeline_stats() if self.downloader else None
+            ),
         }
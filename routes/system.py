@@ -95,6 +95,34 @@ def get_system_resources():
         return jsonify({"error": str(e)}), 500
 
 
+@system_bp.route("/transfer_stats")
+def get_transfer_stats():
+    """获取共享传输引擎的连接复用、密钥缓存、分片缓存及源站并发统计"""
+    try:
+        from services.concurrency_controller import get_origin_stats
+        from services.downloader import get_transfer_engine
+        from services.fileops import get_copy_stats
+        from services.host_scheduler import get_host_stats
+        from services.key_cache import get_key_cache
+        from services.proxy_pool import get_proxy_pool
+        from services.retry_policy import get_breaker_stats
+        from services.rate_limiter import get_rate_limiter
+        from services.segment_cache import get_segment_cache
+
+        stats = get_transfer_engine().get_stats()
+        stats["key_cache"] = get_key_cache().get_stats()
+        stats["origins"] = get_origin_stats()
+        stats["rate_limit"] = get_rate_limiter().get_stats()
+        stats["hosts"] = get_host_stats()
+        stats["breakers"] = get_breaker_stats()
+        stats["proxies"] = get_proxy_pool().get_stats()
+        stats["merge_copy"] = get_copy_stats()
+        stats["segment_cache"] = get_segment_cache().get_stats()
+        return jsonify(stats)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @system_bp.route("/config", methods=["GET", "POST"])
 def handle_config():
     """处理配置"""
@@ -104,9 +132,12 @@ def handle_config():
         return jsonify(
             {
                 "max_concurrent": Config.MAX_CONCURRENT_DOWNLOADS,
-                "speed_limit": Config.SPEED_LIMIT,
+                "speed_limit": Config.SPEED_LIMIT / (1024 * 1024),  # MB/s
                 "cleanup_days": Config.AUTO_CLEANUP_DAYS,
                 "verify_ssl": Config.VERIFY_SSL,
+                "http_transport": Config.HTTP_TRANSPORT,
+                "proxies": Config.PROXIES,
+                "merge_mode": Config.MERGE_MODE,
             }
         )
 
@@ -115,11 +146,25 @@ def handle_config():
         if "max_concurrent" in data:
             Config.MAX_CONCURRENT_DOWNLOADS = int(data["max_concurrent"])
         if "speed_limit" in data:
-            Config.SPEED_LIMIT = int(data["speed_limit"])
+            # 页面上的限速单位为MB/s，修改后立即对正在下载的任务生效
+            Config.SPEED_LIMIT = int(max(0, float(data["speed_limit"])) * 1024 * 1024)
         if "cleanup_days" in data:
             Config.AUTO_CLEANUP_DAYS = int(data["cleanup_days"])
         if "verify_ssl" in data:
             Config.VERIFY_SSL = bool(data["verify_ssl"])
+        if "http_transport" in data:
+            if data["http_transport"] not in ("http1", "http2"):
+                return jsonify({"error": "不支持的传输协议"}), 400
+            Config.HTTP_TRANSPORT = data["http_transport"]
+        if "merge_mode" in data:
+            if data["merge_mode"] not in ("stream", "pipe", "batch"):
+                return jsonify({"error": "不支持的合并方式"}), 400
+            Config.MERGE_MODE = data["merge_mode"]
+        if "proxies" in data:
+            from services.proxy_pool import get_proxy_pool, parse_proxies
+
+            Config.PROXIES = parse_proxies(data["proxies"])
+            get_proxy_pool().configure(Config.PROXIES)
 
         return jsonify({"status": "success"})
     except Exception as e:
@@ -7,9 +7,12 @@ from handlers.task_handler import (
     cancel_task_handler,
     pause_task_handler,
     resume_task,
+    retry_task_handler,
+    set_task_speed_limit_handler,
 )
 from models.database import get_session, TaskModel
 from models.task import download_tasks
+from services.playlist import VARIANT_POLICIES
 import logging
 import os
 import shutil
@@ -32,7 +35,35 @@ def create_task():
         if not url:
             return jsonify({"error": "缺少URL参数"}), 400
 
-        task = create_download_task(url, filename, format_type)
+        # 下载选项
+        options = {}
+        if data.get("concurrency"):
+            options["concurrency"] = int(data["concurrency"])
+        if "adaptive" in data:
+            options["adaptive"] = bool(data["adaptive"])
+        if data.get("mirrors"):
+            mirrors = data["mirrors"]
+            if isinstance(mirrors, str):
+                mirrors = [m for m in mirrors.splitlines() if m.strip()]
+            if not isinstance(mirrors, list) or not all(
+                isinstance(m, str) for m in mirrors
+            ):
+                return jsonify({"error": "镜像列表格式错误"}), 400
+            options["mirrors"] = mirrors
+        if "hedge" in data:
+            options["hedge"] = bool(data["hedge"])
+        if data.get("speed_limit"):
+            options["speed_limit"] = float(data["speed_limit"])
+        if data.get("weight"):
+            options["weight"] = float(data["weight"])
+        if data.get("variant_policy"):
+            if data["variant_policy"] not in VARIANT_POLICIES:
+                return jsonify({"error": "不支持的码率选择策略"}), 400
+            options["variant_policy"] = data["variant_policy"]
+        if data.get("max_height"):
+            options["max_height"] = int(data["max_height"])
+
+        task = create_download_task(url, filename, format_type, options)
         if task:
             # 启动任务
             start_download_task(task["task_id"])
@@ -107,6 +138,41 @@ def resume_task_route(task_id):
         return jsonify({"error": str(e)}), 500
 
 
+@task_bp.route("/<task_id>/retry", methods=["POST"])
+def retry_task_route(task_id):
+    """重试任务（断点续传）"""
+    try:
+        task = retry_task_handler(task_id)
+        if task:
+            return jsonify({"status": "success", "task": task})
+        else:
+            return jsonify({"error": "任务不存在或无法重试"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@task_bp.route("/<task_id>/speed_limit", methods=["POST"])
+def set_task_speed_limit(task_id):
+    """修改任务的速度上限（MB/s，0表示不限速）或带宽权重"""
+    try:
+        data = request.get_json() or {}
+        speed_limit = data.get("speed_limit")
+        weight = data.get("weight")
+        if speed_limit is None and weight is None:
+            return jsonify({"error": "缺少speed_limit或weight参数"}), 400
+
+        if set_task_speed_limit_handler(
+            task_id,
+            float(speed_limit) if speed_limit is not None else None,
+            float(weight) if weight is not None else None,
+        ):
+            return jsonify({"status": "success"})
+        else:
+            return jsonify({"error": "任务不存在"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @task_bp.route("/<task_id>", methods=["DELETE"])
 def delete_task_route(task_id):
     """删除任务"""
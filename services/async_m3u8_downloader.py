@@ -0,0 +1,639 @@
+import asyncio
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from config import Config
+from services.compact_playlist import SEGMENT_DONE
+from services.dns_cache import get_dns_cache
+from services.hedging import HedgeLost, HedgeRace, hedge_file, replay_hedge
+from services.host_scheduler import get_host_scheduler
+from services.m3u8_downloader import M3U8Downloader
+from services.proxy_pool import is_proxy_error
+from services.retry_policy import get_circuit_breaker
+from services.segment_jobs import JobSplitter, SegmentJob
+from services.segment_pipeline import get_segment_pipeline
+from services.segment_validator import check_content_length
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp 为可选依赖，未安装时回退到线程下载引擎
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+# aiohttp只支持HTTP代理，SOCKS代理需使用线程下载引擎
+_PROXY_SCHEMES = ("http", "https")
+
+# 所有任务共享的事件循环及HTTP会话
+_loop = None
+_loop_lock = threading.Lock()
+_client_session = None
+_io_executor = None
+
+
+def get_download_loop():
+    """获取共享的下载事件循环，首次调用时在后台线程中启动"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name="download-loop", daemon=True
+            )
+            thread.start()
+            _loop = loop
+            atexit.register(_shutdown_loop)
+            logger.info("下载事件循环已启动")
+        return _loop
+
+
+def _shutdown_loop():
+    """进程退出时在下载事件循环中关闭共享的HTTP会话及其连接"""
+
+    async def close():
+        if _client_session is not None and not _client_session.closed:
+            await _client_session.close()
+
+    loop = _loop
+    if loop is None or not loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(close(), loop).result(timeout=5)
+    except Exception as e:
+        logger.debug(f"关闭HTTP会话失败: {str(e)}")
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def _log_background_error(future):
+    """记录未被等待的后台操作的异常"""
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(f"后台操作失败: {str(future.exception())}")
+
+
+if aiohttp is not None:
+
+    class _CachedResolver(aiohttp.abc.AbstractResolver):
+        """使用进程内DNS缓存的aiohttp解析器，与线程下载引擎共享解析结果"""
+
+        async def resolve(self, host, port=0, family=socket.AF_INET):
+            loop = asyncio.get_running_loop()
+            addresses = await loop.run_in_executor(None, get_dns_cache().resolve, host)
+            return [
+                {
+                    "hostname": host,
+                    "host": ip,
+                    "port": port,
+                    "family": address_family,
+                    "proto": 0,
+                    "flags": socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+                }
+                for address_family, ip in addresses
+                if not family or address_family == family
+            ]
+
+        async def close(self):
+            pass
+
+
+def _get_io_executor():
+    """获取执行阻塞磁盘操作的线程池，事件循环中不直接读写文件"""
+    global _io_executor
+    with _loop_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(
+                max_workers=Config.ASYNC_IO_WORKERS, thread_name_prefix="async-io"
+            )
+        return _io_executor
+
+
+async def _run_io(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+        _get_io_executor(), func, *args
+    )
+
+
+def _get_client_session():
+    """获取共享的aiohttp会话，只能在下载事件循环中调用"""
+    global _client_session
+    if _client_session is None or _client_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=Config.ASYNC_MAX_CONNECTIONS,
+            limit_per_host=Config.ASYNC_MAX_CONNECTIONS_PER_HOST,
+            ssl=False,
+            resolver=_CachedResolver(),
+            use_dns_cache=False,  # 由共享的DNS缓存按TTL缓存
+        )
+        _client_session = aiohttp.ClientSession(
+            connector=connector,
+            headers={
+                "User-Agent": Config.DEFAULT_HEADERS["User-Agent"],
+                "Accept": "*/*",
+            },
+        )
+    return _client_session
+
+
+class AsyncM3U8Downloader(M3U8Downloader):
+    """基于asyncio的下载引擎，所有任务的分片请求运行在同一个事件循环上"""
+
+    def _prewarm_hosts(self, playlist):
+        """预先解析分片主机的DNS；aiohttp的连接在首次请求时建立"""
+        if not Config.PREWARM_CONNECTIONS:
+            return
+        for url in self._segment_hosts(playlist):
+            try:
+                get_dns_cache().resolve(urlsplit(url).hostname)
+            except Exception as e:
+                logger.debug(f"预解析 {url} 失败: {str(e)}")
+
+    def download_segment(
+        self, progress_callback=None, cancel_event=None, pause_event=None
+    ):
+        """同步接口，在共享事件循环上执行下载并等待结果"""
+        future = asyncio.run_coroutine_threadsafe(
+            self.download_segment_async(progress_callback, cancel_event, pause_event),
+            get_download_loop(),
+        )
+        return future.result()
+
+    def _client_timeout(self):
+        connect, read = self._controller.get_timeout()
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    async def _download_segment_with_retry_async(
+        self,
+        segment_url,
+        target,
+        key=None,
+        iv=None,
+        max_retries=None,
+        cancel_event=None,
+    ):
+        """异步下载单个分片到target（分片包中的分片），带重试机制"""
+        job = SegmentJob(segment_url)
+        job.add_part(0)
+        results = await self._download_job_with_retry_async(
+            job,
+            lambda part: self._open_sink(target, key, iv),
+            max_retries=max_retries,
+            cancel_event=cancel_event,
+        )
+        return results[0][1]
+
+    async def _download_job_hedged_async(self, job, open_sink, cancel_event=None):
+        """异步下载分片任务，耗时超过该主机pN耗时时发出对冲请求，先完成的一方获胜"""
+        if job.cached:
+            # 从共享分片缓存导入为文件复制，在线程池中执行
+            results = await _run_io(self._load_cached, job)
+            if results is not None:
+                return results
+        if not self.hedge:
+            return await self._download_job_with_retry_async(
+                job, open_sink, cancel_event=cancel_event
+            )
+        race = HedgeRace(job)
+        primary = asyncio.ensure_future(
+            self._download_job_with_retry_async(
+                job, open_sink, cancel_event=cancel_event, race=race
+            )
+        )
+        # 等待主请求实际发出后开始计时
+        while race.started is None and not primary.done():
+            await asyncio.wait({primary}, timeout=0.1)
+        threshold = self._hedges.threshold(race.host)
+        if not primary.done() and threshold is not None:
+            remaining = threshold - (time.monotonic() - race.started)
+            await asyncio.wait({primary}, timeout=max(remaining, 0))
+        if primary.done() or threshold is None or not self._hedges.try_hedge():
+            return await self._finish_primary_async(race, primary)
+
+        logger.info(f"分片耗时超过 {threshold:.1f} 秒，发出对冲请求: {job.url}")
+        race.hedged = True
+        hedge = asyncio.ensure_future(self._fetch_hedge_async(race, cancel_event))
+        await asyncio.wait({primary, hedge}, return_when=asyncio.FIRST_COMPLETED)
+        if hedge.done() and hedge.result() is not None:
+            # 对冲请求先完成，取消主请求后使用对冲请求的数据
+            primary.cancel()
+            await asyncio.gather(primary, return_exceptions=True)
+            self._hedges.record_result(True)
+            logger.info(f"对冲请求先完成: {job.url}")
+            return await _run_io(replay_hedge, job, open_sink, *hedge.result())
+
+        if primary.done() and primary.exception() is None:
+            hedge.cancel()
+            await asyncio.gather(hedge, return_exceptions=True)
+            self._hedges.record_result(False)
+            return await self._finish_primary_async(race, primary)
+
+        # 一方失败时等待另一方
+        result = await hedge
+        if primary.done() and result is not None:
+            primary.exception()  # 主请求的失败已由对冲请求弥补
+            self._hedges.record_result(True)
+            return await _run_io(replay_hedge, job, open_sink, *result)
+        self._hedges.record_result(False)
+        return await self._finish_primary_async(race, primary)
+
+    async def _finish_primary_async(self, race, primary):
+        results = await primary
+        self._hedges.observe(race.host, time.monotonic() - race.started)
+        return results
+
+    async def _fetch_hedge_async(self, race, cancel_event=None):
+        """异步对冲请求：把数据下载到私有临时文件，获胜时返回(文件路径, 跳过字节数)"""
+        job = race.job
+        mirror, url = self._hedge_mirror(race)
+        host = get_host_scheduler(url)
+        breaker = get_circuit_breaker(url)
+        delay = host.try_reserve()
+        if delay is None:
+            return None  # 主机暂停请求（Retry-After）或请求数已满，不再增加负担
+        path = hedge_file(os.path.dirname(self.output_path), job)
+        result = None
+        proxy = None
+        try:
+            # 与主请求相同遵守主机的发送节奏
+            if delay > 0:
+                await asyncio.sleep(delay)
+                if race.lost("hedge") or (cancel_event and cancel_event.is_set()):
+                    return None
+            breaker.check()
+            proxy = self._proxies.acquire(schemes=_PROXY_SCHEMES)
+            self._retry_budget.on_request()
+            headers = {}
+            if job.start is not None:
+                headers["Range"] = job.range_header()
+            request_started = time.time()
+            async with _get_client_session().get(
+                url,
+                timeout=self._client_timeout(),
+                headers=headers,
+                proxy=proxy.url if proxy else None,
+            ) as response:
+                skip = self._range_skip(job, response.status, response.headers)
+                overrun = job.start is not None and response.status == 200
+                received = 0
+                buffer = bytearray()
+                f = await _run_io(open, path, "wb")
+                try:
+                    async for chunk in response.content.iter_chunked(Config.CHUNK_SIZE):
+                        if race.lost("hedge") or (
+                            cancel_event and cancel_event.is_set()
+                        ):
+                            return None
+                        received += len(chunk)
+                        wait = self._rate_limiter.reserve(self.rate_share, len(chunk))
+                        if wait > 0:
+                            await asyncio.sleep(wait)
+                        buffer += chunk
+                        if len(buffer) >= Config.PIPELINE_CHUNK_SIZE:
+                            await _run_io(f.write, bytes(buffer))
+                            buffer.clear()
+                        if overrun and received >= job.end:
+                            break
+                    else:
+                        check_content_length(response.headers, received)
+                    await _run_io(f.write, bytes(buffer))
+                finally:
+                    await _run_io(f.close)
+            breaker.record(None)
+            self._mirrors.record_success(
+                mirror, received, time.time() - request_started
+            )
+            self._proxies.record_success(proxy, received, time.time() - request_started)
+            if race.claim("hedge"):
+                result = (path, skip)
+            return result
+        except Exception as e:
+            breaker.record(e)
+            self._mirrors.record_failure(mirror, e)
+            self._proxies.record_failure(proxy, e)
+            logger.info(f"对冲请求失败: {url}, error={str(e)}")
+            return None
+        finally:
+            self._proxies.release(proxy)
+            host.release()
+            if result is None and os.path.exists(path):
+                os.remove(path)
+
+    async def _download_job_with_retry_async(
+        self, job, open_sink, max_retries=None, cancel_event=None, race=None
+    ):
+        """异步下载一个分片任务（完整分片或合并后的字节范围），带重试机制"""
+        session = _get_client_session()
+        max_retries = max_retries or Config.RETRY_MAX_ATTEMPTS
+        attempt = 0
+        tried = set()  # 本任务失败过的镜像，重试时优先换用其它镜像
+        tried_proxies = set()
+        while True:
+            if cancel_event and cancel_event.is_set():
+                raise Exception("下载已取消")
+            mirror, url, breaker = self._select_mirror(job.url, tried)
+            origin = self._origin_controller(url)
+            host = get_host_scheduler(url)
+            if race:
+                race.mirror = mirror
+            delay = 0
+            proxy = None
+            acquired = False
+            host_acquired = False
+            try:
+                # 主机调度器控制请求数及发送节奏，所有任务共享；
+                # 先等待主机（Retry-After可能很长）再占用源站名额，等待时不占用源站并发
+                while not host.try_acquire():
+                    if cancel_event and cancel_event.is_set():
+                        raise Exception("下载已取消")
+                    await asyncio.sleep(0.05)
+                host_acquired = True
+                wait = host.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                if origin:
+                    # 源站并发数已满时等待
+                    while not origin.try_acquire():
+                        if cancel_event and cancel_event.is_set():
+                            raise Exception("下载已取消")
+                        await asyncio.sleep(0.05)
+                    acquired = True
+                proxy = self._proxies.acquire(
+                    exclude=tried_proxies, schemes=_PROXY_SCHEMES
+                )
+                self._retry_budget.on_request()
+                headers = {}
+                if job.start is not None:
+                    headers["Range"] = job.range_header()
+                if race:
+                    race.begin()
+                request_started = time.time()
+                async with session.get(
+                    url,
+                    timeout=self._client_timeout(),
+                    headers=headers,
+                    proxy=proxy.url if proxy else None,
+                ) as response:
+                    latency = time.time() - request_started
+                    # 边下载边解密保存分片：数据攒够一块后交给流水线，
+                    # 队列满时的等待及写盘都在线程池中进行，不阻塞事件循环
+                    splitter = JobSplitter(
+                        job,
+                        open_sink,
+                        self._range_skip(job, response.status, response.headers),
+                    )
+                    # 服务器忽略Range返回完整资源时，任务范围内的数据收齐后即停止读取并关闭连接
+                    overrun = job.start is not None and response.status == 200
+                    try:
+                        received = 0
+                        buffer = bytearray()
+                        async for chunk in response.content.iter_chunked(
+                            Config.CHUNK_SIZE
+                        ):
+                            if cancel_event and cancel_event.is_set():
+                                raise Exception("下载已取消")
+                            received += len(chunk)
+                            wait = self._rate_limiter.reserve(
+                                self.rate_share, len(chunk)
+                            )
+                            if wait > 0:
+                                await asyncio.sleep(wait)
+                            buffer += chunk
+                            covered = overrun and received >= job.end
+                            if len(buffer) >= Config.PIPELINE_CHUNK_SIZE or covered:
+                                done = await _run_io(splitter.feed, bytes(buffer))
+                                buffer.clear()
+                                if done and overrun:
+                                    break
+                        else:
+                            check_content_length(response.headers, received)
+                        if race and not race.claim("primary"):
+                            raise HedgeLost()
+                        if buffer:
+                            await _run_io(splitter.feed, bytes(buffer))
+                        results = await _run_io(splitter.close)
+                    except BaseException:
+                        # 含对冲请求获胜后的取消，等待已提交的数据处理完
+                        await asyncio.shield(_run_io(splitter.abort))
+                        raise
+                self._report_success(origin, latency, received)
+                breaker.record(None)
+                self._mirrors.record_success(
+                    mirror, received, time.time() - request_started
+                )
+                self._proxies.record_success(
+                    proxy, received, time.time() - request_started
+                )
+                return results
+
+            except Exception as e:
+                if (cancel_event and cancel_event.is_set()) or isinstance(e, HedgeLost):
+                    raise
+                attempt += 1
+                self._mirrors.record_failure(mirror, e)
+                tried.add(mirror)
+                proxy_failed = proxy is not None and is_proxy_error(e)
+                if proxy:
+                    self._proxies.record_failure(proxy, e)
+                    tried_proxies.add(proxy)
+                delay = self._on_attempt_failed(
+                    url,
+                    e,
+                    attempt,
+                    max_retries,
+                    origin,
+                    host,
+                    # 代理故障与源站无关，不计入源站的熔断器，换用其它代理立即重试
+                    None if proxy_failed else breaker,
+                    failover=self._mirrors.has_alternative(job.url, tried)
+                    or (proxy_failed and self._proxies.has_alternative(tried_proxies)),
+                )
+            finally:
+                self._proxies.release(proxy)
+                if host_acquired:
+                    host.release()
+                if acquired:
+                    origin.release()
+            # 释放并发名额后再等待
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def download_segment_async(
+        self, progress_callback=None, cancel_event=None, pause_event=None
+    ):
+        """下载M3U8视频分片（异步版本），返回值与进度回调同线程下载引擎一致"""
+        loop = asyncio.get_running_loop()
+        try:
+            logger.info(f"开始下载M3U8(asyncio): {self.m3u8_url}")
+            # 播放列表加载（含主播放列表的码率选择）较少，在线程池中执行
+            playlist = await loop.run_in_executor(None, self._load_playlist)
+            if not playlist.segments:
+                logger.error("M3U8文件没有分片")
+                return False
+
+            self.total_segments = len(playlist.segments)
+            logger.info(f"找到 {self.total_segments} 个分片")
+
+            # 获取密钥的同时预先解析分片主机
+            prewarm = loop.run_in_executor(None, self._prewarm_hosts, playlist)
+            prewarm.add_done_callback(_log_background_error)
+
+            # 密钥缓存为同步接口，在线程池中预先获取所有分片的密钥
+            segment_keys = await loop.run_in_executor(
+                None, self._prepare_segment_keys, playlist
+            )
+
+            task_dir = os.path.dirname(self.output_path)
+            self.downloaded_segments = 0
+            self.failed_segments = []
+            self._bytes_since_last_update = 0
+            self._last_progress_update = time.time()
+            logger.info(
+                f"分片并发数: {self.concurrency}，自适应: {bool(self.adaptive)}"
+            )
+
+            # 分片包和断点续传日志的读写为阻塞操作，在线程池中执行
+            jobs = await _run_io(
+                self._plan_jobs, playlist, segment_keys, progress_callback
+            )
+            self._pipeline = get_segment_pipeline()
+
+            def open_sink(part):
+                return self._open_segment_sink(part.index, segment_keys)
+
+            # 只在事件循环中访问，不需要加锁
+            pending = deque(jobs)
+            results = asyncio.Queue()
+            remaining = len(jobs)  # 尚未返回结果的任务数（含校验失败后重新下载的任务）
+
+            async def validate(job_results, segment_url):
+                """在校验线程池中检查分片，校验失败的分片重新加入下载队列"""
+                nonlocal remaining
+                checked = []
+                for index, segment_size in job_results:
+                    self._states.set(index, SEGMENT_DONE)
+                    if Config.SEGMENT_VALIDATION:
+                        try:
+                            await asyncio.wrap_future(self._validate(index))
+                        except Exception as e:
+                            if self._validation_failed(index, segment_url, e):
+                                # 放在队首，流式合并时不会被合并窗口挡住
+                                pending.appendleft(self._single_segment_job(index))
+                                remaining += 1
+                            continue
+                    checked.append((index, segment_size))
+                return checked
+
+            async def worker():
+                nonlocal remaining
+                while pending:
+                    if cancel_event and cancel_event.is_set():
+                        return
+                    while pause_event and pause_event.is_set():
+                        if cancel_event and cancel_event.is_set():
+                            return
+                        await asyncio.sleep(0.1)
+
+                    # 并发数由控制器决定，超出流式合并窗口或达到上限时等待
+                    if (
+                        self._merge_blocked(pending[0])
+                        or not self._controller.try_acquire()
+                    ):
+                        if self._merge_stalled():
+                            # 合并位置的分片已失败，任务无法完成
+                            remaining -= len(pending)
+                            pending.clear()
+                            return
+                        await asyncio.sleep(0.05)
+                        continue
+
+                    job = pending.popleft()
+                    try:
+                        job_results = await self._download_job_hedged_async(
+                            job, open_sink, cancel_event=cancel_event
+                        )
+                        job_results = await validate(job_results, job.url)
+                        await results.put((job, job_results, None))
+                    except Exception as e:
+                        await results.put((job, None, e))
+                    finally:
+                        self._controller.release()
+
+            self._rate_limiter.register(self.rate_share)
+            workers = [
+                asyncio.create_task(worker())
+                for _ in range(min(self._controller.max_limit, len(jobs)))
+            ]
+            try:
+                while remaining > 0:
+                    result = None
+                    # 流式合并无法继续时工作协程会放弃剩余的任务并减少remaining
+                    while result is None and remaining > 0:
+                        if cancel_event and cancel_event.is_set():
+                            logger.info("下载已取消")
+                            return False
+                        try:
+                            result = await asyncio.wait_for(results.get(), 0.5)
+                        except asyncio.TimeoutError:
+                            continue
+                    if result is None:
+                        break
+
+                    remaining -= 1
+                    job, job_results, error = result
+                    if error is not None:
+                        logger.error(f"下载分片失败: {job.url}, error={str(error)}")
+                        for index in job.indexes:
+                            self._segment_failed(index, job.url, error)
+                        continue
+
+                    for index, segment_size in job_results:
+                        # 写入分片包索引和断点续传日志（日志定期同步到磁盘）、保存到分片缓存
+                        await _run_io(self._record_segment, index)
+                        self.downloaded_segments += 1
+                        self.progress = (
+                            self.downloaded_segments / self.total_segments
+                        ) * 100
+                        # 进度回调可能访问数据库，放到线程池中执行以免阻塞事件循环
+                        if progress_callback:
+                            await loop.run_in_executor(
+                                None,
+                                progress_callback,
+                                self.downloaded_segments,
+                                self.total_segments,
+                                segment_size,
+                            )
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                self._rate_limiter.unregister(self.rate_share)
+
+            # 检查是否有失败的分片
+            if self.failed_segments:
+                self._log_failed_segments()
+                return False
+
+            # 合并分片（阻塞操作，放到线程池中执行）
+            success = await loop.run_in_executor(None, self._merge_segments, task_dir)
+            await _run_io(self._close_task, success)
+            return success
+
+        except Exception as e:
+            logger.error(f"下载失败: {str(e)}", exc_info=True)
+            return False
+        finally:
+            await _run_io(self._close_task, False)
+
+    def _close_task(self, success):
+        """停止流式合并并关闭断点续传日志和分片包，已关闭的不再处理"""
+        self._close_merger()
+        self._close_journal(success)
+        self._close_pack(success)
+        if self._pipeline:
+            self._last_pipeline_stats = self._pipeline.get_stats()
+            self._pipeline = None
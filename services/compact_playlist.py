@@ -0,0 +1,293 @@
+import io
+import re
+import threading
+from array import array
+from collections.abc import Sequence
+from urllib.parse import urljoin
+
+import m3u8
+
+from services.segment_jobs import parse_byterange
+
+# 分片状态（状态位图中每个分片占2位）
+SEGMENT_PENDING = 0
+SEGMENT_DONE = 1  # 已下载，等待校验
+SEGMENT_FAILED = 2
+SEGMENT_VERIFIED = 3  # 已校验
+STATE_NAMES = ("pending", "done", "failed", "verified")
+
+_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+class PlaylistKey:
+    """EXT-X-KEY，属性与m3u8.Key相同"""
+
+    __slots__ = ("method", "uri", "iv")
+
+    def __init__(self, method, uri=None, iv=None):
+        self.method = method
+        self.uri = uri
+        self.iv = iv
+
+
+class PlaylistSegment:
+    """播放列表中的一个分片，访问时由列存储生成，属性与m3u8.Segment相同"""
+
+    __slots__ = ("uri", "absolute_uri", "duration", "byterange", "key")
+
+    def __init__(self, uri, absolute_uri, duration, byterange, key):
+        self.uri = uri
+        self.absolute_uri = absolute_uri
+        self.duration = duration
+        self.byterange = byterange
+        self.key = key
+
+
+class _Column(Sequence):
+    def __init__(self, playlist, get):
+        self._playlist = playlist
+        self._get = get
+
+    def __len__(self):
+        return len(self._playlist)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._get(index)
+
+
+class CompactPlaylist:
+    """媒体播放列表的列存储
+
+    分片地址按目录前缀去重，文件名部分连续保存在一个bytearray中；时长、字节范围及密钥序号
+    各用一个array保存，每个分片只占几十字节，不为每个分片创建Python对象。
+    segments和segment_urls按需生成分片对象和绝对地址，可以替代m3u8对象的segments使用。
+    """
+
+    is_variant = False
+
+    def __init__(self, uri=None):
+        self.base_uri = uri
+        self.media_sequence = 0
+        self.target_duration = None
+        self.is_endlist = False
+        self.keys = []  # 去重后的密钥，分片保存其序号
+        self._key_index = {}
+        self._prefixes = []  # 分片地址的目录前缀
+        self._prefix_index = {}
+        self._absolute_prefixes = {}  # 前缀序号 -> 解析后的绝对前缀
+        self._uri_prefix = array("I")
+        self._uri_data = bytearray()  # 文件名部分（UTF-8）
+        self._uri_offsets = array("Q", [0])
+        self._durations = array("d")  # 没有EXTINF时为-1
+        self._range_lengths = None  # 第一个带字节范围的分片出现时创建
+        self._range_offsets = None  # 未指定偏移时为-1
+        self._key_indexes = array("i")  # 未加密为-1
+        self.segments = _Column(self, self.segment)
+        self.segment_urls = _Column(self, self.absolute_uri)
+
+    def __len__(self):
+        return len(self._durations)
+
+    def _add_key(self, attributes):
+        method = attributes.get("METHOD")
+        if not method or method == "NONE":
+            return -1
+        identity = (method, attributes.get("URI"), attributes.get("IV"))
+        index = self._key_index.get(identity)
+        if index is None:
+            index = self._key_index[identity] = len(self.keys)
+            self.keys.append(PlaylistKey(*identity))
+        return index
+
+    def append(self, uri, duration=None, byterange=None, key_index=-1):
+        """添加一个分片"""
+        split = uri.rfind("/", 0, _query_start(uri)) + 1
+        prefix = self._prefix_index.get(uri[:split])
+        if prefix is None:
+            prefix = self._prefix_index[uri[:split]] = len(self._prefixes)
+            self._prefixes.append(uri[:split])
+        self._uri_prefix.append(prefix)
+        self._uri_data += uri[split:].encode("utf-8")
+        self._uri_offsets.append(len(self._uri_data))
+        self._durations.append(-1 if duration is None else duration)
+        self._key_indexes.append(key_index)
+        if byterange is not None and self._range_lengths is None:
+            self._range_lengths = array("q", [-1]) * (len(self) - 1)
+            self._range_offsets = array("q", [-1]) * (len(self) - 1)
+        if self._range_lengths is not None:
+            if byterange is None:
+                length, offset = -1, None
+            else:
+                length, offset = parse_byterange(byterange)
+            self._range_lengths.append(length)
+            self._range_offsets.append(-1 if offset is None else offset)
+
+    def _name(self, index):
+        start, end = self._uri_offsets[index], self._uri_offsets[index + 1]
+        return self._uri_data[start:end].decode("utf-8")
+
+    def uri(self, index):
+        """分片地址（播放列表中的原始值）"""
+        return self._prefixes[self._uri_prefix[index]] + self._name(index)
+
+    def absolute_uri(self, index):
+        """分片的绝对地址，相对地址按播放列表地址解析"""
+        prefix = self._uri_prefix[index]
+        name = self._name(index)
+        if name in (".", "..") or name.startswith(("?", "#")):
+            return urljoin(self.base_uri or "", self._prefixes[prefix] + name)
+        base = self._absolute_prefixes.get(prefix)
+        if base is None:
+            # 同一前缀下的文件名直接拼接，每个前缀只解析一次
+            base = urljoin(self.base_uri or "", self._prefixes[prefix] + "_")[:-1]
+            self._absolute_prefixes[prefix] = base
+        return base + name
+
+    def byterange(self, index):
+        """EXT-X-BYTERANGE的值，没有时返回None"""
+        if self._range_lengths is None or self._range_lengths[index] < 0:
+            return None
+        offset = self._range_offsets[index]
+        length = self._range_lengths[index]
+        return f"{length}@{offset}" if offset >= 0 else str(length)
+
+    def segment(self, index):
+        duration = self._durations[index]
+        key = self._key_indexes[index]
+        return PlaylistSegment(
+            self.uri(index),
+            self.absolute_uri(index),
+            None if duration < 0 else duration,
+            self.byterange(index),
+            self.keys[key] if key >= 0 else None,
+        )
+
+    def memory_size(self):
+        """列存储占用的字节数（不含去重后的前缀和密钥）"""
+        columns = [
+            self._uri_prefix,
+            self._uri_data,
+            self._uri_offsets,
+            self._durations,
+            self._key_indexes,
+            self._range_lengths,
+            self._range_offsets,
+        ]
+        return sum(
+            len(column) * getattr(column, "itemsize", 1)
+            for column in columns
+            if column is not None
+        )
+
+
+def _query_start(uri):
+    """地址中查询参数或片段的起始位置，前缀只在其之前划分"""
+    end = len(uri)
+    for mark in ("?", "#"):
+        position = uri.find(mark, 0, end)
+        if position >= 0:
+            end = position
+    return end
+
+
+def _parse_attributes(value):
+    return {
+        name: item[1:-1] if item.startswith('"') else item
+        for name, item in _ATTRIBUTE.findall(value)
+    }
+
+
+def _parse_duration(value):
+    """#EXTINF的时长，格式不正确时为0"""
+    try:
+        return float(value.split(",", 1)[0].strip() or 0)
+    except ValueError:
+        return 0.0
+
+
+def _check_header(line):
+    """M3U8文件的第一行必须是#EXTM3U（允许UTF-8 BOM）"""
+    if not line.lstrip("\ufeff").startswith("#EXTM3U"):
+        raise Exception("不是有效的M3U8文件")
+
+
+def parse_media_playlist(lines, uri=None):
+    """逐行解析媒体播放列表，返回CompactPlaylist
+
+    与m3u8库相同，只有跟在#EXTINF之后的地址行才是分片，其它非注释行忽略。
+    """
+    playlist = CompactPlaylist(uri)
+    duration = None  # 等待分片地址的#EXTINF时长
+    byterange = None
+    key_index = -1
+    header = False
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if not header:
+            _check_header(line)
+            header = True
+            continue
+        if line[0] != "#":
+            if duration is None:
+                continue
+            playlist.append(line, duration, byterange, key_index)
+            duration = byterange = None
+        elif line.startswith("#EXTINF:"):
+            duration = _parse_duration(line[8:])
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            byterange = line[17:]
+        elif line.startswith("#EXT-X-KEY:"):
+            key_index = playlist._add_key(_parse_attributes(line[11:]))
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            playlist.media_sequence = int(line[22:])
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            playlist.target_duration = float(line[22:])
+        elif line == "#EXT-X-ENDLIST":
+            playlist.is_endlist = True
+    if not header:
+        _check_header("")
+    return playlist
+
+
+def parse_playlist(text, uri=None):
+    """解析M3U8文本：主播放列表（码率较少）使用m3u8库，媒体播放列表使用列存储"""
+    text = text.lstrip("\ufeff")
+    _check_header(text.lstrip())
+    if "#EXT-X-STREAM-INF" in text:
+        return m3u8.loads(text, uri=uri)
+    return parse_media_playlist(io.StringIO(text), uri)
+
+
+class SegmentStates:
+    """分片状态位图，每个分片2位（pending/done/failed/verified），并维护各状态的分片数"""
+
+    def __init__(self, count):
+        self._bits = bytearray((count + 3) // 4)
+        self._counts = [count, 0, 0, 0]
+        # 同一字节中的4个分片可能在不同线程中更新（如asyncio引擎的写盘线程）
+        self._lock = threading.Lock()
+
+    def get(self, index):
+        return (self._bits[index >> 2] >> ((index & 3) << 1)) & 3
+
+    def set(self, index, state):
+        shift = (index & 3) << 1
+        with self._lock:
+            byte = self._bits[index >> 2]
+            self._counts[(byte >> shift) & 3] -= 1
+            self._counts[state] += 1
+            self._bits[index >> 2] = (byte & ~(3 << shift)) | (state << shift)
+
+    def count(self, state):
+        return self._counts[state]
+
+    def snapshot(self):
+        return dict(zip(STATE_NAMES, self._counts))
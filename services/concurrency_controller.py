@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+from config import Config
+from services.downloader import HTTPStatusError
+
+logger = logging.getLogger(__name__)
+
+
+def congestion_reason(error):
+    """判断错误是否表示服务器过载，返回原因描述，其它错误返回None"""
+    if isinstance(error, HTTPStatusError):
+        if error.status_code == 429 or error.status_code >= 500:
+            return f"HTTP {error.status_code}"
+        return None
+    if isinstance(error, TimeoutError) or "timed out" in str(error).lower():
+        return "超时"
+    return None
+
+
+class AIMDController:
+    """加性增、乘性减（AIMD）的并发控制器
+
+    每完成约limit个请求评估一次吞吐量，吞吐量上升时并发数加1；
+    遇到429/5xx/超时时并发数乘以AIMD_DECREASE_FACTOR，同一次拥塞只减少一次。
+    同时按请求首字节延迟估算超时时间（类似TCP的RTO）。
+    """
+
+    def __init__(self, name, initial, min_limit=None, max_limit=None):
+        self.name = name
+        self.min_limit = min_limit or Config.AIMD_MIN_CONCURRENCY
+        self.max_limit = max(max_limit or Config.AIMD_MAX_CONCURRENCY, initial)
+        self.limit = float(max(self.min_limit, initial))
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+        # 吞吐量评估窗口
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._window_count = 0
+        self._last_throughput = None
+        self._last_decrease = 0
+
+        # 首字节延迟的平滑值及偏差
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+        self.reasons = deque(maxlen=Config.AIMD_HISTORY_SIZE)
+
+    def current_limit(self):
+        return max(self.min_limit, int(self.limit))
+
+    def try_acquire(self):
+        """并发数未达到上限时占用一个名额"""
+        with self._cond:
+            if self.in_flight >= self.current_limit():
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self, cancel_event=None):
+        """等待并占用一个名额"""
+        with self._cond:
+            while self.in_flight >= self.current_limit():
+                if cancel_event and cancel_event.is_set():
+                    raise Exception("下载已取消")
+                self._cond.wait(0.1)
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def on_success(self, latency, size):
+        """记录一次成功的请求"""
+        with self._cond:
+            self._observe_latency(latency)
+            self._window_bytes += size
+            self._window_count += 1
+            if self._window_count < self.current_limit():
+                return
+
+            now = time.time()
+            elapsed = max(now - self._window_start, 1e-6)
+            throughput = self._window_bytes / elapsed
+            if self._last_throughput is None or throughput > self._last_throughput * (
+                1 + Config.AIMD_GROWTH_THRESHOLD
+            ):
+                if self.current_limit() < self.max_limit:
+                    self.limit = min(self.max_limit, self.limit + 1)
+                    self._note(
+                        "increase", f"吞吐量上升 {throughput / 1024 / 1024:.2f}MB/s"
+                    )
+                    self._cond.notify_all()
+            self._last_throughput = throughput
+            self._reset_window(now)
+
+    def on_congestion(self, reason):
+        """服务器过载（429/5xx/超时）时降低并发数"""
+        with self._cond:
+            now = time.time()
+            # 同一次拥塞中并发的多个失败只降低一次
+            if now - self._last_decrease < max(self.srtt or 0, 1.0):
+                return
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * Config.AIMD_DECREASE_FACTOR)
+            self._last_throughput = None
+            self._reset_window(now)
+            self._note("decrease", reason)
+            logger.warning(
+                f"并发控制[{self.name}]: {reason}，并发数降低到 {self.current_limit()}"
+            )
+
+    def get_timeout(self):
+        """根据观测到的延迟返回(连接超时, 读取超时)，样本不足时使用默认值"""
+        with self._cond:
+            if self.samples < Config.AIMD_MIN_LATENCY_SAMPLES:
+                return Config.DEFAULT_TIMEOUT
+            rto = self.srtt + 4 * self.rttvar
+        connect = min(
+            max(2 * rto, Config.MIN_CONNECT_TIMEOUT), Config.MAX_CONNECT_TIMEOUT
+        )
+        read = min(max(4 * rto, Config.MIN_READ_TIMEOUT), Config.MAX_READ_TIMEOUT)
+        return (round(connect, 2), round(read, 2))
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "limit": self.current_limit(),
+                "in_flight": self.in_flight,
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "latency": round(self.srtt, 3) if self.srtt is not None else None,
+                "throughput": (
+                    int(self._last_throughput) if self._last_throughput else None
+                ),
+                "reasons": list(self.reasons),
+            }
+
+    def _observe_latency(self, latency):
+        self.samples += 1
+        if self.srtt is None:
+            self.srtt = latency
+            self.rttvar = latency / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - latency)
+            self.srtt = 0.875 * self.srtt + 0.125 * latency
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_count = 0
+
+    def _note(self, action, reason):
+        self.reasons.append(
+            {
+                "time": time.strftime("%H:%M:%S"),
+                "action": action,
+                "limit": self.current_limit(),
+                "reason": reason,
+            }
+        )
+
+
+_origin_controllers = {}
+_origin_controllers_lock = threading.Lock()
+
+
+def origin_of(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_origin_controller(url):
+    """获取URL所属源站的并发控制器，所有任务共享"""
+    origin = origin_of(url)
+    with _origin_controllers_lock:
+        controller = _origin_controllers.get(origin)
+        if controller is None:
+            controller = AIMDController(
+                origin,
+                Config.AIMD_ORIGIN_INITIAL_CONCURRENCY,
+                max_limit=Config.AIMD_ORIGIN_MAX_CONCURRENCY,
+            )
+            _origin_controllers[origin] = controller
+        return controller
+
+
+def get_origin_stats():
+    with _origin_controllers_lock:
+        controllers = dict(_origin_controllers)
+    return {origin: c.snapshot() for origin, c in controllers.items()}
@@ -0,0 +1,155 @@
+import ipaddress
+import logging
+import socket
+import threading
+import time
+
+from config import Config
+
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:  # dnspython 为可选依赖，未安装时使用系统解析并按默认TTL缓存
+    dns = None
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    def __init__(self, addresses, ttl):
+        self.addresses = addresses  # [(地址族, IP)]
+        self.expires = time.monotonic() + ttl
+        self.next = 0
+
+
+class DNSCache:
+    """进程内DNS缓存，所有下载任务共享
+
+    安装了dnspython时按DNS记录的TTL缓存，否则使用系统解析（getaddrinfo）并按
+    DNS_CACHE_TTL缓存；TTL限制在DNS_CACHE_MIN_TTL到DNS_CACHE_MAX_TTL之间。
+    同一主机有多个地址时，新建连接轮流使用各个地址。
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._host_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def resolve(self, host):
+        """解析主机名，返回[(地址族, IP)]，解析失败时抛出异常"""
+        if _is_ip(host):
+            return [(_family(host), host)]
+        entry = self._get(host)
+        if entry is not None:
+            return entry.addresses
+        # 同一主机只解析一次，其它线程等待结果
+        with self._lock:
+            host_lock = self._host_locks.setdefault(host, threading.Lock())
+        with host_lock:
+            entry = self._get(host, count=False)
+            if entry is not None:
+                return entry.addresses
+            with self._lock:
+                self.misses += 1
+            try:
+                addresses, ttl = _lookup(host)
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                raise
+            ttl = min(max(ttl, Config.DNS_CACHE_MIN_TTL), Config.DNS_CACHE_MAX_TTL)
+            with self._lock:
+                self._entries[host] = _Entry(addresses, ttl)
+            logger.debug(f"DNS解析 {host}: {addresses}, TTL={ttl}")
+            return addresses
+
+    def pick(self, host):
+        """返回用于新建连接的IP地址，解析失败时返回原主机名（由系统解析报告错误）"""
+        if _is_ip(host):
+            return host
+        try:
+            addresses = self.resolve(host)
+        except Exception:
+            return host
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is None or not addresses:
+                return host
+            address = entry.addresses[entry.next % len(entry.addresses)][1]
+            entry.next += 1
+            return address
+
+    def _get(self, host, count=True):
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is None or entry.expires <= time.monotonic():
+                return None
+            if count:
+                self.hits += 1
+            return entry
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "failures": self.failures,
+                "entries": {
+                    host: {
+                        "addresses": [ip for _, ip in entry.addresses],
+                        "ttl": round(max(0, entry.expires - now), 1),
+                    }
+                    for host, entry in self._entries.items()
+                },
+            }
+
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host.strip("[]"))
+        return True
+    except ValueError:
+        return False
+
+
+def _family(ip):
+    return socket.AF_INET6 if ":" in ip else socket.AF_INET
+
+
+def _lookup(host):
+    """解析主机名，返回([(地址族, IP)], TTL)"""
+    if dns is not None:
+        try:
+            answer = dns.resolver.resolve(
+                host, "A", lifetime=Config.DNS_RESOLVE_TIMEOUT
+            )
+            addresses = [(socket.AF_INET, record.address) for record in answer]
+            if addresses:
+                return addresses, answer.rrset.ttl
+        except dns.exception.DNSException:
+            pass  # 如/etc/hosts中的主机名，交给系统解析
+    addresses = []
+    for family, _, _, _, sockaddr in socket.getaddrinfo(
+        host, None, type=socket.SOCK_STREAM
+    ):
+        address = (family, sockaddr[0])
+        if address not in addresses:
+            addresses.append(address)
+    return addresses, Config.DNS_CACHE_TTL
+
+
+_dns_cache = None
+_dns_cache_lock = threading.Lock()
+
+
+def get_dns_cache():
+    """获取进程内共享的DNS缓存"""
+    global _dns_cache
+    with _dns_cache_lock:
+        if _dns_cache is None:
+            _dns_cache = DNSCache()
+        return _dns_cache
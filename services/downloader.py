@@ -1,8 +1,505 @@
 from config import Config
 import requests
+from services.rate_limiter import get_rate_limiter
 from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+from services.dns_cache import get_dns_cache
+import logging
 import os
+import ssl
+import threading
 import time
+from urllib.parse import urlsplit
+
+try:
+    import httpx
+except ImportError:  # httpx[http2] 为可选依赖，未安装时只使用HTTP/1.1
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+
+class TransferStats:
+    """传输引擎计数器（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {
+            "requests": 0,  # 发出的请求数
+            "connections_opened": 0,  # 新建的TCP连接数
+            "connections_reused": 0,  # 复用keep-alive连接的请求数
+            "tls_handshakes": 0,  # 完整TLS握手次数
+            "tls_sessions_resumed": 0,  # 复用TLS会话的握手次数
+            "h2_connections_opened": 0,  # HTTP/2传输新建的TCP连接数
+            "h2_streams": 0,  # 通过HTTP/2多路复用发出的请求数
+            "h2_fallback_hosts": 0,  # 改用HTTP/1.1的主机数
+            "prewarmed_connections": 0,  # 预先建立的空闲连接数
+        }
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+_stats = TransferStats()
+
+
+class HTTPStatusError(Exception):
+    """HTTP状态码错误，保留状态码供重试及并发控制判断"""
+
+    def __init__(self, status_code, message=None, retry_after=None):
+        super().__init__(message or f"下载失败，状态码: {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after  # Retry-After要求等待的秒数
+
+
+class _SessionCachingSSLContext(ssl.SSLContext):
+    """为每个主机缓存TLS会话，新建连接时尝试会话复用，减少完整握手"""
+
+    def __new__(cls, *args, **kwargs):
+        context = super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+        context._sessions = {}
+        context._sessions_lock = threading.Lock()
+        return context
+
+    def wrap_socket(
+        self,
+        sock,
+        server_side=False,
+        do_handshake_on_connect=True,
+        suppress_ragged_eofs=True,
+        server_hostname=None,
+        session=None,
+    ):
+        if session is None and server_hostname:
+            with self._sessions_lock:
+                session = self._sessions.get(server_hostname)
+
+        ssl_sock = super().wrap_socket(
+            sock,
+            server_side=server_side,
+            do_handshake_on_connect=do_handshake_on_connect,
+            suppress_ragged_eofs=suppress_ragged_eofs,
+            server_hostname=server_hostname,
+            session=session,
+        )
+
+        if do_handshake_on_connect and server_hostname:
+            if ssl_sock.session_reused:
+                _stats.incr("tls_sessions_resumed")
+            else:
+                _stats.incr("tls_handshakes")
+            self.remember_session(ssl_sock)
+        return ssl_sock
+
+    def remember_session(self, ssl_sock):
+        """缓存连接的TLS会话（TLS 1.3的会话票据在握手之后才会收到）"""
+        session = getattr(ssl_sock, "session", None)
+        server_hostname = getattr(ssl_sock, "server_hostname", None)
+        if session is not None and server_hostname and session.has_ticket:
+            with self._sessions_lock:
+                self._sessions[server_hostname] = session
+
+
+class _CachedDNSMixin:
+    """新建连接时使用进程内DNS缓存解析的地址，Host头及TLS的SNI仍使用原主机名"""
+
+    def _new_conn(self):
+        host = self._dns_host
+        self._dns_host = get_dns_cache().pick(host)
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+
+class _CountingHTTPConnection(_CachedDNSMixin, HTTPConnection):
+    def connect(self):
+        _stats.incr("connections_opened")
+        super().connect()
+
+
+class _CountingHTTPSConnection(_CachedDNSMixin, HTTPSConnection):
+    def connect(self):
+        _stats.incr("connections_opened")
+        super().connect()
+
+
+# 当前线程取出连接时的回调（TransferEngine.request的on_connection参数）
+_connection_hooks = threading.local()
+
+
+class _CountingPoolMixin:
+    """统计每次取出连接时是否复用了已建立的keep-alive连接"""
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout=timeout)
+        if conn.sock is not None:
+            _stats.incr("connections_reused")
+        callback = getattr(_connection_hooks, "callback", None)
+        if callback is not None:
+            callback(conn)
+        return conn
+
+    def _put_conn(self, conn):
+        ssl_context = getattr(conn, "ssl_context", None)
+        if isinstance(ssl_context, _SessionCachingSSLContext):
+            if isinstance(conn.sock, ssl.SSLSocket):
+                ssl_context.remember_session(conn.sock)
+        super()._put_conn(conn)
+
+    def take_idle(self, count):
+        """不等待地取出连接池中的连接，使已建立的连接加上返回的未建立连接共count个
+
+        返回的连接建立后需用_put_conn放回；连接池中没有空闲位置时返回空列表。
+        """
+        taken = []
+        while len(taken) < count:
+            try:
+                taken.append(super()._get_conn(timeout=0))
+            except EmptyPoolError:
+                break
+        idle = [conn for conn in taken if conn.sock is None]
+        for conn in taken:
+            if conn.sock is not None:
+                super()._put_conn(conn)
+        return idle
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _TransferAdapter(HTTPAdapter):
+    """使用计数连接池和共享SSL上下文的适配器"""
+
+    def __init__(self, ssl_context, **kwargs):
+        self._ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self._ssl_context
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        """经由HTTP代理的连接同样使用计数连接池和共享SSL上下文（SOCKS代理使用其自带的连接池）"""
+        if proxy not in self.proxy_manager:
+            proxy_kwargs["ssl_context"] = self._ssl_context
+            manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+            if not proxy.lower().startswith("socks"):
+                manager.pool_classes_by_scheme = {
+                    "http": _CountingHTTPConnectionPool,
+                    "https": _CountingHTTPSConnectionPool,
+                }
+            return manager
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+
+class _HTTP2Response:
+    """httpx响应的包装，提供下载器用到的requests.Response接口"""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.http_version = response.http_version
+        self.url = str(response.url)
+
+    @property
+    def content(self):
+        return self._response.read()
+
+    @property
+    def text(self):
+        self._response.read()
+        return self._response.text
+
+    def iter_content(self, chunk_size=1):
+        return self._response.iter_bytes(chunk_size)
+
+    def close(self):
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _HTTP2Transport:
+    """基于httpx的HTTP/2传输，同一主机的并发请求复用少量连接（多路复用）
+
+    只用于https地址（通过ALPN协商HTTP/2）；服务器不支持HTTP/2或协议出错的主机
+    之后改用requests的HTTP/1.1连接池。
+    """
+
+    def __init__(self, stats, headers):
+        self.stats = stats
+        self.client = httpx.Client(
+            http2=True,
+            verify=False,
+            headers=headers,
+            limits=httpx.Limits(
+                max_connections=Config.HTTP2_MAX_CONNECTIONS,
+                max_keepalive_connections=Config.HTTP2_MAX_CONNECTIONS,
+            ),
+        )
+        self._http1_hosts = set()
+
+    def supports(self, url):
+        if not url.startswith("https://"):
+            return False
+        return url.split("/", 3)[2] not in self._http1_hosts
+
+    def request(self, method, url, stream=False, timeout=None, headers=None, **kwargs):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            timeout = httpx.Timeout(read, connect=connect)
+        request = self.client.build_request(
+            method,
+            url,
+            headers=headers,
+            timeout=timeout,
+            extensions={"trace": self._trace},
+        )
+        try:
+            response = self.client.send(
+                request,
+                stream=True,
+                follow_redirects=kwargs.get("allow_redirects", method == "GET"),
+            )
+        except httpx.RemoteProtocolError:
+            self._fallback(url, "协议错误")
+            raise
+        if response.http_version != "HTTP/2":
+            self._fallback(url, f"服务器使用 {response.http_version}")
+        wrapped = _HTTP2Response(response)
+        if not stream:
+            try:
+                wrapped.content
+            finally:
+                wrapped.close()
+        return wrapped
+
+    def _fallback(self, url, reason):
+        host = url.split("/", 3)[2]
+        if host not in self._http1_hosts:
+            self._http1_hosts.add(host)
+            self.stats.incr("h2_fallback_hosts")
+            logger.info(f"主机 {host} 改用HTTP/1.1: {reason}")
+
+    def _trace(self, event, info):
+        if event == "connection.connect_tcp.complete":
+            self.stats.incr("h2_connections_opened")
+        elif event == "connection.start_tls.complete":
+            self.stats.incr("tls_handshakes")
+        elif event == "http2.send_request_headers.started":
+            self.stats.incr("h2_streams")
+
+    def get_stats(self):
+        """当前打开的连接数（按主机），读取失败时返回None"""
+        try:
+            connections = self.client._transport._pool.connections
+        except AttributeError:
+            return None
+        hosts = {}
+        for connection in connections:
+            origin = connection._origin
+            host = f"{origin.scheme.decode()}://{origin.host.decode()}:{origin.port}"
+            hosts[host] = hosts.get(host, 0) + 1
+        return hosts
+
+
+class TransferEngine:
+    """进程内共享的HTTP传输引擎，所有下载任务复用同一组按主机划分的连接池"""
+
+    def __init__(self):
+        self.stats = _stats
+        self.ssl_context = _SessionCachingSSLContext()
+        # 与原下载器一致，不校验SSL证书
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+        self.session = requests.Session()
+        self.adapter = _TransferAdapter(
+            self.ssl_context,
+            pool_connections=Config.HTTP_POOL_HOSTS,
+            pool_maxsize=Config.HTTP_POOL_MAXSIZE_PER_HOST,
+            pool_block=True,  # 单主机连接数达到上限时等待空闲连接
+            # 不在连接池内重试，重试统一由services.retry_policy处理
+            max_retries=0,
+        )
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+        # 设置请求头
+        self.session.headers.update(
+            {
+                "User-Agent": Config.DEFAULT_HEADERS["User-Agent"],
+                "Connection": "keep-alive",
+                "Accept": "*/*",
+            }
+        )
+        self.session.verify = False
+        self._http2 = None
+        self._http2_lock = threading.Lock()
+        self._prewarm_pool = ThreadPoolExecutor(
+            max_workers=Config.PREWARM_WORKERS, thread_name_prefix="prewarm"
+        )
+
+    def _http2_transport(self):
+        """配置为HTTP/2时返回HTTP/2传输，httpx或h2未安装时返回None"""
+        if Config.HTTP_TRANSPORT != "http2" or httpx is None:
+            return None
+        with self._http2_lock:
+            if self._http2 is None:
+                try:
+                    self._http2 = _HTTP2Transport(
+                        self.stats, dict(self.session.headers)
+                    )
+                except ImportError:
+                    # httpx已安装但缺少h2
+                    logger.warning("未安装h2，HTTP/2不可用，使用HTTP/1.1")
+                    self._http2 = False
+            return self._http2 or None
+
+    def request(self, method, url, on_connection=None, proxy=None, **kwargs):
+        """发送请求；on_connection(conn)在取出连接时调用，可用于从其它线程中断请求
+
+        配置为HTTP/2时https请求经由HTTP/2传输发送，多路复用的连接不会被中断，
+        因此不调用on_connection。指定proxy（代理地址）时经由该代理以HTTP/1.1发送。
+        """
+        kwargs.setdefault("timeout", (5, 30))
+        # 显式传入verify，避免REQUESTS_CA_BUNDLE等环境变量覆盖会话设置
+        kwargs.setdefault("verify", self.session.verify)
+        self.stats.incr("requests")
+        if proxy:
+            kwargs["proxies"] = {"http": proxy, "https": proxy}
+        http2 = self._http2_transport()
+        if http2 and not proxy and http2.supports(url):
+            return http2.request(method, url, **kwargs)
+        if on_connection is None:
+            return self.session.request(method, url, **kwargs)
+        _connection_hooks.callback = on_connection
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            _connection_hooks.callback = None
+
+    def prewarm(self, urls, count):
+        """在后台预先解析urls中各主机的DNS，并为每个主机建立最多count个空闲连接
+
+        立即返回；预热失败不影响之后的正常请求。经由HTTP/2传输的主机只预先解析DNS。
+        """
+        if not Config.PREWARM_CONNECTIONS:
+            return
+        http2 = self._http2_transport()
+        for url in urls:
+            if http2 and http2.supports(url):
+                self._prewarm_pool.submit(self._resolve, url)
+            else:
+                self._prewarm_pool.submit(self._prewarm_host, url, count)
+
+    def _resolve(self, url):
+        host = urlsplit(url).hostname
+        try:
+            get_dns_cache().resolve(host)
+            return True
+        except Exception as e:
+            logger.debug(f"预解析 {host} 失败: {str(e)}")
+            return False
+
+    def _prewarm_host(self, url, count):
+        if not self._resolve(url):
+            return
+        try:
+            prepared = requests.Request("GET", url).prepare()
+            proxies = self.session.merge_environment_settings(
+                url, {}, None, self.session.verify, None
+            )["proxies"]
+            pool = self.adapter.get_connection_with_tls_context(
+                prepared, self.session.verify, proxies=proxies
+            )
+        except Exception as e:
+            logger.debug(f"获取 {url} 的连接池失败: {str(e)}")
+            return
+        if not isinstance(pool, _CountingPoolMixin):
+            return
+        for conn in pool.take_idle(count):
+            self._prewarm_pool.submit(self._prewarm_conn, pool, conn)
+
+    def _prewarm_conn(self, pool, conn):
+        try:
+            conn.timeout = Config.PREWARM_CONNECT_TIMEOUT
+            conn.connect()
+            self.stats.incr("prewarmed_connections")
+        except Exception as e:
+            logger.debug(f"预建连接 {pool.host} 失败: {str(e)}")
+            conn.close()
+        finally:
+            pool._put_conn(conn)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def get_stats(self):
+        """获取传输统计信息，包括每个主机连接池的状态"""
+        stats = self.stats.snapshot()
+        pools = {}
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            host = f"{key.key_scheme}://{key.key_host}:{key.key_port}"
+            pools[host] = {
+                "connections": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle": pool.pool.qsize() if pool.pool else 0,
+                "maxsize": pool.pool.maxsize if pool.pool else 0,
+            }
+        stats["pools"] = pools
+        stats["pool_maxsize_per_host"] = Config.HTTP_POOL_MAXSIZE_PER_HOST
+        stats["transport"] = Config.HTTP_TRANSPORT
+        stats["dns"] = get_dns_cache().get_stats()
+        http2 = self._http2_transport()
+        if http2:
+            stats["h2_pools"] = http2.get_stats()
+        return stats
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_transfer_engine():
+    """获取进程内共享的传输引擎"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = TransferEngine()
+            logger.info(
+                f"传输引擎已创建: 单主机连接数上限={Config.HTTP_POOL_MAXSIZE_PER_HOST}"
+            )
+        return _engine
 
 
 class Downloader:
@@ -11,33 +508,17 @@ class Downloader:
             max_workers=Config.get_max_concurrent_downloads()
         )
         self._active_downloads = 0
-        self._speed_limit = (
-            Config.get_download_speed_limit() * 1024 * 1024
-        )  # 转换为字节/秒
+        self._engine = get_transfer_engine()
 
     def download_segment(self, url, save_path):
         verify = Config.get_ssl_verify()
-
-        # 应用下载速度限制
-        if self._speed_limit > 0:
-            response = requests.get(url, verify=verify, stream=True)
-            chunk_size = min(8192, self._speed_limit)  # 每次读取的块大小
-            start_time = time.time()
-            downloaded = 0
-
+        # 从共享令牌桶中取带宽，限速值修改后立即生效
+        rate_limiter = get_rate_limiter()
+        with self._engine.get(url, verify=verify, stream=True) as response:
             with open(save_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=chunk_size):
+                for chunk in response.iter_content(chunk_size=Config.CHUNK_SIZE):
                     if chunk:
+                        delay = rate_limiter.reserve(None, len(chunk))
+                        if delay > 0:
+                            time.sleep(delay)
                         f.write(chunk)
-                        downloaded += len(chunk)
-
-                        # 计算需要的延迟来达到速度限制
-                        elapsed = time.time() - start_time
-                        expected_time = downloaded / self._speed_limit
-                        if expected_time > elapsed:
-                            time.sleep(expected_time - elapsed)
-        else:
-            # 无速度限制的下载
-            response = requests.get(url, verify=verify)
-            with open(save_path, "wb") as f:
-                f.write(response.content)
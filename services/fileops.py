@@ -0,0 +1,148 @@
+import errno
+import logging
+import os
+import threading
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 单次系统调用最多复制的字节数，避免32位平台上的溢出
+_MAX_CHUNK = 1 << 30
+# 表示当前文件系统或内核不支持该复制方式的错误，此时换用下一种方式
+_UNSUPPORTED = {
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+    errno.ENOTSOCK,
+    errno.ETXTBSY,
+}
+
+_lock = threading.Lock()
+_disabled = set()  # 内核不支持（ENOSYS）的复制方式，之后不再尝试
+_stats = {}
+
+
+def _copy_file_range(src_fd, src_offset, dst_fd, dst_offset, count):
+    """内核内复制，支持的文件系统（如XFS/Btrfs/NFS4.2）上可以共享数据块或在服务端复制"""
+    copied = 0
+    while copied < count:
+        n = os.copy_file_range(
+            src_fd,
+            dst_fd,
+            min(count - copied, _MAX_CHUNK),
+            src_offset + copied,
+            dst_offset + copied,
+        )
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _sendfile(src_fd, src_offset, dst_fd, dst_offset, count):
+    """内核内复制，数据不经过用户空间；写入位置为输出文件的当前位置"""
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    copied = 0
+    while copied < count:
+        n = os.sendfile(
+            dst_fd, src_fd, src_offset + copied, min(count - copied, _MAX_CHUNK)
+        )
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _copy_chunks(src_fd, src_offset, dst_fd, dst_offset, count):
+    """按PIPELINE_CHUNK_SIZE分块读写，所有平台都支持"""
+    copied = 0
+    while copied < count:
+        data = os.pread(
+            src_fd,
+            min(count - copied, Config.PIPELINE_CHUNK_SIZE),
+            src_offset + copied,
+        )
+        if not data:
+            break
+        copied += os.pwrite(dst_fd, data, dst_offset + copied)
+    return copied
+
+
+COPY_METHODS = {"copy_file_range": _copy_file_range, "sendfile": _sendfile}
+if not hasattr(os, "copy_file_range"):  # 仅Linux上的Python 3.8+提供
+    del COPY_METHODS["copy_file_range"]
+if not hasattr(os, "sendfile"):
+    del COPY_METHODS["sendfile"]
+COPY_METHODS["chunked"] = _copy_chunks
+
+
+def append_file(src_path, dst, methods=None):
+    """把src_path的内容追加到dst（以二进制写模式打开的文件）的当前位置，返回复制的字节数"""
+    with open(src_path, "rb") as src:
+        count = os.fstat(src.fileno()).st_size
+        return append_range(src.fileno(), 0, count, dst, methods)
+
+
+def append_range(src_fd, offset, count, dst, methods=None):
+    """把src_fd中从offset开始的count字节追加到dst的当前位置，返回复制的字节数
+
+    依次尝试copy_file_range、sendfile，数据在内核中复制，不经过Python；
+    都不支持时按块读写。dst不能定位（如管道）时按块写入。
+    methods可以限定使用的复制方式（用于基准测试）。
+    """
+    dst.flush()
+    if not dst.seekable():
+        copied = 0
+        while copied < count:
+            data = os.pread(
+                src_fd, min(count - copied, Config.PIPELINE_CHUNK_SIZE), offset + copied
+            )
+            if not data:
+                break
+            dst.write(data)
+            copied += len(data)
+        _count("stream", copied)
+        return copied
+
+    dst_offset = dst.tell()
+    copied = copy_range(src_fd, offset, dst.fileno(), dst_offset, count, methods)
+    # 同步文件对象的位置，之后的写入接在复制的数据后面
+    dst.seek(dst_offset + copied)
+    return copied
+
+
+def copy_range(src_fd, src_offset, dst_fd, dst_offset, count, methods=None):
+    """把src_fd中从src_offset开始的count字节复制到dst_fd的dst_offset处，返回复制的字节数"""
+    for name in methods or COPY_METHODS:
+        if name in _disabled:
+            continue
+        try:
+            copied = COPY_METHODS[name](src_fd, src_offset, dst_fd, dst_offset, count)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            if e.errno == errno.ENOSYS:
+                with _lock:
+                    _disabled.add(name)
+            logger.debug(f"{name} 不可用，换用其它复制方式: {str(e)}")
+            continue
+        _count(name, copied)
+        return copied
+    raise Exception("没有可用的文件复制方式")
+
+
+def _count(name, size):
+    with _lock:
+        stats = _stats.setdefault(name, {"copies": 0, "bytes": 0})
+        stats["copies"] += 1
+        stats["bytes"] += size
+
+
+def get_copy_stats():
+    """各复制方式的复制次数和字节数"""
+    with _lock:
+        return {name: dict(stats) for name, stats in _stats.items()}
@@ -0,0 +1,152 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+from config import Config
+from services.segment_jobs import JobSplitter
+
+logger = logging.getLogger(__name__)
+
+
+class HedgeLost(Exception):
+    """对冲请求已先完成，主请求放弃"""
+
+
+def interrupt_connection(conn):
+    """中断其它线程中正在使用的连接（关闭底层socket），等待响应或读取数据的请求会立即出错"""
+    sock = getattr(conn, "sock", None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class HedgeRace:
+    """同一分片任务的主请求与对冲请求，先完整收到数据的一方获胜"""
+
+    def __init__(self, job):
+        self.job = job
+        self.host = urlsplit(job.url).netloc
+        self.started = None  # 主请求开始时间
+        self.mirror = None  # 主请求当前使用的镜像
+        self.hedged = False
+        self.hedge_future = None
+        self.winner = None
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def begin(self):
+        if self.started is None:
+            self.started = time.monotonic()
+
+    def attach(self, side, conn):
+        """登记请求使用的连接，对方获胜时用于中断"""
+        with self._lock:
+            self._connections[side] = conn
+            lost = self.winner is not None and self.winner != side
+        if lost:
+            interrupt_connection(conn)
+
+    def detach(self, side):
+        """请求结束，连接归还连接池后不能再被中断"""
+        with self._lock:
+            self._connections.pop(side, None)
+
+    def lost(self, side):
+        return self.winner is not None and self.winner != side
+
+    def claim(self, side):
+        """数据接收完整后尝试获胜，成功时中断另一方的请求"""
+        with self._lock:
+            if self.winner is not None:
+                return self.winner == side
+            self.winner = side
+            others = [c for s, c in self._connections.items() if s != side]
+        for conn in others:
+            interrupt_connection(conn)
+        return True
+
+
+class HedgeTracker:
+    """任务级对冲统计：按主机记录分片下载耗时，超过该主机pN耗时的请求发出对冲请求"""
+
+    def __init__(self):
+        self.hedged = 0  # 发出的对冲请求数
+        self.wins = 0  # 对冲请求先完成的次数
+        self.failed = 0  # 对冲请求失败或被取消的次数
+        self.completed = 0
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    def observe(self, host, duration):
+        with self._lock:
+            self.completed += 1
+            samples = self._durations.get(host)
+            if samples is None:
+                samples = self._durations[host] = deque(maxlen=Config.HEDGE_WINDOW)
+            samples.append(duration)
+
+    def threshold(self, host):
+        """返回该主机的对冲等待时间，样本不足时返回None"""
+        with self._lock:
+            samples = self._durations.get(host)
+            if not samples or len(samples) < Config.HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * Config.HEDGE_PERCENTILE / 100))
+        return max(ordered[index], Config.HEDGE_MIN_DELAY)
+
+    def try_hedge(self):
+        """对冲请求数不超过已完成请求数的HEDGE_MAX_RATIO"""
+        with self._lock:
+            if self.hedged >= max(1, self.completed * Config.HEDGE_MAX_RATIO):
+                return False
+            self.hedged += 1
+            return True
+
+    def record_result(self, won):
+        with self._lock:
+            if won:
+                self.wins += 1
+            else:
+                self.failed += 1
+
+    def snapshot(self):
+        with self._lock:
+            hosts = list(self._durations)
+            info = {
+                "hedged": self.hedged,
+                "wins": self.wins,
+                "failed": self.failed,
+                "hedge_rate": (
+                    round(self.hedged / self.completed, 3) if self.completed else 0
+                ),
+            }
+        info["thresholds"] = {host: self.threshold(host) for host in hosts}
+        return info
+
+
+def hedge_file(task_dir, job):
+    """对冲请求的私有临时文件，获胜后再写入分片输出"""
+    return os.path.join(task_dir, f"hedge_{job.parts[0].index}.part")
+
+
+def replay_hedge(job, open_sink, path, skip):
+    """把对冲请求收到的数据写入分片输出，返回[(分片序号, 分片大小)]"""
+    splitter = JobSplitter(job, open_sink, skip)
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(Config.PIPELINE_CHUNK_SIZE), b""):
+                splitter.feed(chunk)
+        return splitter.close()
+    except Exception:
+        splitter.abort()
+        raise
+    finally:
+        os.remove(path)
@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value):
+    """解析Retry-After响应头（秒数或HTTP日期），返回需要等待的秒数"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        seconds = int(value)
+    else:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+    return min(max(seconds, 0), Config.MAX_RETRY_AFTER)
+
+
+class HostScheduler:
+    """单个主机的请求调度，所有任务共享
+
+    - 同时进行的请求数不超过max_in_flight
+    - 按rps均匀安排请求的发出时间，不会突发
+    - 收到Retry-After后，在指定时间之前暂停向该主机发请求
+    """
+
+    def __init__(self, host, rps=0, max_in_flight=0):
+        self.host = host
+        self.rps = rps
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.requests = 0
+        self.waited = 0.0
+        self._next_slot = 0.0
+        self._blocked_until = 0.0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        """请求数未达到上限时占用一个名额"""
+        with self._cond:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self, cancel_event=None):
+        """等待名额及发送时间，返回后可以立即发出请求"""
+        with self._cond:
+            while self.max_in_flight and self.in_flight >= self.max_in_flight:
+                if cancel_event and cancel_event.is_set():
+                    raise Exception("下载已取消")
+                self._cond.wait(0.1)
+            self.in_flight += 1
+        try:
+            delay = self.reserve()
+            while delay > 0:
+                if cancel_event and cancel_event.is_set():
+                    raise Exception("下载已取消")
+                time.sleep(min(delay, 0.1))
+                delay -= 0.1
+        except Exception:
+            self.release()
+            raise
+
+    def reserve(self):
+        """预约下一个发送时间，返回需要等待的秒数"""
+        with self._cond:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._blocked_until)
+            if self.rps:
+                self._next_slot = slot + 1.0 / self.rps
+            self.requests += 1
+            self.waited += slot - now
+            return slot - now
+
+    def try_reserve(self):
+        """不等待名额及Retry-After的预约（用于对冲请求）
+
+        主机暂停请求或请求数已满时返回None，否则占用名额并返回距发送时间需要等待的秒数。
+        """
+        with self._cond:
+            if self._blocked_until > time.monotonic():
+                return None
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return None
+            self.in_flight += 1
+            return self.reserve()
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def block(self, seconds, reason=""):
+        """在seconds秒内暂停向该主机发请求（Retry-After）"""
+        with self._cond:
+            until = time.monotonic() + seconds
+            if until > self._blocked_until:
+                self._blocked_until = until
+                logger.warning(f"主机 {self.host} 暂停请求 {seconds:.1f} 秒 {reason}")
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "rps": self.rps,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "waited": round(self.waited, 3),
+                "blocked_for": round(max(0, self._blocked_until - time.monotonic()), 3),
+            }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_host_scheduler(url):
+    """获取URL所属主机的调度器，限制来自Config.HOST_LIMITS或默认配置"""
+    host = urlsplit(url).netloc
+    with _schedulers_lock:
+        scheduler = _schedulers.get(host)
+        if scheduler is None:
+            limits = Config.HOST_LIMITS.get(host) or Config.HOST_LIMITS.get(
+                host.split(":")[0], {}
+            )
+            scheduler = HostScheduler(
+                host,
+                rps=limits.get("rps", Config.HOST_MAX_RPS),
+                max_in_flight=limits.get("max_in_flight", Config.HOST_MAX_IN_FLIGHT),
+            )
+            _schedulers[host] = scheduler
+        return scheduler
+
+
+def get_host_stats():
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    return {host: s.snapshot() for host, s in schedulers.items()}
@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class KeyCache:
+    """按密钥URI缓存解密密钥（LRU + TTL），所有任务共享
+
+    同一URI同时只会有一个请求，其余调用等待该请求的结果，
+    避免多个任务同时向密钥服务器请求同一个密钥。
+    """
+
+    def __init__(self, max_entries=256, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # uri -> (key, expires_at)
+        self._inflight = {}  # uri -> Future
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uri, fetch):
+        """获取密钥，未命中时调用fetch(uri)获取"""
+        with self._lock:
+            entry = self._entries.get(uri)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(uri)
+                self.hits += 1
+                return entry[0]
+
+            future = self._inflight.get(uri)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = Future()
+                self._inflight[uri] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            key = fetch(uri)
+            with self._lock:
+                self._entries[uri] = (key, time.time() + self.ttl)
+                self._entries.move_to_end(uri)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            future.set_result(key)
+            return key
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(uri, None)
+
+    def invalidate(self, uri):
+        with self._lock:
+            self._entries.pop(uri, None)
+
+    def get_stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0,
+            }
+
+
+_key_cache = None
+_key_cache_lock = threading.Lock()
+
+
+def get_key_cache():
+    """获取进程内共享的密钥缓存"""
+    global _key_cache
+    with _key_cache_lock:
+        if _key_cache is None:
+            _key_cache = KeyCache(Config.KEY_CACHE_MAX_ENTRIES, Config.KEY_CACHE_TTL)
+        return _key_cache
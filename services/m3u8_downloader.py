@@ -1,91 +1,660 @@
-import m3u8
-import requests
+from collections import deque
+import io
 import os
 import logging
 import subprocess
-from Crypto.Cipher import AES
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 import time
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import Config
+from services.compact_playlist import (
+    SEGMENT_DONE,
+    SEGMENT_FAILED,
+    SEGMENT_VERIFIED,
+    SegmentStates,
+    parse_playlist,
+)
+from services.concurrency_controller import (
+    AIMDController,
+    congestion_reason,
+    get_origin_controller,
+)
+from services.downloader import HTTPStatusError, get_transfer_engine
+from services.hedging import (
+    HedgeLost,
+    HedgeRace,
+    HedgeTracker,
+    hedge_file,
+    replay_hedge,
+)
+from services.host_scheduler import get_host_scheduler, parse_retry_after
+from services.key_cache import get_key_cache
+from services.mirrors import MirrorSet
+from services.proxy_pool import get_proxy_pool, is_proxy_error
+from services.segment_crypto import parse_iv, segment_iv, unpad
+from services.rate_limiter import MB, RateShare, get_rate_limiter
+from services.playlist import VariantSelector, describe_variants, read_probe
+from services.resume_journal import ResumeJournal, playlist_fingerprint
+from services.retry_policy import (
+    CircuitOpenError,
+    RetryBudget,
+    backoff_delay,
+    call_with_retry,
+    get_circuit_breaker,
+    is_retryable,
+)
+from services.segment_jobs import (
+    JobSplitter,
+    SegmentJob,
+    build_segment_jobs,
+    build_single_job,
+)
+from services.segment_validator import (
+    TS_SYNC_BYTE,
+    check_content_length,
+    get_validation_pool,
+    validate_segment,
+)
+from services.segment_cache import get_segment_cache, segment_cache_keys
+from services.segment_pack import SegmentPack
+from services.segment_pipeline import (
+    DirectSegmentSink,
+    StageMetrics,
+    get_segment_pipeline,
+)
+from services.stream_merger import FFmpegPipeMerger, StreamMerger
 
 logger = logging.getLogger(__name__)
 
 
+def create_downloader(url, output_path, key_info=None, **options):
+    """按照配置的下载引擎创建下载器"""
+    if Config.DOWNLOAD_ENGINE == "asyncio":
+        from services.async_m3u8_downloader import AsyncM3U8Downloader, aiohttp
+
+        if aiohttp is not None:
+            return AsyncM3U8Downloader(url, output_path, key_info, **options)
+        logger.warning("未安装aiohttp，回退到线程下载引擎")
+    return M3U8Downloader(url, output_path, key_info, **options)
+
+
 class M3U8Downloader:
-    def __init__(self, url, output_path, key_info=None):
+    def __init__(
+        self,
+        url,
+        output_path,
+        key_info=None,
+        concurrency=None,
+        variant_policy=None,
+        max_height=None,
+        adaptive=None,
+        speed_limit=None,
+        weight=None,
+        hedge=None,
+        mirrors=None,
+    ):
         logger.info(f"初始化M3U8下载器: url={url}")
         self.m3u8_url = url
         self.output_path = output_path
         self.key_info = key_info
+        # 同时下载的分片数
+        self.concurrency = max(1, int(concurrency or Config.SEGMENT_CONCURRENCY))
+        # 自适应并发：以concurrency为初始值，按吞吐量和服务器响应调整（任务级及源站级）
+        self.adaptive = Config.ADAPTIVE_CONCURRENCY if adaptive is None else adaptive
+        if self.adaptive:
+            self._controller = AIMDController("task", self.concurrency)
+        else:
+            self._controller = AIMDController(
+                "task",
+                self.concurrency,
+                min_limit=self.concurrency,
+                max_limit=self.concurrency,
+            )
+        self._origins = {}
+        # 镜像：等价的基础地址或替换主机，请求分散到所有健康的镜像上
+        self._mirrors = MirrorSet(url, mirrors)
+        # 对冲请求：耗时超过该主机pN耗时的分片再发一个请求，先完成的一方获胜
+        self.hedge = Config.HEDGE_REQUESTS if hedge is None else hedge
+        self._hedges = HedgeTracker()
+        # 统一重试策略：任务级重试预算及相关主机的熔断器
+        self._retry_budget = RetryBudget()
+        self._breakers = {}
+        # 代理池：所有任务共享，没有配置代理时直接连接
+        self._proxies = get_proxy_pool()
+        # 带宽限制：speed_limit为任务的速度上限（MB/s），weight为全局限速下的权重
+        self._rate_limiter = get_rate_limiter()
+        self.rate_share = RateShare(weight, int(float(speed_limit or 0) * MB))
+        # 主播放列表的码率选择
+        self.variant_policy = variant_policy
+        self.max_height = int(max_height) if max_height else None
+        self.variants = []
+        self.selected_variant = None
         self.progress = 0
         self.total_segments = 0
         self.downloaded_segments = 0
         self.total_size = 0
         self.segment_sizes = []
         self.failed_segments = []
+        self.download_speed = 0
+        self._bytes_since_last_update = 0
+        self._last_progress_update = time.time()
+
+        # 使用进程内共享的传输引擎（连接池、keep-alive及TLS会话在任务间复用）
+        self.engine = get_transfer_engine()
+        self.session = self.engine.session
+        # 分片流水线（下载 -> 解密 -> 写盘），进程内共享，在download_segment期间引用
+        self._pipeline = None
+        self._last_pipeline_stats = None
+        # 流式合并器（MERGE_MODE为stream时在规划下载任务时创建）
+        self._merger = None
+        self._merge_stats = None
+        self._fetch_metrics = StageMetrics("fetch", self._controller.max_limit)
+
+        # 断点续传日志
+        self._journal = None
+        self._segments = []
+        self._segment_urls = []
+        self._states = None  # 分片状态位图，在规划下载任务时创建
+        self._pack = None  # 分片包，在规划下载任务时创建
+        # 共享分片缓存：每个分片的缓存键及本任务从缓存导入的分片
+        self._cache = get_segment_cache()
+        self._cache_keys = None
+        self._cache_loaded = set()
+        self._cache_stores = deque()  # 后台保存到缓存的分片（Future），按提交顺序完成
+
+        # 分片校验：校验中的分片及每个分片的校验失败次数
+        self._validating = {}
+        self._validation_failures = {}
 
-        # 配置请求会话
-        self.session = requests.Session()
-
-        # 配置重试策略
-        retry_strategy = Retry(
-            total=5,  # 最大重试次数
-            backoff_factor=0.5,  # 重试间隔
-            status_forcelist=[500, 502, 503, 504, 429],  # 需要重试的HTTP状态码
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.session.mount("http://", adapter)
-        self.session.mount("https://", adapter)
-
-        # 设置请求头
-        self.session.headers.update(
-            {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                "Connection": "keep-alive",
-                "Accept": "*/*",
-            }
+    def _download_segment_with_retry(
+        self,
+        segment_url,
+        target,
+        key=None,
+        iv=None,
+        max_retries=None,
+        cancel_event=None,
+    ):
+        """下载单个分片到target（分片包中的分片），带重试机制"""
+        job = SegmentJob(segment_url)
+        job.add_part(0)
+        results = self._download_job_with_retry(
+            job,
+            lambda part: self._open_sink(target, key, iv),
+            max_retries=max_retries,
+            cancel_event=cancel_event,
         )
+        return results[0][1]
 
-        # 禁用SSL验证
-        self.session.verify = False
-
-    def _download_segment_with_retry(
-        self, segment_url, output_file, key=None, iv=None, max_retries=3
+    def _download_job_with_retry(
+        self, job, open_sink, max_retries=None, cancel_event=None, race=None
     ):
-        """下载单个分片，带重试机制"""
-        retries = 0
-        while retries < max_retries:
+        """下载一个分片任务（完整分片或合并后的字节范围），带重试机制
+
+        下载线程只负责网络读取，解密和写盘交给分片流水线的后续阶段。
+        race不为None时可能同时存在对冲请求，先收到完整数据的一方获胜。
+        返回[(分片序号, 分片大小)]。
+        """
+        if job.cached:
+            results = self._load_cached(job)
+            if results is not None:
+                return results
+        max_retries = max_retries or Config.RETRY_MAX_ATTEMPTS
+        attempt = 0
+        tried = set()  # 本任务失败过的镜像，重试时优先换用其它镜像
+        tried_proxies = set()
+        while True:
+            if cancel_event and cancel_event.is_set():
+                raise Exception("下载已取消")
+            mirror, url, breaker = self._select_mirror(job.url, tried)
+            origin = self._origin_controller(url)
+            host = get_host_scheduler(url)
+            if race:
+                race.mirror = mirror
+            delay = 0
+            proxy = None
+            started = self._fetch_metrics.begin()
+            downloaded_size = 0
+            acquired = False
+            host_acquired = False
             try:
-                response = self.session.get(segment_url, stream=True, timeout=(5, 30))
-                if response.status_code != 200:
-                    raise Exception(f"下载失败，状态码: {response.status_code}")
-
-                # 解密并保存分片
-                with open(output_file, "wb") as f:
-                    if key:
-                        cipher = AES.new(key, AES.MODE_CBC, iv)
-                        content = response.content
-                        decrypted_content = cipher.decrypt(content)
-                        f.write(self._unpad(decrypted_content))
-                        return len(content)
-                    else:
-                        chunk_size = 8192
-                        downloaded_size = 0
-                        for chunk in response.iter_content(chunk_size=chunk_size):
+                # 主机调度器控制请求数及发送节奏，所有任务共享；
+                # 先等待主机（Retry-After可能很长）再占用源站名额，等待时不占用源站并发
+                host.acquire(cancel_event)
+                host_acquired = True
+                if origin:
+                    origin.acquire(cancel_event)
+                    acquired = True
+                proxy = self._proxies.acquire(exclude=tried_proxies)
+                self._retry_budget.on_request()
+                headers = {}
+                if job.start is not None:
+                    headers["Range"] = job.range_header()
+                if race:
+                    race.begin()
+                request_started = time.time()
+                with self.engine.get(
+                    url,
+                    stream=True,
+                    timeout=self._controller.get_timeout(),
+                    headers=headers,
+                    proxy=proxy.url if proxy else None,
+                    on_connection=(
+                        (lambda conn: race.attach("primary", conn)) if race else None
+                    ),
+                ) as response:
+                    latency = time.time() - request_started
+                    splitter = JobSplitter(
+                        job,
+                        open_sink,
+                        self._range_skip(job, response.status_code, response.headers),
+                    )
+                    # 服务器忽略Range返回完整资源时，任务范围内的数据收齐后即停止读取并关闭连接
+                    overrun = job.start is not None and response.status_code == 200
+                    try:
+                        for chunk in response.iter_content(
+                            chunk_size=Config.CHUNK_SIZE
+                        ):
+                            if cancel_event and cancel_event.is_set():
+                                raise Exception("下载已取消")
+                            if race and race.lost("primary"):
+                                raise HedgeLost()
                             if chunk:
-                                f.write(chunk)
                                 downloaded_size += len(chunk)
-                        return downloaded_size
+                                self._throttle(len(chunk))
+                                if splitter.feed(chunk) and overrun:
+                                    break
+                        else:
+                            check_content_length(response.headers, downloaded_size)
+                        if race and not race.claim("primary"):
+                            raise HedgeLost()
+                        results = splitter.close()
+                    except Exception:
+                        splitter.abort()
+                        raise
+                self._report_success(origin, latency, downloaded_size)
+                breaker.record(None)
+                self._mirrors.record_success(
+                    mirror, downloaded_size, time.time() - request_started
+                )
+                self._proxies.record_success(
+                    proxy, downloaded_size, time.time() - request_started
+                )
+                if race:
+                    self._finish_race(race, won=True)
+                return results
 
             except Exception as e:
-                retries += 1
-                logger.warning(
-                    f"下载分片失败 (尝试 {retries}/{max_retries}): {segment_url}, error={str(e)}"
+                if race:
+                    race.detach("primary")
+                if cancel_event and cancel_event.is_set():
+                    raise
+                if race and race.hedge_future is not None:
+                    # 主请求失败或输给对冲请求时，改用对冲请求的数据
+                    results = self._finish_race(race, won=False, open_sink=open_sink)
+                    if results is not None:
+                        return results
+                attempt += 1
+                self._mirrors.record_failure(mirror, e)
+                tried.add(mirror)
+                proxy_failed = proxy is not None and is_proxy_error(e)
+                if proxy:
+                    self._proxies.record_failure(proxy, e)
+                    tried_proxies.add(proxy)
+                delay = self._on_attempt_failed(
+                    url,
+                    e,
+                    attempt,
+                    max_retries,
+                    origin,
+                    host,
+                    # 代理故障与源站无关，不计入源站的熔断器，换用其它代理立即重试
+                    None if proxy_failed else breaker,
+                    failover=self._mirrors.has_alternative(job.url, tried)
+                    or (proxy_failed and self._proxies.has_alternative(tried_proxies)),
                 )
-                if retries == max_retries:
+            finally:
+                if race:
+                    race.detach("primary")
+                self._proxies.release(proxy)
+                if host_acquired:
+                    host.release()
+                if acquired:
+                    origin.release()
+                self._fetch_metrics.end(started, downloaded_size)
+            # 释放并发名额后再等待
+            if delay > 0 and cancel_event:
+                cancel_event.wait(delay)
+            elif delay > 0:
+                time.sleep(delay)
+
+    def _hedge_stragglers(self, races, hedge_pool, cancel_event=None):
+        """为耗时超过该主机pN耗时的分片任务发出对冲请求"""
+        now = time.monotonic()
+        for future, race in list(races.items()):
+            if future.done():
+                del races[future]
+                continue
+            if race.hedged or race.started is None:
+                continue
+            threshold = self._hedges.threshold(race.host)
+            if threshold is None or now - race.started < threshold:
+                continue
+            if not self._hedges.try_hedge():
+                return
+            race.hedged = True
+            logger.info(
+                f"分片耗时超过 {threshold:.1f} 秒，发出对冲请求: {race.job.url}"
+            )
+            race.hedge_future = hedge_pool.submit(self._fetch_hedge, race, cancel_event)
+
+    def _fetch_hedge(self, race, cancel_event=None):
+        """对冲请求：把数据下载到私有临时文件，获胜时返回(文件路径, 跳过字节数)"""
+        job = race.job
+        mirror, url = self._hedge_mirror(race)
+        host = get_host_scheduler(url)
+        breaker = get_circuit_breaker(url)
+        delay = host.try_reserve()
+        if delay is None:
+            return None  # 主机暂停请求（Retry-After）或请求数已满，不再增加负担
+        path = hedge_file(os.path.dirname(self.output_path), job)
+        result = None
+        proxy = None
+        try:
+            # 与主请求相同遵守主机的发送节奏
+            while delay > 0:
+                if race.lost("hedge") or (cancel_event and cancel_event.is_set()):
+                    return None
+                time.sleep(min(delay, 0.1))
+                delay -= 0.1
+            breaker.check()
+            proxy = self._proxies.acquire()
+            self._retry_budget.on_request()
+            headers = {}
+            if job.start is not None:
+                headers["Range"] = job.range_header()
+            request_started = time.time()
+            with self.engine.get(
+                url,
+                stream=True,
+                timeout=self._controller.get_timeout(),
+                headers=headers,
+                proxy=proxy.url if proxy else None,
+                on_connection=lambda conn: race.attach("hedge", conn),
+            ) as response:
+                skip = self._range_skip(job, response.status_code, response.headers)
+                overrun = job.start is not None and response.status_code == 200
+                received = 0
+                with open(path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=Config.CHUNK_SIZE):
+                        if race.lost("hedge") or (
+                            cancel_event and cancel_event.is_set()
+                        ):
+                            return None
+                        if chunk:
+                            received += len(chunk)
+                            self._throttle(len(chunk))
+                            f.write(chunk)
+                            if overrun and received >= job.end:
+                                break
+                    else:
+                        check_content_length(response.headers, received)
+                # 归还连接前决出胜负，避免中断已被其它请求复用的连接
+                if race.claim("hedge"):
+                    result = (path, skip)
+            breaker.record(None)
+            self._mirrors.record_success(
+                mirror, received, time.time() - request_started
+            )
+            self._proxies.record_success(proxy, received, time.time() - request_started)
+            return result
+        except Exception as e:
+            if not race.lost("hedge"):
+                breaker.record(e)
+                self._mirrors.record_failure(mirror, e)
+                self._proxies.record_failure(proxy, e)
+                logger.info(f"对冲请求失败: {url}, error={str(e)}")
+            return None
+        finally:
+            race.detach("hedge")
+            self._proxies.release(proxy)
+            host.release()
+            if result is None and os.path.exists(path):
+                os.remove(path)
+
+    def _hedge_mirror(self, race):
+        """对冲请求优先使用与主请求不同的镜像，返回(镜像, 地址)"""
+        exclude = {race.mirror} if race.mirror else ()
+        return self._mirrors.pick(race.job.url, exclude=exclude)
+
+    def _finish_race(self, race, won, open_sink=None):
+        """结束主请求与对冲请求的竞争并等待对冲请求退出
+
+        主请求获胜时记录耗时样本；主请求失败时如果对冲请求获胜，
+        把对冲请求的数据写入分片输出并返回结果，否则返回None。
+        """
+        hedge = race.hedge_future.result() if race.hedge_future else None
+        if won:
+            self._hedges.observe(race.host, time.monotonic() - race.started)
+            if race.hedge_future is not None:
+                self._hedges.record_result(False)
+            return None
+        race.hedge_future = None
+        self._hedges.record_result(hedge is not None)
+        if hedge is None:
+            race.winner = None  # 对冲请求失败，主请求继续重试
+            return None
+        logger.info(f"对冲请求先完成: {race.job.url}")
+        return replay_hedge(race.job, open_sink, *hedge)
+
+    def get_hedge_info(self):
+        """获取对冲请求统计，未开启时返回None"""
+        return self._hedges.snapshot() if self.hedge else None
+
+    def _select_mirror(self, url, tried):
+        """选择本次请求使用的镜像，返回(镜像, 镜像上的地址, 熔断器)
+
+        熔断中的镜像有可用的替代时跳过，都不可用时抛出CircuitOpenError。
+        """
+        while True:
+            mirror, target = self._mirrors.pick(url, exclude=tried)
+            breaker = self._circuit_breaker(target)
+            try:
+                breaker.check()
+                return mirror, target, breaker
+            except CircuitOpenError:
+                if not self._mirrors.has_alternative(url, tried | {mirror}):
                     raise
-                time.sleep(1)  # 重试前等待1秒
+                tried.add(mirror)
+
+    def get_mirror_info(self):
+        """获取各镜像的吞吐量及失败次数，没有配置镜像时返回None"""
+        return self._mirrors.snapshot() if len(self._mirrors) > 1 else None
+
+    def _on_attempt_failed(
+        self, url, error, attempt, max_retries, origin, host, breaker, failover=False
+    ):
+        """记录一次失败的请求；不再重试时抛出异常，否则返回重试前需要等待的秒数
+
+        failover为True表示还有其它镜像或代理可以尝试，此时4xx错误也会重试且不等待；
+        breaker为None时（代理故障）不记录熔断器。
+        """
+        self._report_failure(origin, error)
+        if breaker:
+            breaker.record(error)
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after:
+            host.block(retry_after, f"(Retry-After, HTTP {error.status_code})")
+        if not (is_retryable(error) or failover) or attempt >= max_retries:
+            logger.warning(
+                f"下载分片失败 (尝试 {attempt}/{max_retries}): {url}, error={str(error)}"
+            )
+            raise error
+        if not self._retry_budget.try_retry():
+            logger.warning(f"任务重试预算已用完: {url}, error={str(error)}")
+            raise error
+        # 换用其它镜像时立即重试，Retry-After由主机调度器等待，其它错误按指数退避等待
+        delay = 0 if retry_after or failover else backoff_delay(attempt)
+        logger.warning(
+            f"下载分片失败 (尝试 {attempt}/{max_retries})，{delay:.1f}秒后重试: "
+            f"{url}, error={str(error)}"
+        )
+        return delay
+
+    def _circuit_breaker(self, url):
+        breaker = get_circuit_breaker(url)
+        self._breakers[breaker.host] = breaker
+        return breaker
+
+    def get_retry_info(self):
+        """获取任务的重试次数及相关主机的熔断状态"""
+        return {
+            "task": self._retry_budget.snapshot(),
+            "breakers": {
+                host: breaker.snapshot()
+                for host, breaker in list(self._breakers.items())
+            },
+        }
+
+    def _throttle(self, size):
+        """从令牌桶中取出size字节的带宽，超过限速时等待"""
+        delay = self._rate_limiter.reserve(self.rate_share, size)
+        if delay > 0:
+            time.sleep(delay)
+
+    def set_rate_limit(self, speed_limit=None, weight=None):
+        """运行时修改任务的速度上限（MB/s）或权重"""
+        cap = int(float(speed_limit) * MB) if speed_limit is not None else None
+        self._rate_limiter.update_share(self.rate_share, weight=weight, cap=cap)
+
+    def get_rate_limit_info(self):
+        return self.rate_share.snapshot()
+
+    def _origin_controller(self, url):
+        """获取源站级并发控制器，未开启自适应并发时返回None"""
+        if not self.adaptive:
+            return None
+        origin = get_origin_controller(url)
+        self._origins[origin.name] = origin
+        return origin
+
+    def _report_success(self, origin, latency, size):
+        self._controller.on_success(latency, size)
+        if origin:
+            origin.on_success(latency, size)
+
+    def _report_failure(self, origin, error):
+        """429/5xx/超时降低任务及源站的并发数"""
+        reason = congestion_reason(error)
+        if reason is None:
+            return
+        self._controller.on_congestion(reason)
+        if origin:
+            origin.on_congestion(reason)
+
+    def get_concurrency_info(self):
+        """获取当前并发数、超时设置及最近的调整原因"""
+        return {
+            "adaptive": bool(self.adaptive),
+            "task": self._controller.snapshot(),
+            "origins": {
+                name: origin.snapshot() for name, origin in list(self._origins.items())
+            },
+            "timeout": self._controller.get_timeout(),
+        }
+
+    def _range_skip(self, job, status_code, headers=None):
+        """检查响应状态码，返回响应数据开头需要跳过的字节数"""
+        if job.start is not None and status_code == 206:
+            return 0
+        if status_code != 200:
+            retry_after = (
+                parse_retry_after(headers.get("Retry-After")) if headers else None
+            )
+            raise HTTPStatusError(status_code, retry_after=retry_after)
+        # 服务器不支持Range请求时返回完整资源，需跳过范围之前的数据
+        return job.start or 0
+
+    def _open_sink(self, target, key=None, iv=None):
+        """打开分片输出，有流水线时交给流水线解密和写盘"""
+        if self._pipeline:
+            return self._pipeline.open_segment(target, key, iv)
+        return DirectSegmentSink(target, key, iv)
+
+    def _open_segment_target(self, index):
+        """流式合并时由合并器决定分片暂存在内存还是分片包中"""
+        target = self._merger.open_buffer(index) if self._merger else None
+        if target is None:
+            target = self._pack.open(index)
+        return target
+
+    def _open_segment_sink(self, index, segment_keys):
+        """打开分片输出"""
+        key, iv = segment_keys[index]
+        return self._open_sink(self._open_segment_target(index), key, iv)
+
+    def _load_cached(self, job):
+        """从共享分片缓存导入分片，缓存已被删除时返回None（改为下载）"""
+        index = job.parts[0].index
+        size = self._cache.load(
+            self._cache_keys[index], self._open_segment_target(index)
+        )
+        if size is None:
+            logger.info(f"分片 {index + 1} 已从缓存中删除，重新下载")
+            job.cached = False
+            return None
+        self._cache_loaded.add(index)
+        return [(index, size)]
+
+    def _store_cached(self, index):
+        """把校验通过的分片保存到共享分片缓存，从缓存导入的分片不再保存"""
+        if not self._cache_keys or index in self._cache_loaded:
+            return
+        key = self._cache_keys[index]
+        data = self._merger.segment_data(index) if self._merger else None
+        if data is not None:
+            future = self._cache.submit_store(key, lambda f: f.write(data))
+        else:
+            # 保存完成前分片包中的块不会被合并后释放
+            pack = self._pack
+            if not pack.pin(index):
+                return
+            future = self._cache.submit_store(
+                key,
+                lambda f: pack.copy_to(index, f),
+                done=lambda: pack.unpin(index),
+            )
+        stores = self._cache_stores
+        while stores and stores[0].done():
+            stores.popleft()
+        stores.append(future)
+
+    def _finish_cache_stores(self, success):
+        """等待后台保存分片缓存结束，任务失败时不再保存尚未开始的分片"""
+        stores, self._cache_stores = self._cache_stores, deque()
+        if not success:
+            for future in stores:
+                future.cancel()
+        wait(stores)
+
+    def get_pipeline_stats(self):
+        """获取分片流水线各阶段的统计信息（解密和写盘阶段为所有任务共享的流水线）"""
+        stats = {"fetch": self._fetch_metrics.snapshot()}
+        if self._pipeline:
+            stats.update(self._pipeline.get_stats())
+        elif self._last_pipeline_stats:
+            stats.update(self._last_pipeline_stats)
+        merger = self._merger
+        if merger:
+            stats["merge"] = merger.snapshot()
+        elif self._merge_stats:
+            stats["merge"] = self._merge_stats
+        pack = self._pack
+        if pack:
+            stats["pack"] = pack.snapshot()
+        if self._states:
+            stats["segments"] = self._states.snapshot()
+        return stats
 
     def download_segment(
         self, progress_callback=None, cancel_event=None, pause_event=None
@@ -94,7 +663,7 @@ class M3U8Downloader:
         try:
             logger.info(f"开始下载M3U8: {self.m3u8_url}")
             # 加载M3U8文件
-            playlist = m3u8.load(self.m3u8_url, verify_ssl=False)
+            playlist = self._load_playlist()
             if not playlist.segments:
                 logger.error("M3U8文件没有分片")
                 return False
@@ -102,217 +671,642 @@ class M3U8Downloader:
             self.total_segments = len(playlist.segments)
             logger.info(f"找到 {self.total_segments} 个分片")
 
-            # 获取密钥（如果有）
-            key = None
-            iv = None
-            if playlist.keys and len(playlist.keys) > 0:
-                key_info = playlist.keys[0]
-                if key_info:
-                    logger.info(
-                        f"发现加密密钥: method={key_info.method}, uri={key_info.uri}"
-                    )
-                    key_url = self._get_absolute_url(key_info.uri)
-                    key = self.session.get(key_url).content
-                    # 处理IV
-                    if key_info.iv:
-                        if isinstance(key_info.iv, str):
-                            iv_str = key_info.iv.lower().replace("0x", "")
-                            iv_str = iv_str.zfill(32)
-                            iv = bytes.fromhex(iv_str)
-                        else:
-                            iv = key_info.iv
-                    else:
-                        iv = bytes([0] * 16)
-                    logger.info(f"使用IV: {iv.hex()}")
+            # 获取密钥的同时预先解析分片主机并建立连接
+            self._prewarm_hosts(playlist)
+
+            # 预先获取所有分片的密钥（支持密钥轮换），避免密钥请求阻塞分片下载
+            segment_keys = self._prepare_segment_keys(playlist)
 
-            # 下载每个分片
-            downloaded_segments = []
             self.downloaded_segments = 0
-            download_start_time = time.time()
-            last_progress_update = time.time()
-            bytes_since_last_update = 0
+            self.failed_segments = []
+            self._bytes_since_last_update = 0
+            self._last_progress_update = time.time()
+            logger.info(
+                f"分片并发数: {self.concurrency}，自适应: {bool(self.adaptive)}"
+            )
 
-            for index, segment in enumerate(playlist.segments):
-                if cancel_event and cancel_event.is_set():
-                    logger.info("下载已取消")
-                    return False
+            self._pipeline = get_segment_pipeline()
+            self._rate_limiter.register(self.rate_share)
+            success = False
+            try:
+                success = self._download_segments(
+                    playlist,
+                    segment_keys,
+                    progress_callback,
+                    cancel_event,
+                    pause_event,
+                )
+                return success
+            finally:
+                self._close_merger()
+                self._close_journal(success)
+                self._rate_limiter.unregister(self.rate_share)
+                self._last_pipeline_stats = self._pipeline.get_stats()
+                self._pipeline = None
+                self._close_pack(success)
+
+        except Exception as e:
+            logger.error(f"下载失败: {str(e)}", exc_info=True)
+            return False
+
+    def _download_segments(
+        self,
+        playlist,
+        segment_keys,
+        progress_callback=None,
+        cancel_event=None,
+        pause_event=None,
+    ):
+        """并发下载所有分片并合并"""
+        jobs = self._plan_jobs(playlist, segment_keys, progress_callback)
 
-                while pause_event and pause_event.is_set():
+        def open_sink(part):
+            return self._open_segment_sink(part.index, segment_keys)
+
+        hedge_pool = (
+            ThreadPoolExecutor(
+                max_workers=Config.HEDGE_MAX_IN_FLIGHT, thread_name_prefix="hedge"
+            )
+            if self.hedge
+            else None
+        )
+        try:
+            races = {}
+            with ThreadPoolExecutor(
+                max_workers=self._controller.max_limit, thread_name_prefix="segment"
+            ) as executor:
+                in_flight = {}
+                pending = deque(jobs)
+                while pending or in_flight or self._validating:
                     if cancel_event and cancel_event.is_set():
-                        logger.info("暂停时取消下载")
+                        logger.info("下载已取消")
+                        self._cancel_in_flight(in_flight)
                         return False
-                    time.sleep(0.1)
 
-                segment_url = self._get_absolute_url(segment.uri)
-                output_file = os.path.join(
-                    os.path.dirname(self.output_path), f"segment_{index:03d}.ts"
-                )
-                downloaded_segments.append(output_file)
+                    if hedge_pool:
+                        self._hedge_stragglers(races, hedge_pool, cancel_event)
+
+                    # 超出流式合并窗口或没有空闲的下载槽位时，处理已完成的下载和校验；
+                    # 槽位由控制器计数，下载结束（含取消）时归还
+                    if (
+                        not pending
+                        or self._merge_blocked(pending[0])
+                        or not self._controller.try_acquire()
+                    ):
+                        if pending and self._merge_stalled():
+                            pending.clear()  # 合并位置的分片已失败，任务无法完成
+                        self._collect_segments(in_flight, progress_callback, pending)
+                        continue
+
+                    if not self._wait_if_paused(cancel_event, pause_event):
+                        self._controller.release()
+                        self._cancel_in_flight(in_flight)
+                        return False
 
-                try:
+                    job = pending.popleft()
                     logger.info(
-                        f"下载分片 {index+1}/{self.total_segments}: {segment_url}"
+                        f"下载分片 {job.parts[-1].index + 1}/{self.total_segments}: {job.url}"
+                        + (f" ({job.range_header()})" if job.start is not None else "")
                     )
-                    segment_size = self._download_segment_with_retry(
-                        segment_url, output_file, key, iv
+                    race = HedgeRace(job) if hedge_pool else None
+                    future = executor.submit(
+                        self._download_job_with_retry,
+                        job,
+                        open_sink,
+                        cancel_event=cancel_event,
+                        race=race,
                     )
-                    bytes_since_last_update += segment_size
+                    future.add_done_callback(lambda _: self._controller.release())
+                    in_flight[future] = job
+                    if race:
+                        races[future] = race
+        finally:
+            if hedge_pool:
+                hedge_pool.shutdown()
+
+        # 检查是否有失败的分片
+        if self.failed_segments:
+            self._log_failed_segments()
+            return False
 
-                    self.downloaded_segments += 1
-                    self.progress = (
-                        self.downloaded_segments / self.total_segments
-                    ) * 100
+        # 合并分片
+        return self._merge_segments(os.path.dirname(self.output_path))
+
+    def _plan_jobs(self, playlist, segment_keys, progress_callback=None):
+        """打开分片包和断点续传日志并生成下载任务
+
+        已完成的分片不再下载，共享分片缓存中已有的分片生成从缓存导入的任务。
+        """
+        segment_urls = playlist.segment_urls
+        self._segments = playlist.segments
+        self._segment_urls = segment_urls
+        self._states = SegmentStates(len(playlist.segments))
+        logger.info(
+            f"播放列表: {len(playlist.segments)} 个分片，"
+            f"列存储 {playlist.memory_size() // 1024}KB"
+        )
+        self._validating = {}
+        self._validation_failures = {}
+        task_dir = os.path.dirname(self.output_path)
+        self._pack = SegmentPack(
+            task_dir, len(playlist.segments), self._estimate_pack_size(playlist)
+        )
+        self._journal = ResumeJournal(task_dir)
+        completed = self._journal.open(
+            playlist_fingerprint(segment_urls, playlist.segments), self._pack
+        )
+        if self._merge_mode() in ("stream", "pipe"):
+            completed = self._open_merger(completed)
+        for index in completed:
+            self._states.set(index, self._completed_state())
+        if completed:
+            logger.info(f"断点续传: 跳过已完成的 {len(completed)} 个分片")
+            self.downloaded_segments = len(completed)
+            self.progress = (self.downloaded_segments / self.total_segments) * 100
+            if progress_callback:
+                progress_callback(self.downloaded_segments, self.total_segments, 0)
+
+        cached = set()
+        self._cache_loaded = set()
+        if self._cache.enabled:
+            self._cache_keys = segment_cache_keys(
+                playlist.segments, segment_urls, segment_keys
+            )
+            cached = {
+                index
+                for index, key in enumerate(self._cache_keys)
+                if index not in completed and self._cache.probe(key)
+            }
+        jobs = build_segment_jobs(
+            playlist.segments,
+            segment_urls,
+            Config.BYTERANGE_COALESCE_SIZE,
+            skip=completed.keys() | cached,
+        )
+        requested = sum(len(job.parts) for job in jobs)
+        if len(jobs) < requested:
+            logger.info(f"字节范围分片合并为 {len(jobs)} 个请求")
+        if cached:
+            logger.info(f"分片缓存: {len(cached)} 个分片从缓存导入")
+            # 缓存中的分片也生成单分片任务，缓存被删除时按原地址下载
+            cached_jobs = build_segment_jobs(
+                playlist.segments,
+                segment_urls,
+                skip=set(range(len(playlist.segments))) - cached,
+            )
+            for job in cached_jobs:
+                job.cached = True
+            # 按分片顺序排列，流式合并窗口依次推进
+            jobs = sorted(jobs + cached_jobs, key=lambda job: job.parts[0].index)
+        return jobs
+
+    def _merge_mode(self):
+        return Config.MERGE_MODE
+
+    def _stream_output(self):
+        """流式合并的输出文件：TS直接写入最终输出，mp4/mkv先合并为TS再转换格式"""
+        task_dir = os.path.dirname(self.output_path)
+        output_format = os.path.splitext(self.output_path)[1][1:] or "mp4"
+        if output_format in ["mp4", "mkv"]:
+            return os.path.join(task_dir, "merged.ts")
+        return os.path.join(task_dir, f"output.{output_format}")
+
+    def _open_merger(self, completed):
+        """创建流式合并器，返回断点续传时已完成的分片（已合并的及保留在分片包中的）"""
+        if self._merge_mode() == "pipe" and self._open_pipe_merger():
+            for index in sorted(completed):
+                self._merger.complete(index)
+            return completed
+        output_file = self._stream_output()
+        merged, size = self._journal.merged
+        if merged and not (
+            os.path.exists(output_file) and os.path.getsize(output_file) >= size
+        ):
+            logger.info("流式合并的输出文件不完整，重新合并")
+            merged, size = 0, 0
+        self._merger = StreamMerger(
+            output_file, self._pack, self._journal, merged, size
+        )
+        logger.info(
+            f"流式合并: 窗口 {self._merger.window} 个分片，"
+            f"内存缓冲 {self._merger.memory_limit // MB}MB"
+        )
+        # 上次保留在分片包中的分片等待按顺序合并
+        for index in sorted(completed):
+            if index >= merged:
+                self._merger.complete(index)
+        return {**dict.fromkeys(range(merged)), **completed}
+
+    def _open_pipe_merger(self):
+        """mp4/mkv输出时启动FFmpeg边下载边转换，FFmpeg不可用时返回False（改为先合并为TS）"""
+        output_format = os.path.splitext(self.output_path)[1][1:] or "mp4"
+        if output_format not in ["mp4", "mkv"]:
+            return False
+        task_dir = os.path.dirname(self.output_path)
+        output_file = os.path.join(task_dir, f"output.{output_format}")
+        try:
+            self._merger = FFmpegPipeMerger(output_file, self._pack)
+        except OSError as e:
+            logger.warning(f"无法启动FFmpeg，改为合并后再转换格式: {str(e)}")
+            return False
+        logger.info(
+            f"流式合并到FFmpeg: 窗口 {self._merger.window} 个分片，"
+            f"内存缓冲 {self._merger.memory_limit // MB}MB"
+        )
+        return True
 
-                    # 更新进度
-                    if progress_callback:
-                        progress_callback(
-                            self.downloaded_segments, self.total_segments, segment_size
-                        )
+    def _merge_blocked(self, job):
+        """任务超出流式合并窗口时暂不下载，重排缓冲区大小有上限"""
+        return self._merger is not None and not self._merger.in_window(
+            job.parts[0].index
+        )
 
-                    # 更新下载速度
-                    current_time = time.time()
-                    if current_time - last_progress_update >= 1.0:
-                        download_speed = bytes_since_last_update / (
-                            current_time - last_progress_update
-                        )
-                        bytes_since_last_update = 0
-                        last_progress_update = current_time
+    def _merge_stalled(self):
+        """合并位置的分片已失败或合并出错，之后的分片无法再合并"""
+        merger = self._merger
+        if merger is None:
+            return False
+        if merger.error:
+            return True
+        return (
+            merger.idle()
+            and merger.next_index < len(self._segments)
+            and self._states.get(merger.next_index) == SEGMENT_FAILED
+        )
 
-                    logger.info(
-                        f"分片下载进度: {self.downloaded_segments}/{self.total_segments} ({self.progress:.1f}%)"
-                    )
+    def _close_merger(self):
+        """停止流式合并，保留统计信息"""
+        if self._merger is None:
+            return
+        try:
+            self._merger.close()
+        except Exception as e:
+            logger.error(f"关闭流式合并失败: {str(e)}")
+        self._merge_stats = self._merger.snapshot()
+        self._merger = None
+
+    def _record_segment(self, index):
+        """记录一个校验通过的分片：写入断点续传日志，流式合并时交给合并器
+
+        内存中的分片不写入日志，中断后重新下载。
+        """
+        self._states.set(index, self._completed_state())
+        merger = self._merger
+        if not (merger and merger.in_memory(index)):
+            size = self._pack.commit(index)
+            if self._journal:
+                self._journal.record(index, size)
+        self._store_cached(index)
+        if merger:
+            merger.complete(index)
+
+    def _completed_state(self):
+        return SEGMENT_VERIFIED if Config.SEGMENT_VALIDATION else SEGMENT_DONE
+
+    def _segment_failed(self, index, segment_url, error):
+        """记录下载或校验失败的分片"""
+        self._states.set(index, SEGMENT_FAILED)
+        self.failed_segments.append(
+            {"index": index, "url": segment_url, "error": str(error)}
+        )
+
+    def _validate(self, index):
+        """在校验线程池中校验分片，返回Future"""
+        data = self._merger.segment_data(index) if self._merger else None
+        if data is not None:
+            reader, size = io.BytesIO(data), len(data)
+        else:
+            reader, size = self._pack.reader(index)
+        return get_validation_pool().submit(validate_segment, reader, size)
+
+    def _estimate_pack_size(self, playlist):
+        """预估需要写入分片包的数据量，用于预分配
+
+        按字节范围或所选码率乘以总时长估算；流式合并时分片包中只保存合并窗口内溢出内存的分片。
+        """
+        segments = playlist.segments
+        if all(segment.byterange for segment in segments):
+            total = sum(int(segment.byterange.split("@")[0]) for segment in segments)
+        elif self.selected_variant and self.selected_variant.get("bandwidth"):
+            duration = sum(segment.duration or 0 for segment in segments)
+            total = int(self.selected_variant["bandwidth"] * duration / 8)
+        else:
+            return 0
+        if self._merge_mode() in ("stream", "pipe"):
+            total = total * min(1, Config.MERGE_WINDOW / len(segments))
+        return int(total)
+
+    def _close_pack(self, success):
+        """下载成功后删除分片包，否则保留以便下次继续"""
+        if self._pack is None:
+            return
+        self._finish_cache_stores(success)
+        try:
+            if success:
+                self._pack.remove()
+            else:
+                self._pack.close()
+        except Exception as e:
+            logger.error(f"关闭分片包失败: {str(e)}")
+        self._pack = None
 
+    def _close_journal(self, success):
+        """下载成功后删除断点续传日志，否则保留以便下次继续"""
+        if self._journal is None:
+            return
+        try:
+            if success:
+                self._journal.remove()
+            else:
+                self._journal.close()
+        except Exception as e:
+            logger.error(f"关闭断点续传日志失败: {str(e)}")
+        self._journal = None
+
+    def _segment_hosts(self, playlist):
+        """返回分片所在的各主机（每个主机一个示例地址），包括镜像上的地址"""
+        hosts = {}
+        for segment in playlist.segments:
+            url = self._get_absolute_url(segment.uri)
+            for mirror in self._mirrors.mirrors:
+                target = self._mirrors.rewrite(url, mirror)
+                hosts.setdefault(urlsplit(target).netloc, target)
+        return list(hosts.values())
+
+    def _prewarm_hosts(self, playlist):
+        """在后台预先解析分片主机的DNS并建立空闲连接，不阻塞下载
+
+        使用代理时连接经由代理建立，不预建直连的连接。
+        """
+        if len(self._proxies):
+            return
+        try:
+            urls = self._segment_hosts(playlist)
+            count = min(
+                self.concurrency,
+                Config.PREWARM_MAX_CONNECTIONS,
+                Config.HTTP_POOL_MAXSIZE_PER_HOST,
+            )
+            self.engine.prewarm(urls, count)
+            logger.debug(f"预建连接: {len(urls)} 个主机，每个主机 {count} 个连接")
+        except Exception as e:
+            logger.warning(f"预建连接失败: {str(e)}")
+
+    def _prepare_segment_keys(self, playlist):
+        """返回每个分片的(key, iv)，未加密的分片为(None, None)
+
+        每个分片使用其生效的EXT-X-KEY；未指定IV时按HLS规范使用媒体序列号作为IV。
+        密钥通过共享的密钥缓存获取，不同的密钥URI并行获取。
+        """
+        segment_keys = [(None, None)] * len(playlist.segments)
+        key_urls = {}
+        for index, segment in enumerate(playlist.segments):
+            key_info = segment.key
+            if not key_info or not key_info.method or key_info.method == "NONE":
+                continue
+            if key_info.method != "AES-128":
+                raise Exception(f"不支持的加密方式: {key_info.method}")
+            key_urls.setdefault(self._get_absolute_url(key_info.uri), None)
+
+        if key_urls:
+            logger.info(f"发现 {len(key_urls)} 个加密密钥")
+            key_cache = get_key_cache()
+            with ThreadPoolExecutor(
+                max_workers=min(8, len(key_urls)), thread_name_prefix="key"
+            ) as executor:
+                futures = {
+                    url: executor.submit(key_cache.get, url, self._fetch_key)
+                    for url in key_urls
+                }
+                for url, future in futures.items():
+                    key_urls[url] = future.result()
+
+        for index, segment in enumerate(playlist.segments):
+            key_info = segment.key
+            if not key_info or not key_info.method or key_info.method == "NONE":
+                continue
+            key = key_urls[self._get_absolute_url(key_info.uri)]
+            iv = segment_iv(key_info.iv, playlist.media_sequence, index)
+            segment_keys[index] = (key, iv)
+        return segment_keys
+
+    def _fetch_key(self, key_url):
+        """获取解密密钥"""
+        logger.info(f"获取加密密钥: {key_url}")
+        key = call_with_retry(
+            lambda target: self._get_content(target, "获取密钥失败"),
+            key_url,
+            self._retry_budget,
+            what="获取密钥",
+            mirrors=self._mirrors,
+        )
+        if len(key) != 16:
+            raise Exception(f"密钥长度错误: {len(key)} 字节")
+        return key
+
+    def _parse_iv(self, iv):
+        """解析EXT-X-KEY中的IV"""
+        return parse_iv(iv)
+
+    def _wait_if_paused(self, cancel_event=None, pause_event=None):
+        """暂停时等待，取消时返回False"""
+        if cancel_event and cancel_event.is_set():
+            logger.info("下载已取消")
+            return False
+
+        while pause_event and pause_event.is_set():
+            if cancel_event and cancel_event.is_set():
+                logger.info("暂停时取消下载")
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _collect_segments(
+        self, in_flight, progress_callback=None, pending=None, timeout=0.5
+    ):
+        """处理已完成的分片下载和校验，更新进度或记录失败"""
+        futures = list(in_flight) + list(self._validating)
+        if not futures:
+            # 等待流式合并追上下载进度
+            time.sleep(0.05)
+            return
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future in self._validating:
+                index, segment_size, segment_url = self._validating.pop(future)
+                try:
+                    future.result()
                 except Exception as e:
-                    logger.error(f"下载分片失败: {segment_url}, error={str(e)}")
-                    self.failed_segments.append(
-                        {"index": index, "url": segment_url, "error": str(e)}
-                    )
+                    if self._validation_failed(index, segment_url, e):
+                        # 放在队首，流式合并时不会被合并窗口挡住
+                        pending.appendleft(self._single_segment_job(index))
                     continue
+                self._segment_done(index, segment_size, progress_callback)
+                continue
 
-            # 检查是否有失败的分片
-            if self.failed_segments:
-                logger.error(f"有 {len(self.failed_segments)} 个分片下载失败")
-                for failed in self.failed_segments:
-                    logger.error(
-                        f"失败的分片: index={failed['index']}, url={failed['url']}, error={failed['error']}"
-                    )
-                return False
+            job = in_flight.pop(future)
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error(f"下载分片失败: {job.url}, error={str(e)}")
+                for index in job.indexes:
+                    self._segment_failed(index, job.url, e)
+                continue
+
+            for index, segment_size in results:
+                self._states.set(index, SEGMENT_DONE)
+                if Config.SEGMENT_VALIDATION and pending is not None:
+                    # 在校验线程池中检查分片，不占用下载线程
+                    validation = self._validate(index)
+                    self._validating[validation] = (index, segment_size, job.url)
+                else:
+                    self._segment_done(index, segment_size, progress_callback)
+
+    def _validation_failed(self, index, segment_url, error):
+        """记录分片校验失败，返回是否需要重新下载该分片"""
+        attempts = self._validation_failures.get(index, 0) + 1
+        self._validation_failures[index] = attempts
+        if index in self._cache_loaded:
+            # 缓存中的数据已损坏，删除后重新下载
+            self._cache_loaded.discard(index)
+            self._cache.discard(self._cache_keys[index])
+        logger.warning(
+            f"分片校验失败 (第 {attempts} 次): index={index}, url={segment_url}, error={str(error)}"
+        )
+        if attempts <= Config.VALIDATION_RETRIES:
+            return True
+        self._segment_failed(index, segment_url, error)
+        return False
+
+    def _log_failed_segments(self):
+        logger.error(f"有 {len(self.failed_segments)} 个分片下载失败")
+        for failed in self.failed_segments:
+            logger.error(
+                f"失败的分片: index={failed['index']}, url={failed['url']}, error={failed['error']}"
+            )
 
-            # 合并分片
-            if downloaded_segments:
-                return self._merge_segments(
-                    downloaded_segments, os.path.dirname(self.output_path)
-                )
+    def _single_segment_job(self, index):
+        """生成只下载一个分片的任务，用于重新下载校验失败的分片"""
+        return build_single_job(self._segments, self._segment_urls, index)
+
+    def _segment_done(self, index, segment_size, progress_callback=None):
+        """记录一个完成的分片，更新进度和下载速度"""
+        self._record_segment(index)
+        self.downloaded_segments += 1
+        self.progress = (self.downloaded_segments / self.total_segments) * 100
+        self._bytes_since_last_update += segment_size
+
+        # 更新进度
+        if progress_callback:
+            progress_callback(
+                self.downloaded_segments, self.total_segments, segment_size
+            )
 
-            return False
+        # 更新下载速度
+        current_time = time.time()
+        if current_time - self._last_progress_update >= 1.0:
+            self.download_speed = self._bytes_since_last_update / (
+                current_time - self._last_progress_update
+            )
+            self._bytes_since_last_update = 0
+            self._last_progress_update = current_time
 
-        except Exception as e:
-            logger.error(f"下载失败: {str(e)}", exc_info=True)
-            return False
+        logger.info(
+            f"分片下载进度: {self.downloaded_segments}/{self.total_segments} ({self.progress:.1f}%)"
+        )
 
-    def _merge_segments(self, downloaded_segments, task_dir):
+    def _cancel_in_flight(self, in_flight):
+        """取消尚未开始的分片下载，正在下载的分片会检查取消事件后退出"""
+        for future in list(in_flight) + list(self._validating):
+            future.cancel()
+        in_flight.clear()
+        self._validating.clear()
+
+    def _merge_segments(self, task_dir):
         """合并下载的分片"""
+        if self._merger:
+            return self._finish_stream_merge(task_dir)
         try:
             logger.info("开始合并分片")
             output_format = os.path.splitext(self.output_path)[1][1:] or "mp4"
             final_output = os.path.join(task_dir, f"output.{output_format}")
             logger.info(f"输出文件路径: {final_output}")
 
-            if output_format in ["mp4", "mkv"]:
-                # 使用ffmpeg合并并转换格式
-                segments_file = os.path.join(task_dir, "segments.txt")
-
-                # 使用相对路径写入segments.txt
-                with open(segments_file, "w", encoding="utf-8") as f:
-                    for segment in downloaded_segments:
-                        # 确保使用相对于task_dir的路径
-                        segment_name = os.path.basename(segment)
-                        f.write(f"file '{segment_name}'\n")
-
-                # 检查segments.txt是否创建成功
-                if not os.path.exists(segments_file):
-                    raise Exception(f"segments.txt 文件创建失败: {segments_file}")
-
-                logger.info(f"创建segments.txt文件: {segments_file}")
-                logger.info(f"segments.txt内容:")
-                with open(segments_file, "r", encoding="utf-8") as f:
-                    logger.info(f.read())
-
-                # 检查所有分片文件是否存在
-                for segment in downloaded_segments:
-                    if not os.path.exists(segment):
-                        raise Exception(f"分片文件不存在: {segment}")
-
-                # 确保输出目录存在
-                os.makedirs(os.path.dirname(final_output), exist_ok=True)
-
-                cmd = [
-                    "ffmpeg",
-                    "-y",
-                    "-f",
-                    "concat",
-                    "-safe",
-                    "0",
-                    "-i",
-                    "segments.txt",
-                    "-c",
-                    "copy",
-                    "output.{0}".format(output_format),  # 使用相对路径
-                ]
+            if output_format in ["mp4", "mkv"] and not self._segments_are_ts():
+                # fMP4等分片不能按mpegts交给FFmpeg：先按顺序拼接，再由FFmpeg识别格式后转换
+                merged_file = os.path.join(task_dir, "merged.m4s")
+                if not self._merge_ts_files(merged_file):
+                    return False
+                return self._convert_merged(merged_file, final_output)
 
+            if output_format in ["mp4", "mkv"]:
+                # 按顺序把分片包中的分片写入ffmpeg转换格式
+                merger = FFmpegPipeMerger(final_output, self._pack)
+                for index in range(self._pack.count):
+                    merger.complete(index)
                 try:
-                    logger.info(f"执行FFmpeg命令: {' '.join(cmd)}")
-                    logger.info(f"工作目录: {task_dir}")
-
-                    # 检查工作目录是否存在
-                    if not os.path.exists(task_dir):
-                        raise Exception(f"工作目录不存在: {task_dir}")
-
-                    # 检查工作目录权限
-                    if not os.access(task_dir, os.W_OK):
-                        raise Exception(f"工作目录没有写入权限: {task_dir}")
-
-                    result = subprocess.run(
-                        cmd,
-                        check=True,
-                        capture_output=True,
-                        text=True,
-                        cwd=task_dir,
-                    )
-
-                    output_file = os.path.join(task_dir, f"output.{output_format}")
-                    if not os.path.exists(output_file):
-                        raise Exception(
-                            f"FFmpeg执行成功但输出文件不存在: {output_file}"
-                        )
-
-                    logger.info("FFmpeg合并成功")
-                    logger.info(f"输出文件大小: {os.path.getsize(output_file)} bytes")
-
-                    # 获取视频信息
-                    self._process_video_info(output_file)
+                    merger.finish()
+                except Exception as e:
+                    logger.error(f"合并视频失败: {str(e)}")
+                    return False
 
-                    return True
+                logger.info("FFmpeg合并成功")
+                logger.info(f"输出文件大小: {os.path.getsize(final_output)} bytes")
 
-                except subprocess.CalledProcessError as e:
-                    logger.error(f"合并视频失败: {e.stdout}\n{e.stderr}")
-                    return False
-                finally:
-                    # 清理临时文件
-                    try:
-                        self._cleanup_temp_files(
-                            task_dir, segments_file, downloaded_segments
-                        )
-                    except Exception as e:
-                        logger.error(f"清理临时文件失败: {str(e)}")
+                # 获取视频信息
+                self._process_video_info(final_output)
+                return True
             else:
                 # 直接合并TS文件
-                return self._merge_ts_files(downloaded_segments, final_output)
+                return self._merge_ts_files(final_output)
 
         except Exception as e:
             logger.error(f"合并分片失败: {str(e)}", exc_info=True)
             return False
 
+    def _finish_stream_merge(self, task_dir):
+        """等待流式合并完成；mp4/mkv输出再把合并后的TS文件转换格式（FFmpeg管道模式除外）"""
+        try:
+            started = time.time()
+            self._merger.finish()
+            merged_file = self._merger.output_file
+            logger.info(
+                f"流式合并完成，等待 {time.time() - started:.2f} 秒: {merged_file}"
+            )
+        except Exception as e:
+            logger.error(f"流式合并失败: {str(e)}", exc_info=True)
+            return False
+        finally:
+            self._close_merger()
+
+        output_format = os.path.splitext(self.output_path)[1][1:] or "mp4"
+        if output_format not in ["mp4", "mkv"]:
+            return True
+        final_output = os.path.join(task_dir, f"output.{output_format}")
+        if merged_file == final_output:  # FFmpeg已在下载时完成转换
+            logger.info(f"输出文件大小: {os.path.getsize(final_output)} bytes")
+            self._process_video_info(final_output)
+            return True
+        return self._convert_merged(merged_file, final_output)
+
+    def _convert_merged(self, merged_file, final_output):
+        """把合并后的文件转换为mp4/mkv"""
+        cmd = ["ffmpeg", "-y", "-i", merged_file, "-c", "copy", final_output]
+        try:
+            logger.info(f"执行FFmpeg命令: {' '.join(cmd)}")
+            subprocess.run(cmd, check=True, capture_output=True, text=True)
+            logger.info(f"输出文件大小: {os.path.getsize(final_output)} bytes")
+        except subprocess.CalledProcessError as e:
+            logger.error(f"转换视频格式失败: {e.stdout}\n{e.stderr}")
+            return False
+        except Exception as e:
+            logger.error(f"转换视频格式失败: {str(e)}")
+            return False
+        # 转换失败时保留合并后的文件，断点续传时只需重新转换
+        os.remove(merged_file)
+        self._process_video_info(final_output)
+        return True
+
     def _process_video_info(self, video_path):
         """处理视频信息"""
         try:
@@ -336,46 +1330,134 @@ class M3U8Downloader:
             self.status = "completed"
             logger.info("下载任务完成（处理视频信息失败）")
 
-    def _merge_ts_files(self, downloaded_segments, final_output):
+    def _segments_are_ts(self):
+        """按第一个分片的同步字节判断分片是否为TS格式"""
+        for index in range(self._pack.count):
+            if self._pack.size(index):
+                reader, _ = self._pack.reader(index)
+                with reader:
+                    return reader.read(1) == bytes([TS_SYNC_BYTE])
+        return True
+
+    def _merge_ts_files(self, final_output):
         """直接合并TS文件"""
         try:
             logger.info("直接合并TS文件")
             with open(final_output, "wb") as outfile:
-                for segment in downloaded_segments:
-                    if os.path.exists(segment):
-                        with open(segment, "rb") as infile:
-                            outfile.write(infile.read())
-                        # 立即删除已合并的分片
-                        try:
-                            os.remove(segment)
-                            logger.info(f"删除分片文件: {segment}")
-                        except Exception as e:
-                            logger.error(f"删除分片文件失败: {segment}, error={str(e)}")
+                for index in range(self._pack.count):
+                    if self._pack.size(index) is not None:
+                        self._pack.copy_to(index, outfile)
             return True
         except Exception as e:
             logger.error(f"合并TS文件失败: {str(e)}")
             return False
 
-    def _cleanup_temp_files(self, task_dir, segments_file, downloaded_segments):
-        """清理临时文件"""
-        try:
-            # 删除segments.txt
-            if os.path.exists(segments_file):
-                os.remove(segments_file)
-                logger.info(f"删除segments.txt: {segments_file}")
+    def _load_playlist(self):
+        """通过共享传输引擎加载M3U8文件，主播放列表按策略选择码率后加载对应的媒体播放列表"""
+        playlist = self._fetch_playlist(self.m3u8_url)
+        if playlist.is_variant:
+            self.variants = describe_variants(playlist)
+            selector = VariantSelector(
+                self.engine,
+                policy=self.variant_policy,
+                max_height=self.max_height,
+                load_playlist=self._fetch_playlist,
+                fetch_segment=self._probe_segment,
+            )
+            self.selected_variant = selector.select(self.variants)
+            if selector.measured_bandwidth:
+                self.selected_variant["measured_bandwidth"] = int(
+                    selector.measured_bandwidth
+                )
+            logger.info(
+                f"检测到主播放列表，共 {len(self.variants)} 个码率，"
+                f"策略={selector.policy}，选择: {self.selected_variant['resolution']} "
+                f"({self.selected_variant['bandwidth']} bps)"
+            )
+            # 分片地址相对于媒体播放列表解析
+            self.m3u8_url = self.selected_variant["url"]
+            playlist = self._fetch_playlist(self.m3u8_url)
+            if playlist.is_variant:
+                raise Exception("码率播放列表仍然是主播放列表")
+        return playlist
+
+    def _fetch_playlist(self, url):
+        text = call_with_retry(
+            lambda target: self._get_content(target, "获取M3U8文件失败", text=True),
+            url,
+            self._retry_budget,
+            what="获取M3U8文件",
+            mirrors=self._mirrors,
+        )
+        return parse_playlist(text, url)
 
-            # 删除分片文件
-            for segment in downloaded_segments:
-                try:
-                    if os.path.exists(segment):
-                        os.remove(segment)
-                except Exception as e:
-                    logger.error(f"删除分片文件失败: {segment}, error={str(e)}")
-            logger.info("删除分片文件完成")
+    def _get_content(self, url, message, text=False):
+        proxy = self._proxies.acquire()
+        started = time.time()
+        try:
+            with self.engine.get(url, proxy=proxy.url if proxy else None) as response:
+                if response.status_code != 200:
+                    raise HTTPStatusError(
+                        response.status_code,
+                        f"{message}，状态码: {response.status_code}",
+                        parse_retry_after(response.headers.get("Retry-After")),
+                    )
+                content = response.content
+                self._proxies.record_success(proxy, len(content), time.time() - started)
+                return response.text if text else content
+        except Exception as e:
+            self._proxies.record_failure(proxy, e)
+            raise
+        finally:
+            self._proxies.release(proxy)
+
+    def _probe_segment(self, url, range_header, limit):
+        """码率测速的分片请求：与分片下载相同使用镜像、代理、限速及重试策略，最多读取limit字节"""
+        return call_with_retry(
+            lambda target: self._read_probe(target, range_header, limit),
+            url,
+            self._retry_budget,
+            what="测量带宽",
+            mirrors=self._mirrors,
+        )
 
+    def _read_probe(self, url, range_header, limit):
+        proxy = self._proxies.acquire()
+        started = time.time()
+        headers = {"Range": range_header} if range_header else {}
+        try:
+            with self.engine.get(
+                url,
+                stream=True,
+                timeout=self._controller.get_timeout(),
+                headers=headers,
+                proxy=proxy.url if proxy else None,
+            ) as response:
+                if response.status_code not in (200, 206):
+                    raise HTTPStatusError(
+                        response.status_code,
+                        retry_after=parse_retry_after(
+                            response.headers.get("Retry-After")
+                        ),
+                    )
+                received = read_probe(response, limit, self._throttle)
+            self._proxies.record_success(proxy, received, time.time() - started)
+            return received
         except Exception as e:
-            logger.error(f"清理临时文件失败: {str(e)}")
+            self._proxies.record_failure(proxy, e)
             raise
+        finally:
+            self._proxies.release(proxy)
+
+    def get_variant_info(self):
+        """获取码率选择结果，非主播放列表时返回None"""
+        if not self.variants:
+            return None
+        return {
+            "policy": self.variant_policy or Config.VARIANT_POLICY,
+            "selected": self.selected_variant,
+            "available": self.variants,
+        }
 
     def _get_absolute_url(self, url):
         """获取绝对URL"""
@@ -385,13 +1467,7 @@ class M3U8Downloader:
 
     def _unpad(self, data):
         """去除PKCS7填充"""
-        padding_len = data[-1]
-        if padding_len < 1 or padding_len > 16:
-            return data
-        for i in range(padding_len):
-            if data[-i - 1] != padding_len:
-                return data
-        return data[:-padding_len]
+        return unpad(data)
 
     def _prepare_task_directory(self):
         """准备任务目录"""
@@ -423,6 +1499,7 @@ class M3U8Downloader:
 
             downloaded_segments = []
             self.failed_segments = []
+            self._pack = SegmentPack(task_dir, len(self.segments))
 
             for index, segment_url in enumerate(self.segments):
                 if self.status == "cancelled":
@@ -433,11 +1510,10 @@ class M3U8Downloader:
                     logger.info("任务已暂停")
                     return False
 
-                segment_path = os.path.join(task_dir, f"segment_{index}.ts")
                 try:
-                    success = self._download_segment(segment_url, segment_path, index)
+                    success = self._download_segment(segment_url, index)
                     if success:
-                        downloaded_segments.append(segment_path)
+                        downloaded_segments.append(index)
                         self.downloaded_segments = len(downloaded_segments)
                         self.progress = (
                             len(downloaded_segments) / len(self.segments)
@@ -460,11 +1536,12 @@ class M3U8Downloader:
                 logger.warning(f"部分分片下载失败: {len(self.failed_segments)} 个失败")
 
             # 合并分片
-            success = self._merge_segments(downloaded_segments, task_dir)
+            success = self._merge_segments(task_dir)
             if not success:
                 logger.error("合并分片失败")
                 return False
 
+            self._close_pack(True)
             logger.info("下载完成")
             return True
 
@@ -472,13 +1549,14 @@ class M3U8Downloader:
             logger.error(f"下载过程发生错误: {str(e)}", exc_info=True)
             return False
 
-    def _download_segment(self, segment_url, segment_path, index):
+    def _download_segment(self, segment_url, index):
         """下载单个分片"""
         try:
             logger.info(f"下载分片 {index+1}/{self.total_segments}: {segment_url}")
             segment_size = self._download_segment_with_retry(
-                segment_url, segment_path, self.key, self.iv
+                segment_url, self._pack.open(index), self.key, self.iv
             )
+            self._pack.commit(index)
             self.downloaded_segments += 1
             self.total_size += segment_size
             self.segment_sizes.append(segment_size)
@@ -494,7 +1572,7 @@ class M3U8Downloader:
         """解析M3U8文件"""
         try:
             logger.info("开始解析M3U8文件")
-            playlist = m3u8.load(self.m3u8_url, verify_ssl=False)
+            playlist = self._load_playlist()
             self.segments = [
                 self._get_absolute_url(segment.uri) for segment in playlist.segments
             ]
@@ -507,7 +1585,7 @@ class M3U8Downloader:
         """获取总大小"""
         try:
             logger.info("开始获取总大小")
-            response = self.session.head(self.m3u8_url)
+            response = self.engine.head(self.m3u8_url)
             if response.status_code != 200:
                 raise Exception(f"获取总大小失败，状态码: {response.status_code}")
             self.total_size = int(response.headers.get("Content-Length", 0))
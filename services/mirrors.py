@@ -0,0 +1,146 @@
+import logging
+import random
+import threading
+import time
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+from config import Config
+from services.retry_policy import get_circuit_breaker
+
+logger = logging.getLogger(__name__)
+
+
+class Mirror:
+    """一个镜像（等价的基础地址或替换主机）及其健康状态"""
+
+    def __init__(self, name, base=None, host=None):
+        self.name = name
+        self.base = base  # 替换基础地址，如 https://cdn2.example.com/hls/
+        self.host = host  # 替换主机，如 cdn2.example.com
+        self.throughput = None  # 平均吞吐量（字节/秒，EWMA）
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.bytes = 0
+        self.ejected_until = 0
+
+    def available(self, now):
+        return now >= self.ejected_until
+
+    def snapshot(self, now):
+        return {
+            "throughput": int(self.throughput) if self.throughput else None,
+            "requests": self.requests,
+            "failures": self.failures,
+            "bytes": self.bytes,
+            "ejected_for": round(max(0, self.ejected_until - now), 1),
+        }
+
+
+class MirrorSet:
+    """任务的镜像列表：原地址加上等价的基础地址或替换主机
+
+    每次请求按镜像的吞吐量加权随机选择，请求分散到所有健康的镜像上；
+    连续失败的镜像暂时剔除，请求自动切换到其它镜像。
+    """
+
+    def __init__(self, url, mirrors=None):
+        self.base = urljoin(url, ".")
+        self.netloc = urlsplit(url).netloc
+        self.mirrors = [Mirror(self.netloc)]
+        for entry in mirrors or []:
+            entry = entry.strip()
+            if not entry:
+                continue
+            if "://" in entry:
+                base = entry if entry.endswith("/") else entry + "/"
+                self.mirrors.append(Mirror(base, base=base))
+            else:
+                self.mirrors.append(Mirror(entry, host=entry))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def rewrite(self, url, mirror):
+        """把原地址转换为镜像上的地址，不属于原地址的URL保持不变"""
+        if mirror.base:
+            if url.startswith(self.base):
+                return mirror.base + url[len(self.base) :]
+            return url
+        if mirror.host:
+            parts = urlsplit(url)
+            if parts.netloc == self.netloc:
+                return urlunsplit(parts._replace(netloc=mirror.host))
+        return url
+
+    def pick(self, url, exclude=()):
+        """选择一个镜像，返回(镜像, 镜像上的地址)
+
+        优先使用未被剔除、熔断器未打开且不在exclude中的镜像，都不可用时退回全部镜像。
+        """
+        if len(self.mirrors) == 1:
+            return self.mirrors[0], url
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                m
+                for m in self.mirrors
+                if m not in exclude
+                and m.available(now)
+                and not get_circuit_breaker(self.rewrite(url, m)).is_open()
+            ]
+            if not candidates:
+                candidates = [m for m in self.mirrors if m not in exclude]
+            if not candidates:
+                candidates = self.mirrors
+            # 按吞吐量加权，还没有测量数据的镜像使用已知镜像的平均值
+            known = [m.throughput for m in candidates if m.throughput]
+            default = sum(known) / len(known) if known else 1.0
+            weights = [m.throughput or default for m in candidates]
+            mirror = random.choices(candidates, weights=weights)[0]
+        return mirror, self.rewrite(url, mirror)
+
+    def has_alternative(self, url, tried):
+        """是否还有没尝试过的可用镜像"""
+        now = time.monotonic()
+        return any(
+            m not in tried
+            and m.available(now)
+            and not get_circuit_breaker(self.rewrite(url, m)).is_open()
+            for m in self.mirrors
+        )
+
+    def record_success(self, mirror, size, duration):
+        with self._lock:
+            mirror.requests += 1
+            mirror.bytes += size
+            mirror.consecutive_failures = 0
+            if duration > 0 and size:
+                rate = size / duration
+                alpha = Config.MIRROR_EWMA_ALPHA
+                mirror.throughput = (
+                    rate
+                    if mirror.throughput is None
+                    else alpha * rate + (1 - alpha) * mirror.throughput
+                )
+
+    def record_failure(self, mirror, error):
+        if len(self.mirrors) == 1:
+            return
+        with self._lock:
+            mirror.requests += 1
+            mirror.failures += 1
+            mirror.consecutive_failures += 1
+            if mirror.consecutive_failures >= Config.MIRROR_EJECT_FAILURES:
+                mirror.ejected_until = time.monotonic() + Config.MIRROR_EJECT_SECONDS
+                mirror.consecutive_failures = 0
+                logger.warning(
+                    f"镜像 {mirror.name} 连续失败，暂停使用 "
+                    f"{Config.MIRROR_EJECT_SECONDS} 秒: {str(error)}"
+                )
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return {m.name: m.snapshot(now) for m in self.mirrors}
@@ -0,0 +1,140 @@
+import logging
+import time
+from urllib.parse import urljoin
+
+from config import Config
+from services.compact_playlist import parse_playlist
+from services.segment_jobs import build_single_job
+
+logger = logging.getLogger(__name__)
+
+# 主播放列表的码率选择策略
+VARIANT_POLICIES = ("highest", "max_resolution", "measured")
+
+
+def describe_variants(playlist):
+    """列出主播放列表中的所有码率，按带宽从低到高排列"""
+    variants = []
+    for item in playlist.playlists:
+        info = item.stream_info
+        resolution = info.resolution if info else None
+        variants.append(
+            {
+                "url": item.absolute_uri or urljoin(playlist.base_uri or "", item.uri),
+                "bandwidth": (info.bandwidth or 0) if info else 0,
+                "average_bandwidth": info.average_bandwidth if info else None,
+                "resolution": (
+                    f"{resolution[0]}x{resolution[1]}" if resolution else None
+                ),
+                "height": resolution[1] if resolution else None,
+                "codecs": info.codecs if info else None,
+            }
+        )
+    variants.sort(key=lambda v: (v["bandwidth"], v["height"] or 0))
+    return variants
+
+
+class VariantSelector:
+    """根据策略从主播放列表中选择一个码率
+
+    - highest: 带宽最高的码率
+    - max_resolution: 不超过max_height的最高码率
+    - measured: 用最低码率的前几个分片测量实际下载速度，选择带宽不超过测量值的最高码率
+    """
+
+    def __init__(
+        self,
+        engine,
+        policy=None,
+        max_height=None,
+        load_playlist=None,
+        fetch_segment=None,
+    ):
+        self.engine = engine
+        # 由下载器提供时，测速请求与分片下载使用相同的镜像、代理、限速及重试策略
+        self._load_playlist = load_playlist or self._get_playlist
+        self._fetch_segment = fetch_segment or self._get_segment
+        self.policy = policy or Config.VARIANT_POLICY
+        if self.policy not in VARIANT_POLICIES:
+            raise Exception(f"不支持的码率选择策略: {self.policy}")
+        self.max_height = max_height
+        if self.max_height is None and self.policy == "max_resolution":
+            self.max_height = Config.VARIANT_MAX_HEIGHT
+        self.measured_bandwidth = None
+
+    def select(self, variants):
+        """返回选中的码率"""
+        if not variants:
+            raise Exception("主播放列表中没有可用的码率")
+
+        candidates = variants
+        if self.max_height:
+            # 没有分辨率信息的码率不做限制
+            candidates = [
+                v for v in variants if not v["height"] or v["height"] <= self.max_height
+            ]
+            if not candidates:
+                # 所有码率都超过上限时选择分辨率最低的
+                candidates = [min(variants, key=lambda v: v["height"] or 0)]
+
+        if self.policy == "measured":
+            self.measured_bandwidth = self._measure_bandwidth(candidates[0])
+            if self.measured_bandwidth:
+                usable = self.measured_bandwidth * Config.VARIANT_BANDWIDTH_SAFETY
+                fitting = [v for v in candidates if v["bandwidth"] <= usable]
+                candidates = fitting or candidates[:1]
+
+        return candidates[-1]
+
+    def _measure_bandwidth(self, variant):
+        """下载码率的前几个分片（最多VARIANT_PROBE_MAX_BYTES字节），返回测得的带宽（bit/s）"""
+        try:
+            playlist = self._load_playlist(variant["url"])
+            count = min(len(playlist.segments), Config.VARIANT_PROBE_SEGMENTS)
+
+            total_bytes = 0
+            started = time.time()
+            for index in range(count):
+                remaining = Config.VARIANT_PROBE_MAX_BYTES - total_bytes
+                if remaining <= 0:
+                    break
+                # 字节范围分片只请求其范围，不下载整个资源
+                job = build_single_job(playlist.segments, playlist.segment_urls, index)
+                total_bytes += self._fetch_segment(
+                    job.url, job.range_header(), remaining
+                )
+            elapsed = time.time() - started
+            if not total_bytes or elapsed <= 0:
+                return None
+
+            bandwidth = total_bytes * 8 / elapsed
+            logger.info(f"测得下载带宽: {bandwidth / 1000 / 1000:.2f} Mbps")
+            return bandwidth
+        except Exception as e:
+            logger.warning(f"测量下载带宽失败，使用最高码率: {str(e)}")
+            return None
+
+    def _get_playlist(self, url):
+        with self.engine.get(url) as response:
+            if response.status_code != 200:
+                raise Exception(f"状态码: {response.status_code}")
+            return parse_playlist(response.text, url)
+
+    def _get_segment(self, url, range_header, limit):
+        headers = {"Range": range_header} if range_header else {}
+        with self.engine.get(url, stream=True, headers=headers) as response:
+            if response.status_code not in (200, 206):
+                raise Exception(f"状态码: {response.status_code}")
+            return read_probe(response, limit)
+
+
+def read_probe(response, limit, throttle=None):
+    """读取测速请求的响应，最多limit字节，返回读取的字节数"""
+    received = 0
+    for chunk in response.iter_content(chunk_size=Config.CHUNK_SIZE):
+        received += len(chunk)
+        if throttle:
+            throttle(len(chunk))
+        if received >= limit:
+            break
+    return received
@@ -0,0 +1,270 @@
+import logging
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from config import Config
+from services.retry_policy import is_host_failure
+
+logger = logging.getLogger(__name__)
+
+# 无法连接代理或代理拒绝转发，与源站无关
+_PROXY_ERRORS = (requests.exceptions.ProxyError,)
+try:
+    import aiohttp
+
+    _PROXY_ERRORS += (aiohttp.ClientProxyConnectionError,)
+except ImportError:
+    pass
+
+
+_DEFAULT_PORTS = {"http": 80, "https": 443, "socks5": 1080, "socks5h": 1080}
+SUPPORTED_SCHEMES = tuple(_DEFAULT_PORTS)
+
+
+class Proxy:
+    """一个HTTP/SOCKS代理及其健康状态、延迟和吞吐量"""
+
+    def __init__(self, url):
+        self.url = url
+        parts = urlsplit(url)
+        self.scheme = parts.scheme.lower()
+        self.address = (parts.hostname, parts.port or _DEFAULT_PORTS[self.scheme])
+        self.name = f"{self.scheme}://{parts.hostname}:{self.address[1]}"  # 不含密码
+        self.latency = None  # 健康检查的平均延迟（秒，EWMA）
+        self.throughput = None  # 平均吞吐量（字节/秒，EWMA）
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.bytes = 0
+        self.ejected_until = 0
+        self.last_check = None  # 最近一次健康检查结果
+
+    def available(self, now):
+        return now >= self.ejected_until
+
+    def snapshot(self, now):
+        return {
+            "latency": round(self.latency, 3) if self.latency else None,
+            "throughput": int(self.throughput) if self.throughput else None,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "bytes": self.bytes,
+            "ejected_for": round(max(0, self.ejected_until - now), 1),
+            "last_check": self.last_check,
+        }
+
+
+def is_proxy_error(error):
+    """判断错误是否由代理本身引起，这类错误不计入源站的熔断器"""
+    return isinstance(error, _PROXY_ERRORS)
+
+
+def parse_proxies(value):
+    """解析代理列表（列表或按行分隔的字符串），格式错误时抛出异常"""
+    if isinstance(value, str):
+        value = value.splitlines()
+    if not isinstance(value, list):
+        raise Exception("代理列表格式错误")
+    proxies = []
+    for entry in value:
+        entry = str(entry).strip()
+        if not entry:
+            continue
+        parts = urlsplit(entry)
+        if parts.scheme.lower() not in SUPPORTED_SCHEMES or not parts.hostname:
+            raise Exception(f"不支持的代理地址: {entry}")
+        if entry not in proxies:
+            proxies.append(entry)
+    return proxies
+
+
+class ProxyPool:
+    """代理池，所有任务共享
+
+    每次请求按代理的吞吐量（没有数据时按健康检查延迟）加权随机选择，
+    并按正在进行的请求数分摊，带宽分散到所有健康的代理上；连续失败的代理暂时剔除，
+    后台健康检查通过后恢复使用。没有配置代理时直接连接。
+    """
+
+    def __init__(self):
+        self.proxies = []
+        self._lock = threading.Lock()
+        self._checker = None
+        self._wakeup = threading.Event()
+
+    def configure(self, urls):
+        """更新代理列表，保留仍在列表中的代理的统计数据"""
+        with self._lock:
+            existing = {p.url: p for p in self.proxies}
+            self.proxies = [existing.get(url) or Proxy(url) for url in urls]
+            start = self.proxies and self._checker is None
+            if start:
+                self._checker = threading.Thread(
+                    target=self._health_loop, name="proxy-health", daemon=True
+                )
+        if start:
+            self._checker.start()
+        self._wakeup.set()
+        logger.info(f"代理池已更新: {len(urls)} 个代理")
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def acquire(self, exclude=(), schemes=None):
+        """选择一个代理并占用，请求结束后需调用release；没有配置代理时返回None
+
+        优先使用未被剔除且不在exclude中的代理，都不可用时退回全部代理。
+        schemes限制可用的代理类型，没有符合的代理时抛出异常。
+        """
+        with self._lock:
+            proxies = self.proxies
+            if schemes:
+                proxies = [p for p in proxies if p.scheme in schemes]
+                if self.proxies and not proxies:
+                    raise Exception(f"没有可用的代理（仅支持 {'/'.join(schemes)}）")
+            if not proxies:
+                return None
+            now = time.monotonic()
+            candidates = [p for p in proxies if p not in exclude and p.available(now)]
+            if not candidates:
+                candidates = [p for p in proxies if p not in exclude] or proxies
+            weights = [
+                w / (1 + p.in_flight)
+                for p, w in zip(candidates, self._scores(candidates))
+            ]
+            proxy = random.choices(candidates, weights=weights)[0]
+            proxy.in_flight += 1
+            return proxy
+
+    def has_alternative(self, tried):
+        """是否还有没尝试过的可用代理"""
+        now = time.monotonic()
+        with self._lock:
+            return any(p not in tried and p.available(now) for p in self.proxies)
+
+    def _scores(self, candidates):
+        """吞吐量作为权重，没有吞吐量数据的代理使用平均值；都没有时按延迟倒数"""
+        known = [p.throughput for p in candidates if p.throughput]
+        if known:
+            default = sum(known) / len(known)
+            return [p.throughput or default for p in candidates]
+        latencies = [p.latency for p in candidates if p.latency]
+        default = sum(latencies) / len(latencies) if latencies else 1.0
+        return [1.0 / max(p.latency or default, 0.001) for p in candidates]
+
+    def release(self, proxy):
+        if proxy is None:
+            return
+        with self._lock:
+            proxy.in_flight -= 1
+
+    def record_success(self, proxy, size, duration):
+        if proxy is None:
+            return
+        with self._lock:
+            proxy.requests += 1
+            proxy.bytes += size
+            proxy.consecutive_failures = 0
+            if duration > 0 and size:
+                rate = size / duration
+                alpha = Config.PROXY_EWMA_ALPHA
+                proxy.throughput = (
+                    rate
+                    if proxy.throughput is None
+                    else alpha * rate + (1 - alpha) * proxy.throughput
+                )
+
+    def record_failure(self, proxy, error):
+        """记录请求失败；源站返回的4xx等错误不计入代理的失败"""
+        if proxy is None:
+            return
+        with self._lock:
+            proxy.requests += 1
+            if is_host_failure(error):
+                self._on_failure(proxy, error)
+
+    def _on_failure(self, proxy, error):
+        proxy.failures += 1
+        proxy.consecutive_failures += 1
+        if proxy.consecutive_failures >= Config.PROXY_EJECT_FAILURES:
+            proxy.ejected_until = time.monotonic() + Config.PROXY_EJECT_SECONDS
+            proxy.consecutive_failures = 0
+            logger.warning(
+                f"代理 {proxy.name} 连续失败，暂停使用 "
+                f"{Config.PROXY_EJECT_SECONDS} 秒: {str(error)}"
+            )
+
+    def _health_loop(self):
+        while True:
+            self._wakeup.wait(Config.PROXY_HEALTH_CHECK_INTERVAL)
+            self._wakeup.clear()
+            with self._lock:
+                proxies = list(self.proxies)
+            for proxy in proxies:
+                self.check(proxy)
+
+    def check(self, proxy):
+        """健康检查：连接代理（配置了PROXY_HEALTH_CHECK_URL时经由代理请求该地址）"""
+        started = time.monotonic()
+        try:
+            if Config.PROXY_HEALTH_CHECK_URL:
+                from services.downloader import get_transfer_engine
+
+                with get_transfer_engine().head(
+                    Config.PROXY_HEALTH_CHECK_URL,
+                    proxy=proxy.url,
+                    timeout=Config.PROXY_HEALTH_CHECK_TIMEOUT,
+                ) as response:
+                    if response.status_code >= 500:
+                        raise Exception(f"状态码: {response.status_code}")
+            else:
+                socket.create_connection(
+                    proxy.address, timeout=Config.PROXY_HEALTH_CHECK_TIMEOUT
+                ).close()
+        except Exception as e:
+            with self._lock:
+                proxy.last_check = f"失败: {str(e)}"
+                self._on_failure(proxy, ConnectionError(str(e)))
+            logger.debug(f"代理 {proxy.name} 健康检查失败: {str(e)}")
+            return False
+        latency = time.monotonic() - started
+        with self._lock:
+            alpha = Config.PROXY_EWMA_ALPHA
+            proxy.latency = (
+                latency
+                if proxy.latency is None
+                else alpha * latency + (1 - alpha) * proxy.latency
+            )
+            proxy.last_check = "正常"
+            proxy.consecutive_failures = 0
+            if proxy.ejected_until:
+                proxy.ejected_until = 0
+                logger.info(f"代理 {proxy.name} 健康检查通过，恢复使用")
+        return True
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {p.name: p.snapshot(now) for p in self.proxies}
+
+
+_proxy_pool = None
+_proxy_pool_lock = threading.Lock()
+
+
+def get_proxy_pool():
+    """获取进程内共享的代理池，首次调用时按Config.PROXIES初始化"""
+    global _proxy_pool
+    with _proxy_pool_lock:
+        if _proxy_pool is None:
+            _proxy_pool = ProxyPool()
+            if Config.PROXIES:
+                _proxy_pool.configure(parse_proxies(Config.PROXIES))
+        return _proxy_pool
@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class TokenBucket:
+    """令牌桶，rate为每秒字节数，0表示不限速
+
+    reserve(n)立即扣除n个令牌并返回需要等待的秒数（令牌可以为负，即预支），
+    调用方自行sleep，因此同步线程和asyncio都可以使用；先预约的请求先获得带宽。
+    """
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = 0
+        self.burst = 0
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self._refill()
+            self.rate = max(0, rate or 0)
+            # 默认允许突发约0.25秒的流量
+            self.burst = burst or max(self.rate * Config.RATE_LIMIT_BURST, 64 * 1024)
+            self._tokens = min(self._tokens, self.burst)
+
+    def reserve(self, n):
+        if not self.rate:
+            return 0
+        with self._lock:
+            self._refill()
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+        self._updated = now
+
+
+class RateShare:
+    """单个任务的带宽份额：weight为全局限速下的权重，cap为任务自身的速度上限（字节/秒）"""
+
+    def __init__(self, weight=1.0, cap=0):
+        self.weight = max(float(weight or 1.0), 0.01)
+        self.cap = max(0, cap or 0)
+        self.bucket = TokenBucket()
+        self.rate = 0  # 当前生效的速度限制，0表示不限速
+        self.bytes = 0
+
+    def snapshot(self):
+        return {
+            "weight": self.weight,
+            "cap": self.cap / MB if self.cap else 0,
+            "rate": self.rate / MB if self.rate else 0,
+            "bytes": self.bytes,
+        }
+
+
+class RateLimiter:
+    """进程内共享的带宽限制器
+
+    所有分片读取都从全局令牌桶（Config.SPEED_LIMIT）中取令牌；
+    多个任务同时下载时按权重分配全局带宽，任务的cap再单独限制。
+    限速值每次取令牌时读取，修改配置后立即对正在下载的任务生效。
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket()
+        self._shares = set()
+        self._lock = threading.Lock()
+        self._global_rate = None
+        self._last_rebalance = 0
+
+    def register(self, share):
+        with self._lock:
+            self._shares.add(share)
+            self._last_rebalance = 0
+
+    def unregister(self, share):
+        with self._lock:
+            self._shares.discard(share)
+            self._last_rebalance = 0
+
+    def update_share(self, share, weight=None, cap=None):
+        """运行时修改任务的权重或速度上限"""
+        with self._lock:
+            if weight is not None:
+                share.weight = max(float(weight), 0.01)
+            if cap is not None:
+                share.cap = max(0, cap)
+            self._last_rebalance = 0
+
+    def reserve(self, share, n):
+        """预约n字节的带宽，返回需要等待的秒数"""
+        self._rebalance()
+        if share is not None:
+            share.bytes += n
+            delay = share.bucket.reserve(n)
+        else:
+            delay = 0
+        return max(delay, self.global_bucket.reserve(n))
+
+    def _rebalance(self):
+        """全局限速或任务份额变化时重新计算各任务的速度限制"""
+        global_rate = Config.SPEED_LIMIT
+        now = time.monotonic()
+        if global_rate == self._global_rate and now - self._last_rebalance < 1.0:
+            return
+        with self._lock:
+            if global_rate != self._global_rate:
+                self.global_bucket.set_rate(global_rate)
+                self._global_rate = global_rate
+                logger.info(f"全局下载限速: {global_rate / MB:.2f} MB/s")
+            total_weight = sum(share.weight for share in self._shares) or 1
+            for share in self._shares:
+                rate = global_rate * share.weight / total_weight if global_rate else 0
+                if share.cap:
+                    rate = min(rate, share.cap) if rate else share.cap
+                if rate != share.rate:
+                    share.rate = rate
+                    share.bucket.set_rate(rate)
+            self._last_rebalance = now
+
+    def get_stats(self):
+        self._rebalance()
+        with self._lock:
+            return {
+                "speed_limit": self._global_rate / MB if self._global_rate else 0,
+                "tasks": len(self._shares),
+            }
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """获取进程内共享的带宽限制器"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILENAME = "journal.jsonl"
+
+
+def playlist_fingerprint(segment_urls, segments):
+    """根据分片地址和字节范围计算播放列表指纹，播放列表变化后旧记录失效"""
+    digest = hashlib.sha1()
+    for url, segment in zip(segment_urls, segments):
+        digest.update(url.encode("utf-8"))
+        digest.update(str(segment.byterange or "").encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+class ResumeJournal:
+    """任务目录下的断点续传日志（temp/<task_id>/journal.jsonl）
+
+    第一行记录播放列表指纹，之后每完成一个写入分片包的分片追加一行（序号、大小）；
+    流式合并时还记录已按顺序合并到输出文件的分片数及输出文件大小。只追加写入，进程崩溃时最多丢失最后一行未写完的记录，读取时忽略损坏的行。
+    日志每隔JOURNAL_SYNC_INTERVAL同步到磁盘，同步前先同步记录所引用的数据（分片包、合并输出），
+    断电后日志中的记录不会指向未落盘的数据。
+    """
+
+    def __init__(self, task_dir):
+        self.path = os.path.join(task_dir, JOURNAL_FILENAME)
+        self._file = None
+        self._lock = threading.Lock()
+        self._last_sync = 0
+        self._torn = False
+        self._sync_hooks = []  # 日志同步前调用，先同步日志引用的数据
+        self.merged = (0, 0)  # 流式合并进度：(已合并的分片数, 输出文件大小)
+
+    def open(self, fingerprint, pack):
+        """打开日志，返回已完成且在分片包（services.segment_pack.SegmentPack）中大小一致的分片 {序号: 大小}"""
+        completed = {}
+        header = None
+        self.merged = (0, 0)
+        if os.path.exists(self.path):
+            header, records = self._read()
+            if header and header.get("fingerprint") == fingerprint:
+                self.merged = self._merged
+                for index, record in records.items():
+                    if index < pack.count and pack.size(index) == record.get("size"):
+                        completed[index] = record["size"]
+            else:
+                logger.info("播放列表已变化，断点续传记录失效")
+                header = None
+
+        if header is None:
+            # 新建日志
+            self._torn = False
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(
+                    json.dumps({"type": "playlist", "fingerprint": fingerprint}) + "\n"
+                )
+        self._sync_hooks = [pack.sync]
+        self._file = open(self.path, "a", encoding="utf-8")
+        if self._torn:
+            # 补齐上次崩溃时写了一半的行，避免与新记录连在一起
+            self._file.write("\n")
+        return completed
+
+    def add_sync(self, sync):
+        """注册在日志同步到磁盘之前调用的函数（如流式合并输出文件的同步）"""
+        with self._lock:
+            self._sync_hooks.append(sync)
+
+    def record(self, index, size):
+        """记录一个已完成的分片"""
+        self._write_line({"type": "segment", "index": index, "size": size})
+
+    def record_merged(self, count, size):
+        """记录流式合并进度：前count个分片已合并，输出文件大小为size"""
+        if self._file is None:
+            return
+        self._write_line({"type": "merged", "count": count, "size": size})
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        """任务完成后删除日志"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _write_line(self, entry):
+        line = json.dumps(entry)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+            # 定期同步到磁盘，避免每个分片都fsync
+            now = time.time()
+            if now - self._last_sync >= Config.JOURNAL_SYNC_INTERVAL:
+                self._sync()
+                self._last_sync = now
+
+    def _sync(self):
+        for sync in self._sync_hooks:
+            sync()
+        os.fsync(self._file.fileno())
+
+    def _read(self):
+        header = None
+        records = {}
+        self._merged = (0, 0)
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                self._torn = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时写了一半的行
+                if entry.get("type") == "playlist":
+                    header = entry
+                elif entry.get("type") == "segment":
+                    records[entry["index"]] = entry
+                elif entry.get("type") == "merged":
+                    self._merged = (entry["count"], entry["size"])
+        return header, records
@@ -0,0 +1,277 @@
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from config import Config
+from services.downloader import HTTPStatusError
+
+logger = logging.getLogger(__name__)
+
+# 网络层错误（连接失败、超时、连接中断），说明主机可能不可用
+_NETWORK_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+try:
+    import aiohttp
+
+    _NETWORK_ERRORS += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+except ImportError:
+    pass
+try:
+    import httpx
+
+    _NETWORK_ERRORS += (httpx.TransportError,)
+except ImportError:
+    pass
+
+# 可以重试的4xx状态码，其它4xx重试也不会成功
+RETRYABLE_CLIENT_STATUS = {408, 425, 429}
+
+
+class CircuitOpenError(Exception):
+    """主机熔断中，请求直接失败"""
+
+
+def is_retryable(error):
+    """判断错误是否值得重试"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, HTTPStatusError):
+        return error.status_code >= 500 or error.status_code in RETRYABLE_CLIENT_STATUS
+    return True
+
+
+def is_host_failure(error):
+    """判断错误是否说明主机故障（5xx或网络错误），4xx等错误说明主机仍在响应"""
+    if isinstance(error, HTTPStatusError):
+        return error.status_code >= 500
+    return isinstance(error, _NETWORK_ERRORS)
+
+
+def backoff_delay(attempt):
+    """第attempt次重试前的等待时间：指数退避加全抖动"""
+    ceiling = min(Config.RETRY_MAX_DELAY, Config.RETRY_BASE_DELAY * 2**attempt)
+    return random.uniform(0, ceiling)
+
+
+class RetryBudget:
+    """任务级重试预算
+
+    重试次数不超过 RETRY_BUDGET_MIN + 已发请求数 * RETRY_BUDGET_RATIO，
+    大量分片同时失败时不会让重试请求成倍增加。
+    """
+
+    def __init__(self, ratio=None, minimum=None):
+        self.ratio = Config.RETRY_BUDGET_RATIO if ratio is None else ratio
+        self.minimum = Config.RETRY_BUDGET_MIN if minimum is None else minimum
+        self.requests = 0
+        self.retries = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def on_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def try_retry(self):
+        """预算充足时记录一次重试并返回True"""
+        with self._lock:
+            if self.retries >= self.minimum + self.requests * self.ratio:
+                self.exhausted += 1
+                return False
+            self.retries += 1
+            return True
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "budget": int(self.minimum + self.requests * self.ratio),
+                "exhausted": self.exhausted,
+            }
+
+
+class CircuitBreaker:
+    """单个主机的熔断器，所有任务共享
+
+    连续CIRCUIT_FAILURE_THRESHOLD次主机故障后熔断，冷却期内请求直接失败；
+    冷却结束后只放行一个探测请求，成功则恢复，失败则冷却时间加倍（不超过CIRCUIT_MAX_COOLDOWN）。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, host):
+        self.host = host
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self.cooldown = Config.CIRCUIT_COOLDOWN
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        """检查是否允许发出请求，熔断中时抛出CircuitOpenError"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at >= self.cooldown:
+                    self.state = self.HALF_OPEN
+                    self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True  # 放行一个探测请求
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"主机 {self.host} 暂时不可用（熔断中）")
+
+    def is_open(self):
+        """是否处于熔断冷却期（不改变状态）"""
+        with self._lock:
+            return (
+                self.state == self.OPEN
+                and time.monotonic() - self._opened_at < self.cooldown
+            )
+
+    def on_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"主机 {self.host} 恢复，熔断结束")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.cooldown = Config.CIRCUIT_COOLDOWN
+            self._probing = False
+
+    def on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                # 探测失败，延长冷却时间
+                self.cooldown = min(self.cooldown * 2, Config.CIRCUIT_MAX_COOLDOWN)
+                self._open()
+            elif (
+                self.state == self.CLOSED
+                and self.failures >= Config.CIRCUIT_FAILURE_THRESHOLD
+            ):
+                self._open()
+
+    def record(self, error):
+        """根据请求结果更新状态，error为None表示成功"""
+        if error is None or not is_host_failure(error):
+            self.on_success()
+        else:
+            self.on_failure()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened += 1
+        self._opened_at = time.monotonic()
+        self._probing = False
+        logger.warning(
+            f"主机 {self.host} 连续失败 {self.failures} 次，熔断 {self.cooldown:.0f} 秒"
+        )
+
+    def snapshot(self):
+        with self._lock:
+            retry_in = 0
+            if self.state == self.OPEN:
+                retry_in = max(0, self.cooldown - (time.monotonic() - self._opened_at))
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "retry_in": round(retry_in, 1),
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(url):
+    """获取URL所属主机的熔断器"""
+    host = urlsplit(url).netloc
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host)
+            _breakers[host] = breaker
+        return breaker
+
+
+def get_breaker_stats():
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {host: b.snapshot() for host, b in breakers.items()}
+
+
+def call_with_retry(
+    func, url, budget=None, cancel_event=None, what="请求", mirrors=None
+):
+    """按统一的重试策略调用func(地址)，用于播放列表、密钥等一次性请求
+
+    指定mirrors（services.mirrors.MirrorSet）时每次尝试选择一个镜像，失败后换用其它镜像。
+    func返回响应内容或读取的字节数，用于记录镜像的传输速度。
+    """
+    attempt = 0
+    tried = set()
+    while True:
+        mirror, target = mirrors.pick(url, exclude=tried) if mirrors else (None, url)
+        breaker = get_circuit_breaker(target)
+        try:
+            breaker.check()
+        except CircuitOpenError:
+            if mirror is None or not mirrors.has_alternative(url, tried | {mirror}):
+                raise
+            tried.add(mirror)
+            continue
+        if budget:
+            budget.on_request()
+        started = time.time()
+        try:
+            result = func(target)
+        except Exception as e:
+            breaker.record(e)
+            failover = False
+            if mirror is not None:
+                mirrors.record_failure(mirror, e)
+                tried.add(mirror)
+                failover = mirrors.has_alternative(url, tried)
+            attempt += 1
+            if (
+                not (is_retryable(e) or failover)
+                or attempt >= Config.RETRY_MAX_ATTEMPTS
+                or (budget and not budget.try_retry())
+            ):
+                raise
+            if failover:
+                delay = 0  # 换用其它镜像时立即重试
+            else:
+                delay = getattr(e, "retry_after", None) or backoff_delay(attempt)
+            logger.warning(
+                f"{what}失败 (尝试 {attempt}/{Config.RETRY_MAX_ATTEMPTS})，"
+                f"{delay:.1f}秒后重试: {target}, error={str(e)}"
+            )
+            if cancel_event:
+                if cancel_event.wait(delay):
+                    raise Exception("下载已取消")
+            else:
+                time.sleep(delay)
+            continue
+        breaker.record(None)
+        if mirror is not None:
+            size = result if isinstance(result, int) else len(result)
+            mirrors.record_success(mirror, size, time.time() - started)
+        return result
@@ -0,0 +1,228 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from services.segment_jobs import parse_byterange
+
+logger = logging.getLogger(__name__)
+
+
+def segment_cache_keys(segments, segment_urls, segment_keys):
+    """计算每个分片的缓存键：分片地址、字节范围及密钥/IV的sha256
+
+    缓存中保存解密后的数据，密钥或IV不同的分片不共用缓存。
+    """
+    keys = []
+    previous = None  # (url, 上一个字节范围的结束位置)
+    for segment, url, (key, iv) in zip(segments, segment_urls, segment_keys):
+        digest = hashlib.sha256(url.encode("utf-8"))
+        if segment.byterange:
+            length, offset = parse_byterange(segment.byterange)
+            if offset is None:
+                offset = previous[1] if previous and previous[0] == url else 0
+            previous = (url, offset + length)
+            digest.update(f"\n{offset}-{length}".encode("utf-8"))
+        else:
+            previous = None
+        if key:
+            digest.update(b"\n" + key + b"\n" + (iv or b""))
+        keys.append(digest.hexdigest())
+    return keys
+
+
+class SegmentCache:
+    """按内容寻址的分片缓存，所有任务共享
+
+    校验通过的分片（解密后）以缓存键为文件名保存在SEGMENT_CACHE_DIR中，
+    其它任务下载同一分片时直接从缓存复制到分片包或合并缓冲区；
+    支持的文件系统（如Btrfs/XFS）上copy_file_range以reflink方式共享数据块。
+    总大小超过SEGMENT_CACHE_MAX_BYTES时按最近最少使用的顺序删除。
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # 缓存键 -> 文件大小，按使用顺序排列
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.stored = 0
+        self.evicted = 0
+        self._writer = None  # 后台保存分片的线程，下载线程不等待写缓存
+        if max_bytes > 0:
+            self._scan()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _scan(self):
+        """启动时加载已有的缓存文件，按修改时间恢复使用顺序"""
+        files = []
+        if os.path.isdir(self.directory):
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    path = os.path.join(root, name)
+                    if name.endswith(".tmp"):
+                        os.remove(path)  # 上次写了一半的文件
+                        continue
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, name, stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._total += size
+        self._evict()
+        if files:
+            logger.info(
+                f"分片缓存: {len(self._entries)} 个分片，{self._total // 1024 // 1024}MB"
+            )
+
+    def probe(self, key):
+        """缓存中是否有该分片，未命中时计入统计"""
+        with self._lock:
+            if key in self._entries:
+                return True
+            self.misses += 1
+            return False
+
+    def load(self, key, target):
+        """把缓存的分片复制到target（PackSegment或MemorySegment），返回大小；已被删除时返回None"""
+        path = self._path(key)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total -= size
+                self.misses += 1
+            return None
+        try:
+            size = os.fstat(fd).st_size
+            target.copy_from(fd, size)
+        finally:
+            os.close(fd)
+        os.utime(path)  # 记录使用时间，重启后恢复使用顺序
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += size
+        return size
+
+    def store(self, key, write):
+        """保存一个分片，write(f)把分片数据写入打开的文件"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, "wb") as f:
+                write(f)
+                size = f.tell()
+            if size == 0 or size > self.max_bytes:
+                os.remove(temp_path)
+                return
+            os.replace(temp_path, path)
+        except Exception as e:
+            logger.warning(f"保存分片缓存失败: {str(e)}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total -= previous
+            self._entries[key] = size
+            self._total += size
+            self.stored += 1
+            self._evict()
+
+    def submit_store(self, key, write, done=None):
+        """在后台线程中保存分片，保存结束（含失败和取消）后调用done，返回Future"""
+
+        def run():
+            try:
+                self.store(key, write)
+            finally:
+                if done:
+                    done()
+
+        def cancelled(future):
+            if future.cancelled() and done:
+                done()
+
+        with self._lock:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="segment-cache"
+                )
+            future = self._writer.submit(run)
+        future.add_done_callback(cancelled)
+        return future
+
+    def discard(self, key):
+        """删除一个分片（如校验失败的缓存数据）"""
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is None:
+                return
+            self._total -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._total > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total -= size
+            self.evicted += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0,
+                "bytes_saved": self.bytes_saved,
+                "stored": self.stored,
+                "evicted": self.evicted,
+            }
+
+
+_segment_cache = None
+_segment_cache_lock = threading.Lock()
+
+
+def get_segment_cache():
+    """获取进程内共享的分片缓存"""
+    global _segment_cache
+    with _segment_cache_lock:
+        if _segment_cache is None:
+            _segment_cache = SegmentCache(
+                Config.SEGMENT_CACHE_DIR, Config.SEGMENT_CACHE_MAX_BYTES
+            )
+        return _segment_cache
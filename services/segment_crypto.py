@@ -0,0 +1,64 @@
+from Crypto.Cipher import AES
+
+BLOCK_SIZE = AES.block_size
+
+
+def unpad(data):
+    """去除PKCS7填充"""
+    if not data:
+        return data
+    padding_len = data[-1]
+    if padding_len < 1 or padding_len > BLOCK_SIZE:
+        return data
+    for i in range(padding_len):
+        if data[-i - 1] != padding_len:
+            return data
+    return data[:-padding_len]
+
+
+def parse_iv(iv):
+    """解析EXT-X-KEY中的IV（十六进制字符串，可带0x前缀）"""
+    if isinstance(iv, str):
+        iv_str = iv.lower().replace("0x", "")
+        iv_str = iv_str.zfill(32)
+        return bytes.fromhex(iv_str)
+    return iv
+
+
+def segment_iv(iv, media_sequence, index):
+    """分片的IV：EXT-X-KEY未指定IV时使用分片的媒体序列号（大端16字节）"""
+    if iv:
+        return parse_iv(iv)
+    return ((media_sequence or 0) + index).to_bytes(16, "big")
+
+
+class StreamDecryptor:
+    """AES-128-CBC流式解密
+
+    数据到达时立即解密完整的分组，始终保留最后一个分组，
+    直到finalize时才解密并去除PKCS7填充，内存占用与分片大小无关。
+    """
+
+    def __init__(self, key, iv):
+        self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        self._buffer = b""
+
+    def update(self, data):
+        """输入密文，返回可以写入的明文"""
+        self._buffer += data
+        # 保留最后一个完整分组及不足一个分组的尾部
+        keep = BLOCK_SIZE + len(self._buffer) % BLOCK_SIZE
+        if len(self._buffer) <= keep:
+            return b""
+        ready = len(self._buffer) - keep
+        plaintext = self._cipher.decrypt(self._buffer[:ready])
+        self._buffer = self._buffer[ready:]
+        return plaintext
+
+    def finalize(self):
+        """解密最后一个分组并去除填充"""
+        if len(self._buffer) % BLOCK_SIZE != 0:
+            raise Exception(f"密文长度不是{BLOCK_SIZE}字节的整数倍")
+        plaintext = self._cipher.decrypt(self._buffer) if self._buffer else b""
+        self._buffer = b""
+        return unpad(plaintext)
@@ -0,0 +1,184 @@
+class SegmentPart:
+    """任务中的一个分片，offset为分片在任务响应数据中的偏移"""
+
+    __slots__ = ("index", "offset", "length")
+
+    def __init__(self, index, offset=0, length=None):
+        self.index = index
+        self.offset = offset
+        self.length = length
+
+
+class SegmentJob:
+    """一次HTTP请求：一个完整的分片，或若干相邻字节范围分片合并后的一段范围"""
+
+    def __init__(self, url, start=None):
+        self.url = url
+        self.start = start
+        self.length = 0
+        self.parts = []
+        self.cached = False  # 分片在共享分片缓存中，从缓存导入
+
+    @property
+    def end(self):
+        return self.start + self.length
+
+    @property
+    def indexes(self):
+        return [part.index for part in self.parts]
+
+    def range_header(self):
+        """返回Range请求头的值，完整分片返回None"""
+        if self.start is None:
+            return None
+        return f"bytes={self.start}-{self.end - 1}"
+
+    def add_part(self, index, length=None):
+        self.parts.append(SegmentPart(index, self.length, length))
+        if length:
+            self.length += length
+
+
+def parse_byterange(value):
+    """解析EXT-X-BYTERANGE的值"<长度>[@<偏移>]"，返回(长度, 偏移或None)"""
+    length, _, offset = str(value).partition("@")
+    return int(length), int(offset) if offset else None
+
+
+def build_segment_jobs(segments, segment_urls, coalesce_size=0, skip=None):
+    """把分片列表转换为下载任务
+
+    带EXT-X-BYTERANGE的分片按字节范围下载；同一URI上首尾相接的范围合并为一次Range请求，
+    单次请求的大小不超过coalesce_size（0表示不合并）。skip中的分片（如已完成的分片）不下载。
+    """
+    jobs = []
+    previous = None  # (url, 上一个字节范围的结束位置)
+    current = None
+    for index, segment in enumerate(segments):
+        url = segment_urls[index]
+        if not segment.byterange:
+            if skip and index in skip:
+                previous = current = None
+                continue
+            jobs.append(SegmentJob(url))
+            jobs[-1].add_part(index)
+            previous = current = None
+            continue
+
+        length, offset = parse_byterange(segment.byterange)
+        if offset is None:
+            # 未指定偏移时紧接同一资源上一个分片的范围
+            offset = previous[1] if previous and previous[0] == url else 0
+        previous = (url, offset + length)
+
+        if skip and index in skip:
+            current = None
+            continue
+
+        if (
+            current is not None
+            and current.url == url
+            and current.end == offset
+            and current.length + length <= coalesce_size
+        ):
+            current.add_part(index, length)
+            continue
+
+        current = SegmentJob(url, offset)
+        current.add_part(index, length)
+        jobs.append(current)
+
+    return jobs
+
+
+def build_single_job(segments, segment_urls, index):
+    """生成只下载一个分片的任务
+
+    字节范围未指定偏移时，向前查找同一资源上相邻的分片直到遇到明确的偏移，
+    只访问该分片之前连续的一段字节范围分片，不需要重新生成全部任务。
+    """
+    url = segment_urls[index]
+    byterange = segments[index].byterange
+    if not byterange:
+        job = SegmentJob(url)
+        job.add_part(index)
+        return job
+
+    length, offset = parse_byterange(byterange)
+    start = 0
+    previous = index
+    while offset is None:
+        previous -= 1
+        if (
+            previous < 0
+            or not segments[previous].byterange
+            or segment_urls[previous] != url
+        ):
+            offset = 0
+            break
+        previous_length, offset = parse_byterange(segments[previous].byterange)
+        start += previous_length
+    job = SegmentJob(url, start + offset)
+    job.add_part(index, length)
+    return job
+
+
+class JobSplitter:
+    """按分片边界切分一次请求的响应数据，分别写入各分片的输出"""
+
+    def __init__(self, job, open_sink, skip=0):
+        self.job = job
+        self._open_sink = open_sink
+        self._parts = iter(job.parts)
+        self._skip = skip  # 服务器忽略Range时需要跳过的字节数
+        self._part = None
+        self._sink = None
+        self._remaining = None
+        self.results = []  # [(分片序号, 分片大小)]
+
+    def feed(self, data):
+        """写入一块响应数据，任务的所有分片都已收齐时返回True"""
+        view = memoryview(data)
+        if self._skip:
+            skipped = min(self._skip, len(view))
+            self._skip -= skipped
+            view = view[skipped:]
+
+        while view:
+            if self._sink is None:
+                self._part = next(self._parts, None)
+                if self._part is None:
+                    return True  # 超出任务范围的数据直接丢弃
+                self._sink = self._open_sink(self._part)
+                self._remaining = self._part.length
+
+            if self._remaining is None:
+                self._sink.feed(bytes(view))
+                return False
+
+            size = min(len(view), self._remaining)
+            self._sink.feed(bytes(view[:size]))
+            self._remaining -= size
+            view = view[size:]
+            if self._remaining == 0:
+                self._finish_part()
+        return self._sink is None and len(self.results) == len(self.job.parts)
+
+    def close(self):
+        """结束当前分片并检查所有分片是否完整，返回各分片的大小"""
+        if self._sink is not None:
+            if self._remaining:
+                raise Exception(f"分片数据不完整，缺少 {self._remaining} 字节")
+            self._finish_part()
+        if len(self.results) != len(self.job.parts):
+            raise Exception("响应数据不完整")
+        return self.results
+
+    def abort(self):
+        if self._sink is not None:
+            self._sink.abort()
+            self._sink = None
+
+    def _finish_part(self):
+        sink, self._sink = self._sink, None
+        self.results.append((self._part.index, sink.close()))
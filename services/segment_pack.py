@@ -0,0 +1,374 @@
+import heapq
+import io
+import logging
+import os
+import struct
+import threading
+from array import array
+
+from config import Config
+from services.fileops import append_range, copy_range
+
+logger = logging.getLogger(__name__)
+
+# 只同步数据（不含访问时间等元数据），不支持的系统使用fsync
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+PACK_FILENAME = "segments.pack"
+INDEX_FILENAME = "segments.idx"
+
+# 索引记录：分片序号、分片大小、块数，之后是块号数组
+_RECORD = struct.Struct("<IQI")
+_RELEASED = 0xFFFFFFFFFFFFFFFF  # 分片已合并，块已释放
+
+
+class PackSegment:
+    """分片包中的一个分片，下载流水线按偏移写入，块在写入时按需分配"""
+
+    def __init__(self, pack, index):
+        self._pack = pack
+        self.index = index
+        self.blocks = array("I")
+        self.size = 0
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def write_at(self, offset, data):
+        self._pack._write(self, offset, data)
+
+    def copy_from(self, fd, size):
+        """用文件fd开头的size字节作为分片内容（从分片缓存导入）"""
+        self._pack._copy_in(self, fd, size)
+
+    def __len__(self):
+        return self.size
+
+
+class _PackReader(io.RawIOBase):
+    """按顺序读取分片包中一个分片的数据"""
+
+    def __init__(self, pack, segment):
+        self._pack = pack
+        self._segment = segment
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._segment.size
+        self._pos = max(0, pos)
+        return self._pos
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._segment.size - self._pos)
+        if size <= 0:
+            return 0
+        block_size = self._pack.block_size
+        block, skip = divmod(self._pos, block_size)
+        size = min(size, block_size - skip)  # 每次最多读到块尾
+        offset = self._segment.blocks[block] * block_size + skip
+        data = os.pread(self._pack.fd, size, offset)
+        buffer[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+class SegmentPack:
+    """任务的分片包文件（temp/<task_id>/segments.pack）
+
+    所有分片写入同一个文件，不再为每个分片创建和删除文件。文件按PACK_BLOCK_SIZE分块，
+    分片写入时按需分配块，块号记录在紧凑的索引中；已合并的分片释放的块会被重用。
+    文件按预估大小用fallocate预分配，空间不足时按PACK_GROW_SIZE扩展。
+    已完成分片的块号追加写入索引文件（segments.idx），断点续传时恢复。
+    """
+
+    def __init__(self, task_dir, count, estimated_size=0):
+        self.path = os.path.join(task_dir, PACK_FILENAME)
+        self.index_path = os.path.join(task_dir, INDEX_FILENAME)
+        self.count = count
+        self.block_size = Config.PACK_BLOCK_SIZE
+        self._lock = threading.Lock()
+        self._segments = [None] * count  # 已完成的分片
+        self._writing = {}  # 序号 -> 正在写入的PackSegment
+        self._pinned = {}  # 序号 -> 正在读取该分片的次数（如保存到分片缓存）
+        self._deferred = set()  # 读取结束后再释放的分片
+        self._free = []  # 可重用的块号（最小堆，优先使用文件前部的块）
+        self._next_block = 0
+        self._sync_lock = threading.Lock()  # 同步与关闭互斥
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._allocated = os.fstat(self.fd).st_size
+        self._load_index()
+        self._index = open(self.index_path, "ab")
+        self._reserve(estimated_size)
+
+    def _load_index(self):
+        """读取索引文件恢复已完成的分片，并重写为只包含有效记录的紧凑索引"""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            pos = 0
+            while pos + _RECORD.size <= len(data):
+                index, size, count = _RECORD.unpack_from(data, pos)
+                end = pos + _RECORD.size + count * 4
+                if end > len(data):
+                    break  # 崩溃时写了一半的记录
+                blocks = array("I", data[pos + _RECORD.size : end])
+                pos = end
+                if index >= self.count:
+                    continue
+                if size == _RELEASED:
+                    self._segments[index] = None
+                    continue
+                segment = PackSegment(self, index)
+                segment.blocks = blocks
+                segment.size = size
+                segment.closed = True
+                self._segments[index] = segment
+
+        used = set()
+        for index, segment in enumerate(self._segments):
+            if segment is None:
+                continue
+            end = max(segment.blocks, default=-1) + 1
+            if end * self.block_size > self._allocated or used.intersection(
+                segment.blocks
+            ):
+                self._segments[index] = None  # 数据不在文件中
+                continue
+            used.update(segment.blocks)
+        self._next_block = max(used, default=-1) + 1
+        self._free = [b for b in range(self._next_block) if b not in used]
+        heapq.heapify(self._free)
+
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            for segment in self._segments:
+                if segment is not None:
+                    f.write(self._encode(segment.index, segment.size, segment.blocks))
+        os.replace(temp_path, self.index_path)
+        if used:
+            logger.info(
+                f"分片包: 恢复 {sum(s is not None for s in self._segments)} 个分片，"
+                f"{len(used)} 个块"
+            )
+
+    @staticmethod
+    def _encode(index, size, blocks):
+        return _RECORD.pack(index, size, len(blocks)) + blocks.tobytes()
+
+    def _reserve(self, size):
+        """确保包文件至少预分配size字节"""
+        if size <= self._allocated:
+            return
+        # 按当前大小倍增，每次最多扩展PACK_GROW_SIZE
+        grow = min(max(self._allocated, 16 * self.block_size), Config.PACK_GROW_SIZE)
+        size = max(size, self._allocated + grow)
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, self._allocated, size - self._allocated)
+            except OSError as e:
+                # 文件系统不支持预分配时由写入自动扩展文件
+                logger.debug(f"分片包预分配失败: {str(e)}")
+        self._allocated = size
+
+    def _allocate_block(self):
+        if self._free:
+            return heapq.heappop(self._free)
+        block = self._next_block
+        self._next_block += 1
+        self._reserve(self._next_block * self.block_size)
+        return block
+
+    def _free_blocks(self, blocks):
+        for block in blocks:
+            heapq.heappush(self._free, block)
+
+    def open(self, index):
+        """开始写入一个分片，丢弃该分片之前写入或完成的数据"""
+        segment = PackSegment(self, index)
+        with self._lock:
+            previous = [self._writing.pop(index, None), self._segments[index]]
+            self._segments[index] = None
+            self._writing[index] = segment
+        for old in previous:
+            if old is None:
+                continue
+            # 等待正在进行的写入结束后再释放块，之后对旧分片的写入直接丢弃
+            with old._lock:
+                old.closed = True
+                with self._lock:
+                    self._free_blocks(old.blocks)
+        return segment
+
+    def _write(self, segment, offset, data):
+        block_size = self.block_size
+        with segment._lock:
+            if segment.closed:
+                return
+            end = offset + len(data)
+            last = (end - 1) // block_size
+            if last >= len(segment.blocks):
+                with self._lock:
+                    while len(segment.blocks) <= last:
+                        segment.blocks.append(self._allocate_block())
+            view = memoryview(data)
+            while view:
+                block, skip = divmod(offset, block_size)
+                size = min(len(view), block_size - skip)
+                os.pwrite(
+                    self.fd, view[:size], segment.blocks[block] * block_size + skip
+                )
+                view = view[size:]
+                offset += size
+            segment.size = max(segment.size, end)
+
+    def _copy_in(self, segment, fd, size):
+        """把文件内容复制到分片的块中，连续的块一次复制；支持的文件系统上共享数据块"""
+        block_size = self.block_size
+        with segment._lock:
+            if segment.closed:
+                return
+            count = -(-size // block_size)
+            with self._lock:
+                while len(segment.blocks) < count:
+                    segment.blocks.append(self._allocate_block())
+            blocks = segment.blocks
+            i = 0
+            while i < count:
+                j = i + 1
+                while j < count and blocks[j] == blocks[j - 1] + 1:
+                    j += 1
+                offset = i * block_size
+                length = min((j - i) * block_size, size - offset)
+                copied = copy_range(fd, offset, self.fd, blocks[i] * block_size, length)
+                if copied != length:
+                    raise Exception(f"分片 {segment.index + 1} 导入不完整")
+                i = j
+            segment.size = max(segment.size, size)
+
+    def commit(self, index):
+        """分片下载并校验完成，写入索引，返回分片大小"""
+        with self._lock:
+            segment = self._writing.pop(index, None)
+            if segment is None:
+                segment = self._segments[index]
+                return segment.size if segment else None
+            segment.closed = True
+            self._segments[index] = segment
+            self._index.write(self._encode(index, segment.size, segment.blocks))
+            self._index.flush()
+            return segment.size
+
+    def pin(self, index):
+        """在后台读取分片前调用，读取结束前release推迟执行；分片未完成时返回False"""
+        with self._lock:
+            if self._segments[index] is None:
+                return False
+            self._pinned[index] = self._pinned.get(index, 0) + 1
+            return True
+
+    def unpin(self, index):
+        with self._lock:
+            count = self._pinned.pop(index) - 1
+            if count:
+                self._pinned[index] = count
+                return
+            deferred = index in self._deferred
+            self._deferred.discard(index)
+        if deferred:
+            self.release(index)
+
+    def release(self, index):
+        """分片已合并，释放其占用的块"""
+        with self._lock:
+            if index in self._pinned:
+                self._deferred.add(index)
+                return
+            segment = self._segments[index]
+            if segment is None:
+                return
+            self._segments[index] = None
+            self._free_blocks(segment.blocks)
+            self._index.write(self._encode(index, _RELEASED, array("I")))
+            self._index.flush()
+
+    def size(self, index):
+        """已完成分片的大小，未完成时返回None"""
+        segment = self._segments[index]
+        return segment.size if segment else None
+
+    def _segment(self, index):
+        with self._lock:
+            segment = self._writing.get(index) or self._segments[index]
+        if segment is None:
+            raise Exception(f"分片 {index + 1} 不在分片包中")
+        return segment
+
+    def reader(self, index):
+        """返回读取分片数据的文件对象及分片大小，用于校验"""
+        segment = self._segment(index)
+        reader = io.BufferedReader(_PackReader(self, segment), self.block_size)
+        return reader, segment.size
+
+    def copy_to(self, index, dst):
+        """把分片追加到输出文件（或管道）dst，连续的块一次复制，返回复制的字节数"""
+        segment = self._segment(index)
+        block_size = self.block_size
+        remaining = segment.size
+        blocks = segment.blocks
+        i = 0
+        while remaining > 0:
+            # 合并块号连续的块
+            j = i + 1
+            while j < len(blocks) and blocks[j] == blocks[j - 1] + 1:
+                j += 1
+            size = min((j - i) * block_size, remaining)
+            copied = append_range(self.fd, blocks[i] * block_size, size, dst)
+            if copied != size:
+                raise Exception(f"分片 {index + 1} 数据不完整")
+            remaining -= size
+            i = j
+        return segment.size
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "blocks": self._next_block,
+                "free_blocks": len(self._free),
+                "allocated": self._allocated,
+            }
+
+    def sync(self):
+        """把分片数据和索引同步到磁盘（断点续传日志同步前调用）"""
+        with self._sync_lock:
+            if self.fd is None:
+                return
+            _datasync(self.fd)
+            with self._lock:
+                self._index.flush()
+            _datasync(self._index.fileno())
+
+    def close(self):
+        with self._sync_lock, self._lock:
+            if self.fd is None:
+                return
+            self._index.close()
+            os.close(self.fd)
+            self.fd = None
+
+    def remove(self):
+        """任务完成后删除分片包"""
+        self.close()
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,341 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from Crypto.Cipher import AES
+
+from config import Config
+from services.segment_crypto import BLOCK_SIZE, StreamDecryptor, unpad
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# 进程模式下所有任务共享的解密进程池
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=Config.PIPELINE_DECRYPT_WORKERS
+            )
+        return _process_pool
+
+
+def decrypt_chunk(key, iv, data, final=False):
+    """解密一段按分组对齐的密文，iv为前一段密文的最后一个分组"""
+    plaintext = AES.new(key, AES.MODE_CBC, iv).decrypt(data)
+    return unpad(plaintext) if final else plaintext
+
+
+class StageMetrics:
+    """流水线阶段的统计信息"""
+
+    def __init__(self, name, workers, work_queue=None):
+        self.name = name
+        self.workers = workers
+        self._queue = work_queue
+        self._lock = threading.Lock()
+        self.items = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+        self.max_queue_depth = 0
+        self.in_progress = 0
+
+    def queued(self):
+        if self._queue is not None:
+            with self._lock:
+                self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def begin(self):
+        with self._lock:
+            self.in_progress += 1
+        return time.time()
+
+    def end(self, started, size):
+        with self._lock:
+            self.in_progress -= 1
+            self.items += 1
+            self.bytes += size
+            self.busy_time += time.time() - started
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+                "max_queue_depth": self.max_queue_depth,
+                "in_progress": self.in_progress,
+                "items": self.items,
+                "bytes": self.bytes,
+                "busy_time": round(self.busy_time, 3),
+            }
+
+
+class SegmentSink:
+    """流水线中的单个分片输出
+
+    由下载线程调用feed写入密文/明文，数据按PIPELINE_CHUNK_SIZE切块后交给
+    解密队列或写盘队列；每块密文携带前一块的最后一个分组作为IV，
+    因此各块可以在不同的解密线程中并行解密，并按偏移量写入target
+    （services.segment_pack.PackSegment或services.stream_merger.MemorySegment）。
+    """
+
+    def __init__(self, pipeline, target, key=None, iv=None):
+        self._pipeline = pipeline
+        self.target = target
+        self.key = key
+        self._chain_iv = iv
+        self._buffer = bytearray()
+        self._offset = 0
+        self._received = 0
+        self._outstanding = 0
+        self._cond = threading.Condition()
+        self.error = None
+        self.aborted = False
+
+    def feed(self, data):
+        """输入下载到的数据"""
+        if self.error:
+            raise self.error
+        self._received += len(data)
+        self._buffer += data
+        if len(self._buffer) >= self._pipeline.chunk_size:
+            self._emit(final=False)
+
+    def close(self):
+        """提交剩余数据并等待写盘完成，返回下载的字节数"""
+        self._emit(final=True)
+        self._wait()
+        if self.error:
+            raise self.error
+        return self._received
+
+    def abort(self):
+        """放弃该分片，等待已提交的数据处理完"""
+        self.aborted = True
+        self._wait()
+
+    def _emit(self, final):
+        if self.key:
+            # 保留最后一个分组，去除填充只在最后一块进行
+            if final:
+                if len(self._buffer) % BLOCK_SIZE != 0:
+                    raise Exception(f"密文长度不是{BLOCK_SIZE}字节的整数倍")
+                ready = len(self._buffer)
+            else:
+                keep = BLOCK_SIZE + len(self._buffer) % BLOCK_SIZE
+                ready = len(self._buffer) - keep
+            if ready <= 0 and not final:
+                return
+            data = bytes(self._buffer[:ready])
+            del self._buffer[:ready]
+            chunk_iv = self._chain_iv
+            if data:
+                self._chain_iv = data[-BLOCK_SIZE:]
+            self._submit()
+            self._pipeline.put_decrypt((self, self._offset, chunk_iv, data, final))
+        else:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            if not data and not final:
+                return
+            self._submit()
+            self._pipeline.put_write((self, self._offset, data, final))
+        self._offset += len(data)
+
+    def _submit(self):
+        with self._cond:
+            self._outstanding += 1
+
+    def _done(self, error=None):
+        with self._cond:
+            if error and not self.error:
+                self.error = error
+            self._outstanding -= 1
+            self._cond.notify_all()
+
+    def _wait(self):
+        with self._cond:
+            while self._outstanding > 0:
+                self._cond.wait()
+
+    def _write(self, offset, data):
+        if data and not self.aborted and not self.error:
+            self.target.write_at(offset, data)
+
+
+class DirectSegmentSink:
+    """不经过流水线，在调用线程中直接解密并写入target"""
+
+    def __init__(self, target, key=None, iv=None):
+        self.target = target
+        self._decryptor = StreamDecryptor(key, iv) if key else None
+        self._offset = 0
+        self._received = 0
+
+    def feed(self, data):
+        self._received += len(data)
+        self._output(self._decryptor.update(data) if self._decryptor else data)
+
+    def close(self):
+        if self._decryptor:
+            self._output(self._decryptor.finalize())
+        return self._received
+
+    def abort(self):
+        pass
+
+    def _output(self, data):
+        if data:
+            self.target.write_at(self._offset, data)
+            self._offset += len(data)
+
+
+class SegmentPipeline:
+    """分片处理流水线：下载 -> 解密（线程/进程池）-> 写盘
+
+    各阶段之间通过有界队列连接，解密和写盘不会阻塞网络读取，
+    队列满时对上游形成背压，内存占用受队列长度和块大小限制。
+    解密线程在第一次有密文时才启动，未加密的任务只使用写盘线程。
+    """
+
+    def __init__(
+        self,
+        decrypt_workers=None,
+        write_workers=None,
+        decrypt_mode=None,
+        queue_size=None,
+        chunk_size=None,
+    ):
+        self.decrypt_workers = decrypt_workers or Config.PIPELINE_DECRYPT_WORKERS
+        self.write_workers = write_workers or Config.PIPELINE_WRITE_WORKERS
+        self.decrypt_mode = decrypt_mode or Config.PIPELINE_DECRYPT_MODE
+        self.chunk_size = chunk_size or Config.PIPELINE_CHUNK_SIZE
+        queue_size = queue_size or Config.PIPELINE_QUEUE_SIZE
+
+        self._decrypt_queue = queue.Queue(maxsize=queue_size)
+        self._write_queue = queue.Queue(maxsize=queue_size)
+        self.metrics = {
+            "decrypt": StageMetrics(
+                "decrypt", self.decrypt_workers, self._decrypt_queue
+            ),
+            "write": StageMetrics("write", self.write_workers, self._write_queue),
+        }
+
+        self._lock = threading.Lock()
+        self._write_threads = [
+            self._start_thread(self._write_loop, f"write-{i}")
+            for i in range(self.write_workers)
+        ]
+        self._decrypt_threads = []
+        logger.info(
+            f"分片流水线已启动: 解密={self.decrypt_workers}({self.decrypt_mode}), "
+            f"写盘={self.write_workers}, 队列长度={queue_size}"
+        )
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def _start_decrypt_workers(self):
+        with self._lock:
+            if not self._decrypt_threads:
+                self._decrypt_threads = [
+                    self._start_thread(self._decrypt_loop, f"decrypt-{i}")
+                    for i in range(self.decrypt_workers)
+                ]
+
+    def open_segment(self, target, key=None, iv=None):
+        """打开一个分片输出"""
+        return SegmentSink(self, target, key, iv)
+
+    def put_decrypt(self, item):
+        if not self._decrypt_threads:
+            self._start_decrypt_workers()
+        self._decrypt_queue.put(item)
+        self.metrics["decrypt"].queued()
+
+    def put_write(self, item):
+        self._write_queue.put(item)
+        self.metrics["write"].queued()
+
+    def _decrypt_loop(self):
+        metrics = self.metrics["decrypt"]
+        while True:
+            item = self._decrypt_queue.get()
+            if item is _STOP:
+                return
+            sink, offset, chunk_iv, data, final = item
+            if sink.aborted or sink.error:
+                sink._done()
+                continue
+            started = metrics.begin()
+            try:
+                if self.decrypt_mode == "process":
+                    plaintext = (
+                        _get_process_pool()
+                        .submit(decrypt_chunk, sink.key, chunk_iv, data, final)
+                        .result()
+                    )
+                else:
+                    plaintext = decrypt_chunk(sink.key, chunk_iv, data, final)
+            except Exception as e:
+                metrics.end(started, len(data))
+                sink._done(e)
+                continue
+            metrics.end(started, len(data))
+            # 解密完成的数据交给写盘阶段，计数从解密阶段转移到写盘阶段
+            self.put_write((sink, offset, plaintext, final))
+
+    def _write_loop(self):
+        metrics = self.metrics["write"]
+        while True:
+            item = self._write_queue.get()
+            if item is _STOP:
+                return
+            sink, offset, data, final = item
+            started = metrics.begin()
+            try:
+                sink._write(offset, data)
+                sink._done()
+            except Exception as e:
+                sink._done(e)
+            finally:
+                metrics.end(started, len(data))
+
+    def get_stats(self):
+        return {name: metrics.snapshot() for name, metrics in self.metrics.items()}
+
+    def close(self):
+        """停止流水线线程"""
+        with self._lock:
+            decrypt_threads, self._decrypt_threads = self._decrypt_threads, []
+        for _ in decrypt_threads:
+            self._decrypt_queue.put(_STOP)
+        for thread in decrypt_threads:
+            thread.join()
+        for _ in self._write_threads:
+            self._write_queue.put(_STOP)
+        for thread in self._write_threads:
+            thread.join()
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_segment_pipeline():
+    """获取进程内共享的分片流水线，所有任务共用解密和写盘线程"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = SegmentPipeline()
+        return _pipeline
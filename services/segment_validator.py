@@ -0,0 +1,117 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+# 分片中常见的fMP4顶层box
+FMP4_BOX_TYPES = {
+    b"ftyp",
+    b"styp",
+    b"sidx",
+    b"moof",
+    b"mdat",
+    b"moov",
+    b"emsg",
+    b"prft",
+    b"free",
+    b"skip",
+    b"uuid",
+}
+HTML_PREFIXES = (b"<!doctype", b"<html", b"<?xml", b"<head", b"<body")
+
+_validation_pool = None
+_validation_pool_lock = threading.Lock()
+
+
+def get_validation_pool():
+    """获取所有任务共享的分片校验线程池，校验不占用下载线程"""
+    global _validation_pool
+    with _validation_pool_lock:
+        if _validation_pool is None:
+            _validation_pool = ThreadPoolExecutor(
+                max_workers=Config.VALIDATION_WORKERS, thread_name_prefix="validate"
+            )
+        return _validation_pool
+
+
+def check_content_length(headers, received):
+    """检查收到的字节数与Content-Length是否一致（压缩传输时跳过）"""
+    if headers.get("Content-Encoding"):
+        return
+    content_length = headers.get("Content-Length")
+    if content_length and content_length.isdigit():
+        if received != int(content_length):
+            raise Exception(f"分片数据不完整: 收到 {received}/{content_length} 字节")
+
+
+def validate_segment(f, size):
+    """校验解密后的分片数据（f为可定位的二进制文件对象，size为分片大小），有问题时抛出异常
+
+    - 内容不能为空
+    - TS分片每188字节的包头必须是同步字节0x47
+    - fMP4分片的box大小必须首尾相接且等于文件大小
+    - 不能是CDN返回的HTML错误页面
+    无法识别的格式（如伪装成图片的分片）不做格式校验。
+    """
+    if size == 0:
+        raise Exception("分片内容为空")
+
+    head = f.read(TS_PACKET_SIZE)
+    if head[0] == TS_SYNC_BYTE:
+        f.seek(0)
+        _check_ts(f, size)
+    elif head[4:8] in FMP4_BOX_TYPES:
+        _check_fmp4(f, size)
+    elif head.lstrip().lower().startswith(HTML_PREFIXES):
+        raise Exception("分片内容是HTML页面")
+
+
+def _check_ts(f, size):
+    """只检查完整的TS包；源站填充或截断的末尾不足一个包的数据只记录日志"""
+    remainder = size % TS_PACKET_SIZE
+    if remainder:
+        logger.info(
+            f"TS分片长度 {size} 不是{TS_PACKET_SIZE}的整数倍，末尾 {remainder} 字节不校验"
+        )
+    end = size - remainder
+    block_size = TS_PACKET_SIZE * 4096
+    offset = 0
+    while offset < end:
+        block = f.read(min(block_size, end - offset))
+        if not block:
+            return
+        sync_bytes = block[::TS_PACKET_SIZE]
+        if sync_bytes.count(TS_SYNC_BYTE) != len(sync_bytes):
+            for i, value in enumerate(sync_bytes):
+                if value != TS_SYNC_BYTE:
+                    raise Exception(
+                        f"TS同步字节错误，偏移 {offset + i * TS_PACKET_SIZE}"
+                    )
+        offset += len(block)
+
+
+def _check_fmp4(f, size):
+    offset = 0
+    while offset < size:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 8:
+            raise Exception(f"fMP4 box头不完整，偏移 {offset}")
+        box_size = int.from_bytes(header[:4], "big")
+        box_type = header[4:8]
+        if not all(0x20 <= c <= 0x7E for c in box_type):
+            raise Exception(f"fMP4 box类型无效，偏移 {offset}")
+        if box_size == 1:
+            if len(header) < 16:
+                raise Exception(f"fMP4 box头不完整，偏移 {offset}")
+            box_size = int.from_bytes(header[8:16], "big")
+        elif box_size == 0:
+            box_size = size - offset  # 延伸到文件末尾
+        if box_size < 8 or offset + box_size > size:
+            raise Exception(f"fMP4 box大小无效: {box_type.decode()}，偏移 {offset}")
+        offset += box_size
@@ -0,0 +1,279 @@
+import logging
+import os
+import subprocess
+import threading
+from collections import deque
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class MemorySegment:
+    """保存在内存中的分片数据，流水线的写盘线程按偏移写入"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self._lock = threading.Lock()
+
+    def write_at(self, offset, data):
+        with self._lock:
+            end = offset + len(data)
+            if len(self.data) < end:
+                self.data.extend(bytes(end - len(self.data)))
+            self.data[offset:end] = data
+
+    def copy_from(self, fd, size):
+        """用文件fd开头的size字节作为分片内容（从分片缓存导入）"""
+        data = os.pread(fd, size, 0)
+        if len(data) != size:
+            raise Exception("分片缓存数据不完整")
+        with self._lock:
+            self.data[:] = data
+
+    def __len__(self):
+        return len(self.data)
+
+
+class StreamMerger:
+    """流式合并：下一个分片完成后立即按播放列表顺序追加到输出文件
+
+    乱序完成的分片暂存在重排缓冲区中：不超过MERGE_BUFFER_MEMORY字节的保存在内存里，
+    超出时写入分片包，合并后立即释放。下载调度只发出合并位置之后MERGE_WINDOW个分片以内的
+    请求，缓冲区大小有上限，磁盘占用约为视频大小，下载完成时合并也已完成。
+    """
+
+    def __init__(self, output_file, pack, journal=None, merged=0, offset=0):
+        self.output_file = output_file
+        self.pack = pack
+        self.total = pack.count
+        self.window = Config.MERGE_WINDOW
+        self.memory_limit = Config.MERGE_BUFFER_MEMORY
+        self.next_index = merged  # 下一个要合并的分片
+        self.error = None
+        self._journal = journal
+        self._memory = {}  # 序号 -> MemorySegment（下载中或等待合并）
+        self._ready = set()  # 已完成等待合并的分片
+        self._closed = False
+        self._cond = threading.Condition()
+        # 统计
+        self.merged_bytes = offset
+        self.memory_segments = 0
+        self.spilled_segments = 0
+        self.max_buffered = 0
+        self.max_memory = 0
+
+        self._file = self._open_output(offset)
+        self._sync_lock = threading.Lock()  # 同步与关闭输出文件互斥
+        if journal:
+            journal.add_sync(self.sync)
+        self._thread = threading.Thread(
+            target=self._merge_loop, name="stream-merge", daemon=True
+        )
+        self._thread.start()
+        if merged:
+            logger.info(f"流式合并: 从第 {merged + 1} 个分片继续，已合并 {offset} 字节")
+
+    def in_window(self, index):
+        """分片是否在允许下载的窗口内"""
+        return index < self.next_index + self.window
+
+    def open_buffer(self, index):
+        """为开始下载的分片选择缓冲位置，返回MemorySegment，内存缓冲已满时返回None（写入分片包）
+
+        下一个要合并的分片总是使用内存；其它分片按已完成分片的平均大小估算内存占用。
+        """
+        with self._cond:
+            self._ready.discard(index)
+            self._memory.pop(index, None)
+            used = sum(len(segment) for segment in self._memory.values())
+            if index != self.next_index and used + self._average_size() > (
+                self.memory_limit
+            ):
+                return None
+            segment = MemorySegment()
+            self._memory[index] = segment
+            return segment
+
+    def _average_size(self):
+        merged = self.next_index
+        return self.merged_bytes / merged if merged else 0
+
+    def in_memory(self, index):
+        with self._cond:
+            return index in self._memory
+
+    def segment_data(self, index):
+        """返回内存中分片的数据，用于校验；分片在分片包中时返回None"""
+        with self._cond:
+            segment = self._memory.get(index)
+        return bytes(segment.data) if segment is not None else None
+
+    def complete(self, index):
+        """分片下载并校验完成，等待按顺序合并"""
+        with self._cond:
+            self._ready.add(index)
+            in_memory = sum(len(segment) for segment in self._memory.values())
+            self.max_buffered = max(self.max_buffered, len(self._ready))
+            self.max_memory = max(self.max_memory, in_memory)
+            if index in self._memory:
+                self.memory_segments += 1
+            else:
+                self.spilled_segments += 1
+            self._cond.notify_all()
+
+    def idle(self):
+        """合并线程是否在等待尚未完成的分片"""
+        with self._cond:
+            return self.next_index not in self._ready
+
+    def _merge_loop(self):
+        while True:
+            with self._cond:
+                while not self._closed and self.next_index not in self._ready:
+                    self._cond.wait()
+                if self.next_index not in self._ready:
+                    return
+                index = self.next_index
+                self._ready.discard(index)
+                segment = self._memory.pop(index, None)
+            try:
+                size = self._write_segment(index, segment)
+                self._file.flush()
+            except Exception as e:
+                logger.error(f"流式合并分片 {index} 失败: {str(e)}")
+                with self._cond:
+                    self.error = e
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self.next_index += 1
+                self.merged_bytes += size
+                self._cond.notify_all()
+            if self._journal:
+                self._journal.record_merged(self.next_index, self.merged_bytes)
+
+    def _open_output(self, offset):
+        """打开输出文件，从offset处继续写入"""
+        output = open(self.output_file, "r+b" if offset else "wb")
+        output.truncate(offset)
+        output.seek(offset)
+        return output
+
+    def _write_segment(self, index, segment):
+        """把分片追加到输出，返回写入的字节数；分片包中的分片写入后释放"""
+        if segment is not None:
+            self._file.write(segment.data)
+            return len(segment)
+        size = self.pack.copy_to(index, self._file)
+        self.pack.release(index)
+        return size
+
+    def sync(self):
+        """把已合并的数据同步到磁盘（记录合并进度的日志同步前调用）"""
+        with self._sync_lock:
+            if not self._file.closed:
+                getattr(os, "fdatasync", os.fsync)(self._file.fileno())
+
+    def _close_output(self, complete):
+        with self._sync_lock:
+            self._file.close()
+
+    def finish(self):
+        """等待所有分片合并完成，成功时返回True"""
+        with self._cond:
+            while self.next_index < self.total and self.error is None:
+                self._cond.wait(0.5)
+        self.close()
+        if self.error:
+            raise self.error
+        return True
+
+    def close(self):
+        """停止合并线程并关闭输出文件，未合并的分片保留在分片包中"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._close_output(self.next_index >= self.total and self.error is None)
+        with self._cond:
+            self._memory.clear()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "merged_segments": self.next_index,
+                "merged_bytes": self.merged_bytes,
+                "buffered_segments": len(self._ready),
+                "buffered_memory": sum(len(s) for s in self._memory.values()),
+                "max_buffered_segments": self.max_buffered,
+                "max_buffered_memory": self.max_memory,
+                "memory_segments": self.memory_segments,
+                "spilled_segments": self.spilled_segments,
+                "window": self.window,
+            }
+
+
+class FFmpegPipeMerger(StreamMerger):
+    """流式合并到FFmpeg：按顺序把分片写入FFmpeg的标准输入，边下载边转换为mp4/mkv
+
+    最后一个分片写入后FFmpeg只需写完文件尾，不产生合并后的TS文件和分片列表。
+    FFmpeg的输出无法从中间继续，因此不记录合并进度，中断后重新转换。
+    """
+
+    def __init__(self, output_file, pack):
+        self._process = None
+        self._stderr = deque(maxlen=20)
+        super().__init__(output_file, pack)
+
+    def _open_output(self, offset):
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "mpegts",
+            "-i",
+            "pipe:0",
+            "-c",
+            "copy",
+            self.output_file,
+        ]
+        logger.info(f"执行FFmpeg命令: {' '.join(cmd)}")
+        self._process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        # 持续读取FFmpeg的错误输出，避免管道写满后阻塞
+        self._stderr_thread = threading.Thread(
+            target=self._read_stderr, name="ffmpeg-stderr", daemon=True
+        )
+        self._stderr_thread.start()
+        return self._process.stdin
+
+    def _read_stderr(self):
+        for line in self._process.stderr:
+            self._stderr.append(line.decode("utf-8", "replace").rstrip())
+
+    def _close_output(self, complete):
+        """全部分片写入后等待FFmpeg写完文件；中途停止时结束FFmpeg并删除不完整的输出"""
+        try:
+            self._file.close()
+        except OSError:  # FFmpeg已退出
+            complete = False
+        if not complete:
+            self._process.kill()
+        returncode = self._process.wait()
+        self._stderr_thread.join()
+        if returncode != 0 and self._stderr:
+            logger.error("FFmpeg输出:\n" + "\n".join(self._stderr))
+        if complete and returncode != 0:
+            self.error = Exception(f"FFmpeg转换失败 (退出码 {returncode})")
+        if (not complete or self.error) and os.path.exists(self.output_file):
+            os.remove(self.output_file)
@@ -0,0 +1,126 @@
+import io
+from urllib.parse import urljoin
+
+import m3u8
+import pytest
+
+from services.compact_playlist import (
+    SEGMENT_DONE,
+    SEGMENT_FAILED,
+    SEGMENT_PENDING,
+    SEGMENT_VERIFIED,
+    SegmentStates,
+    parse_media_playlist,
+    parse_playlist,
+)
+
+BASE_URI = "https://cdn.example.com/live/1080p/index.m3u8?token=abc"
+
+MEDIA = """#EXTM3U
+#EXT-X-VERSION:4
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:7
+#EXTINF:4.0,
+seg0.ts
+#EXT-X-KEY:METHOD=AES-128,URI="keys/1.key",IV=0x1
+#EXTINF:3.5,title
+sub/seg1.ts?x=1
+#EXT-X-BYTERANGE:100@0
+#EXTINF:2,
+https://other.example.com/all.ts
+#EXT-X-KEY:METHOD=NONE
+#EXT-X-BYTERANGE:50
+#EXTINF:1,
+https://other.example.com/all.ts
+#EXT-X-ENDLIST
+"""
+
+
+def test_media_playlist_matches_m3u8_library():
+    playlist = parse_playlist(MEDIA, BASE_URI)
+    expected = m3u8.loads(MEDIA, uri=BASE_URI)
+
+    assert len(playlist) == 4
+    assert playlist.media_sequence == 7
+    assert playlist.target_duration == 4
+    assert playlist.is_endlist
+    for segment, reference in zip(playlist.segments, expected.segments):
+        assert segment.uri == reference.uri
+        assert segment.duration == reference.duration
+        assert segment.byterange == reference.byterange
+        assert (segment.key and segment.key.uri) == (
+            reference.key and reference.key.uri
+        )
+    assert list(playlist.segment_urls) == [
+        urljoin(BASE_URI, segment.uri) for segment in expected.segments
+    ]
+
+
+def test_keys_are_shared_between_segments():
+    text = '#EXTM3U\n#EXT-X-KEY:METHOD=AES-128,URI="k"\n' + "#EXTINF:1,\na.ts\n" * 3
+    playlist = parse_playlist(text)
+    assert len(playlist.keys) == 1
+    assert {id(segment.key) for segment in playlist.segments} == {id(playlist.keys[0])}
+
+
+def test_segments_column_supports_slices_and_negative_indexes():
+    playlist = parse_playlist(MEDIA, BASE_URI)
+    assert [s.uri for s in playlist.segments[1:3]] == [
+        "sub/seg1.ts?x=1",
+        "https://other.example.com/all.ts",
+    ]
+    assert playlist.segments[-1].byterange == "50"
+    with pytest.raises(IndexError):
+        playlist.segments[4]
+
+
+def test_master_playlist_uses_m3u8_library():
+    text = "#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1000\nlow/index.m3u8\n"
+    playlist = parse_playlist(text, BASE_URI)
+    assert playlist.is_variant
+    assert playlist.playlists[0].uri == "low/index.m3u8"
+
+
+def test_bom_is_accepted():
+    playlist = parse_playlist("\ufeff#EXTM3U\n#EXTINF:1,\na.ts\n")
+    assert [s.uri for s in playlist.segments] == ["a.ts"]
+    playlist = parse_media_playlist(io.StringIO("\ufeff#EXTM3U\n#EXTINF:1,\na.ts\n"))
+    assert len(playlist) == 1
+
+
+@pytest.mark.parametrize("text", ["", "\n\n", "<html></html>", "a.ts\n#EXTM3U\n"])
+def test_text_without_header_is_rejected(text):
+    with pytest.raises(Exception, match="不是有效的M3U8文件"):
+        parse_playlist(text)
+    with pytest.raises(Exception, match="不是有效的M3U8文件"):
+        parse_media_playlist(io.StringIO(text))
+
+
+def test_uri_lines_without_extinf_are_ignored():
+    text = "#EXTM3U\nstray.ts\n#EXTINF:1,\na.ts\ngarbage\n#EXTINF:2,\nb.ts\n"
+    playlist = parse_playlist(text)
+    assert [s.uri for s in playlist.segments] == ["a.ts", "b.ts"]
+
+
+def test_malformed_duration_falls_back_to_zero():
+    text = "#EXTM3U\n#EXTINF:2.5 ,a\na.ts\n#EXTINF:abc,\nb.ts\n#EXTINF:\nc.ts\n"
+    playlist = parse_playlist(text)
+    assert [s.duration for s in playlist.segments] == [2.5, 0.0, 0.0]
+
+
+def test_segment_states_track_counts():
+    states = SegmentStates(10)
+    assert states.snapshot() == {"pending": 10, "done": 0, "failed": 0, "verified": 0}
+    states.set(0, SEGMENT_DONE)
+    states.set(5, SEGMENT_FAILED)
+    states.set(9, SEGMENT_VERIFIED)
+    states.set(5, SEGMENT_VERIFIED)
+    assert [states.get(i) for i in (0, 1, 5, 9)] == [
+        SEGMENT_DONE,
+        SEGMENT_PENDING,
+        SEGMENT_VERIFIED,
+        SEGMENT_VERIFIED,
+    ]
+    assert states.count(SEGMENT_VERIFIED) == 2
+    assert states.count(SEGMENT_FAILED) == 0
+    assert states.count(SEGMENT_PENDING) == 7
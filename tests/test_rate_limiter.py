@@ -0,0 +1,99 @@
+import pytest
+
+from config import Config
+from services.rate_limiter import RateLimiter, RateShare, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("services.rate_limiter.time.monotonic", clock)
+    return clock
+
+
+def test_unlimited_bucket_never_waits(clock):
+    bucket = TokenBucket()
+    assert bucket.reserve(10**9) == 0
+
+
+def test_bucket_borrows_tokens_and_refills(clock):
+    bucket = TokenBucket(rate=1000, burst=1000)
+    assert bucket.reserve(500) == pytest.approx(0.5)
+    # 预支的令牌排在前面，后来的请求等待更久
+    assert bucket.reserve(500) == pytest.approx(1.0)
+    clock.advance(1.0)
+    assert bucket.reserve(0) == pytest.approx(0)
+    clock.advance(10.0)
+    # 令牌不超过突发上限
+    assert bucket.reserve(1000) == 0
+    assert bucket.reserve(100) == pytest.approx(0.1)
+
+
+def test_set_rate_clamps_tokens_to_new_burst(clock):
+    bucket = TokenBucket(rate=1000, burst=1000)
+    clock.advance(5.0)
+    bucket.set_rate(100, burst=100)
+    assert bucket.reserve(100) == 0
+    assert bucket.reserve(50) == pytest.approx(0.5)
+
+
+def test_default_burst_has_lower_bound(clock):
+    bucket = TokenBucket(rate=1)
+    assert bucket.burst == 64 * 1024
+
+
+def test_global_limit_is_split_by_weight(clock, monkeypatch):
+    monkeypatch.setattr(Config, "SPEED_LIMIT", 3000)
+    limiter = RateLimiter()
+    heavy, light = RateShare(weight=2), RateShare(weight=1)
+    limiter.register(heavy)
+    limiter.register(light)
+
+    limiter.reserve(heavy, 0)
+    assert heavy.rate == pytest.approx(2000)
+    assert light.rate == pytest.approx(1000)
+    assert limiter.get_stats()["tasks"] == 2
+
+    limiter.unregister(light)
+    limiter.reserve(heavy, 0)
+    assert heavy.rate == pytest.approx(3000)
+
+
+def test_task_cap_applies_with_and_without_global_limit(clock, monkeypatch):
+    monkeypatch.setattr(Config, "SPEED_LIMIT", 0)
+    limiter = RateLimiter()
+    share = RateShare(cap=500)
+    limiter.register(share)
+    limiter.reserve(share, 0)
+    assert share.rate == 500
+
+    monkeypatch.setattr(Config, "SPEED_LIMIT", 3000)
+    limiter.reserve(share, 0)
+    assert share.rate == 500
+
+    limiter.update_share(share, cap=0)
+    limiter.reserve(share, 0)
+    assert share.rate == 3000
+
+
+def test_reserve_waits_for_slowest_bucket(clock, monkeypatch):
+    monkeypatch.setattr(Config, "SPEED_LIMIT", 0)
+    limiter = RateLimiter()
+    share = RateShare(cap=1000)
+    limiter.register(share)
+    share_delay = limiter.reserve(share, 70 * 1024)
+    assert share_delay > 0
+    assert share.bytes == 70 * 1024
+    # 没有份额的请求只受全局限速约束
+    assert limiter.reserve(None, 10**9) == 0
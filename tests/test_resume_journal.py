@@ -0,0 +1,110 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from config import Config
+from services.resume_journal import ResumeJournal, playlist_fingerprint
+
+
+class FakePack:
+    def __init__(self, sizes, calls=None):
+        self.sizes = sizes
+        self.count = len(sizes)
+        self.calls = calls if calls is not None else []
+
+    def size(self, index):
+        return self.sizes[index]
+
+    def sync(self):
+        self.calls.append("pack")
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = ResumeJournal(str(tmp_path))
+    yield journal
+    journal.close()
+
+
+def reopen(journal, fingerprint, pack):
+    journal.close()
+    return journal.open(fingerprint, pack)
+
+
+def test_completed_segments_are_restored(journal):
+    pack = FakePack([10, 20, 30])
+    assert journal.open("fp", pack) == {}
+    journal.record(0, 10)
+    journal.record(2, 30)
+    assert reopen(journal, "fp", pack) == {0: 10, 2: 30}
+
+
+def test_records_with_mismatched_pack_size_are_excluded(journal):
+    journal.open("fp", FakePack([10, 20]))
+    journal.record(0, 10)
+    journal.record(1, 20)
+    journal.record(5, 10)  # 超出分片包范围
+    assert reopen(journal, "fp", FakePack([10, 19])) == {0: 10}
+
+
+def test_fingerprint_change_invalidates_records(journal):
+    pack = FakePack([10])
+    journal.open("old", pack)
+    journal.record(0, 10)
+    journal.record_merged(1, 10)
+    assert reopen(journal, "new", pack) == {}
+    assert journal.merged == (0, 0)
+    # 新日志只包含新的指纹
+    with open(journal.path, encoding="utf-8") as f:
+        assert [json.loads(line) for line in f] == [
+            {"type": "playlist", "fingerprint": "new"}
+        ]
+
+
+def test_torn_line_is_ignored_and_next_record_starts_on_new_line(journal):
+    pack = FakePack([10, 20, 30])
+    journal.open("fp", pack)
+    journal.record(0, 10)
+    journal.close()
+    with open(journal.path, "a", encoding="utf-8") as f:
+        f.write('{"type": "segment", "ind')  # 崩溃时写了一半的行
+
+    assert journal.open("fp", pack) == {0: 10}
+    journal.record(1, 20)
+    assert reopen(journal, "fp", pack) == {0: 10, 1: 20}
+
+
+def test_merged_progress_is_restored(journal):
+    pack = FakePack([10, 20])
+    journal.open("fp", pack)
+    journal.record_merged(1, 10)
+    journal.record_merged(2, 30)
+    reopen(journal, "fp", pack)
+    assert journal.merged == (2, 30)
+
+
+def test_sync_hooks_run_before_journal_fsync(journal, monkeypatch):
+    calls = []
+    monkeypatch.setattr(Config, "JOURNAL_SYNC_INTERVAL", 0)
+    monkeypatch.setattr("os.fsync", lambda fd: calls.append("journal"))
+    journal.open("fp", FakePack([10], calls))
+    journal.add_sync(lambda: calls.append("output"))
+    journal.record(0, 10)
+    assert calls == ["pack", "output", "journal"]
+
+
+def test_remove_deletes_journal(journal):
+    journal.open("fp", FakePack([]))
+    journal.remove()
+    assert not os.path.exists(journal.path)
+
+
+def test_playlist_fingerprint_covers_urls_and_byteranges():
+    segments = [SimpleNamespace(byterange=None), SimpleNamespace(byterange="10@0")]
+    fingerprint = playlist_fingerprint(["a.ts", "b.ts"], segments)
+    assert fingerprint == playlist_fingerprint(["a.ts", "b.ts"], segments)
+    assert fingerprint != playlist_fingerprint(["a.ts", "c.ts"], segments)
+    segments[1].byterange = "10@5"
+    assert fingerprint != playlist_fingerprint(["a.ts", "b.ts"], segments)
@@ -0,0 +1,204 @@
+import threading
+
+import pytest
+import requests
+
+from config import Config
+from services.downloader import HTTPStatusError
+from services.mirrors import MirrorSet
+from services.retry_policy import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryBudget,
+    backoff_delay,
+    call_with_retry,
+    get_circuit_breaker,
+    is_host_failure,
+    is_retryable,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # 熔断器按主机全局共享，每个测试使用独立的熔断器
+    monkeypatch.setattr("services.retry_policy._breakers", {})
+    clock = FakeClock()
+    monkeypatch.setattr("services.retry_policy.time.monotonic", clock)
+    monkeypatch.setattr("services.retry_policy.time.sleep", clock.sleep)
+    return clock
+
+
+class Flaky:
+    """前failures次调用抛出error，之后返回result"""
+
+    def __init__(self, failures, error, result=b"ok"):
+        self.failures = failures
+        self.error = error
+        self.result = result
+        self.targets = []
+
+    def __call__(self, target):
+        self.targets.append(target)
+        if len(self.targets) <= self.failures:
+            raise self.error
+        return self.result
+
+
+@pytest.mark.parametrize(
+    "error, retryable, host_failure",
+    [
+        (HTTPStatusError(503), True, True),
+        (HTTPStatusError(429), True, False),
+        (HTTPStatusError(404), False, False),
+        (requests.exceptions.ConnectionError(), True, True),
+        (TimeoutError(), True, True),
+        (ValueError("解析失败"), True, False),
+        (CircuitOpenError(), False, False),
+    ],
+)
+def test_error_classification(error, retryable, host_failure):
+    assert is_retryable(error) == retryable
+    assert is_host_failure(error) == host_failure
+
+
+def test_backoff_delay_is_capped(monkeypatch):
+    monkeypatch.setattr("services.retry_policy.random.uniform", lambda a, b: b)
+    assert backoff_delay(1) == Config.RETRY_BASE_DELAY * 2
+    assert backoff_delay(30) == Config.RETRY_MAX_DELAY
+
+
+def test_retry_budget_grows_with_requests():
+    budget = RetryBudget(ratio=0.5, minimum=1)
+    assert budget.try_retry()
+    assert not budget.try_retry()
+    budget.on_request()
+    budget.on_request()
+    assert budget.try_retry()
+    assert not budget.try_retry()
+    assert budget.snapshot() == {
+        "requests": 2,
+        "retries": 2,
+        "budget": 2,
+        "exhausted": 2,
+    }
+
+
+def test_circuit_opens_after_consecutive_host_failures(clock, monkeypatch):
+    monkeypatch.setattr(Config, "CIRCUIT_FAILURE_THRESHOLD", 2)
+    breaker = CircuitBreaker("cdn")
+    breaker.record(HTTPStatusError(500))
+    breaker.record(HTTPStatusError(404))  # 4xx说明主机仍在响应
+    breaker.record(HTTPStatusError(500))
+    breaker.check()
+    breaker.record(HTTPStatusError(500))
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    assert breaker.snapshot()["rejected"] == 1
+
+
+def test_half_open_allows_single_probe_and_backs_off(clock, monkeypatch):
+    monkeypatch.setattr(Config, "CIRCUIT_FAILURE_THRESHOLD", 1)
+    breaker = CircuitBreaker("cdn")
+    breaker.on_failure()
+    clock.now += Config.CIRCUIT_COOLDOWN
+    breaker.check()  # 探测请求
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    # 探测失败，冷却时间加倍
+    breaker.on_failure()
+    assert breaker.cooldown == Config.CIRCUIT_COOLDOWN * 2
+    clock.now += Config.CIRCUIT_COOLDOWN
+    assert breaker.is_open()
+    clock.now += Config.CIRCUIT_COOLDOWN
+    breaker.check()
+    breaker.on_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.cooldown == Config.CIRCUIT_COOLDOWN
+
+
+def test_call_with_retry_retries_retryable_errors(clock):
+    func = Flaky(2, HTTPStatusError(503))
+    assert call_with_retry(func, "https://cdn/a.ts") == b"ok"
+    assert len(func.targets) == 3
+    assert len(clock.sleeps) == 2
+
+
+def test_call_with_retry_honours_retry_after(clock):
+    func = Flaky(1, HTTPStatusError(429, retry_after=7))
+    call_with_retry(func, "https://cdn/a.ts")
+    assert clock.sleeps == [7]
+
+
+def test_call_with_retry_gives_up_on_permanent_errors(clock):
+    func = Flaky(1, HTTPStatusError(404))
+    with pytest.raises(HTTPStatusError):
+        call_with_retry(func, "https://cdn/a.ts")
+    assert len(func.targets) == 1
+
+
+def test_call_with_retry_stops_after_max_attempts():
+    func = Flaky(100, HTTPStatusError(503))
+    with pytest.raises(HTTPStatusError):
+        call_with_retry(func, "https://cdn/a.ts")
+    assert len(func.targets) == Config.RETRY_MAX_ATTEMPTS
+
+
+def test_call_with_retry_respects_budget():
+    budget = RetryBudget(ratio=0, minimum=1)
+    func = Flaky(100, HTTPStatusError(503))
+    with pytest.raises(HTTPStatusError):
+        call_with_retry(func, "https://cdn/a.ts", budget=budget)
+    assert len(func.targets) == 2
+    assert budget.snapshot()["exhausted"] == 1
+
+
+def test_call_with_retry_can_be_cancelled():
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(Exception, match="已取消"):
+        call_with_retry(
+            Flaky(1, HTTPStatusError(503)), "https://cdn/a.ts", None, cancel
+        )
+
+
+def test_call_with_retry_fails_over_to_mirror(clock):
+    mirrors = MirrorSet("https://cdn/hls/index.m3u8", ["backup"])
+    primary, backup = mirrors.mirrors
+    func = Flaky(1, HTTPStatusError(404), result=1234)
+    # 固定先选择原地址
+    mirrors.pick = lambda url, exclude=(): next(
+        (m, mirrors.rewrite(url, m)) for m in mirrors.mirrors if m not in exclude
+    )
+
+    # 4xx本身不重试，但还有其它镜像时立即换用镜像
+    assert call_with_retry(func, "https://cdn/hls/a.ts", mirrors=mirrors) == 1234
+    assert func.targets == ["https://cdn/hls/a.ts", "https://backup/hls/a.ts"]
+    assert clock.sleeps == [0]
+    assert primary.failures == 1
+    # 返回字节数时按字节数记录镜像传输量
+    assert backup.bytes == 1234
+
+
+def test_call_with_retry_skips_mirror_with_open_circuit(monkeypatch):
+    monkeypatch.setattr(Config, "CIRCUIT_FAILURE_THRESHOLD", 1)
+    mirrors = MirrorSet("https://cdn/hls/index.m3u8", ["backup"])
+    get_circuit_breaker("https://cdn/hls/a.ts").on_failure()
+    func = Flaky(0, None)
+    for _ in range(5):
+        call_with_retry(func, "https://cdn/hls/a.ts", mirrors=mirrors)
+    assert set(func.targets) == {"https://backup/hls/a.ts"}
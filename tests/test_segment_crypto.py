@@ -0,0 +1,75 @@
+import os
+
+import pytest
+from Crypto.Cipher import AES
+
+from services.segment_crypto import (
+    BLOCK_SIZE,
+    StreamDecryptor,
+    parse_iv,
+    segment_iv,
+    unpad,
+)
+
+KEY = bytes(range(16))
+
+
+def pad(data):
+    padding = BLOCK_SIZE - len(data) % BLOCK_SIZE
+    return data + bytes([padding]) * padding
+
+
+def encrypt(data, iv):
+    return AES.new(KEY, AES.MODE_CBC, iv).encrypt(pad(data))
+
+
+def test_unpad_removes_pkcs7_padding():
+    assert unpad(b"abc" + b"\x0d" * 13) == b"abc"
+    assert unpad(b"\x10" * 16) == b""
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"abc\x00",  # 填充长度为0
+        b"abc" + b"\x11" * 17,  # 填充长度超过分组大小
+        b"abc\x01\x03\x03",  # 填充字节不一致
+    ],
+)
+def test_unpad_keeps_data_without_valid_padding(data):
+    assert unpad(data) == data
+
+
+def test_parse_iv_accepts_hex_with_prefix():
+    assert parse_iv("0x000102030405060708090A0B0C0D0E0F") == bytes(range(16))
+    assert parse_iv("0X1") == b"\x00" * 15 + b"\x01"
+    assert parse_iv(b"raw") == b"raw"
+
+
+def test_segment_iv_uses_media_sequence_without_explicit_iv():
+    assert segment_iv(None, 100, 5) == (105).to_bytes(16, "big")
+    assert segment_iv(None, None, 3) == (3).to_bytes(16, "big")
+    assert segment_iv("0x2", 100, 5) == (2).to_bytes(16, "big")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 16, 100, 4096])
+def test_stream_decryptor_matches_one_shot_decryption(chunk_size):
+    iv = os.urandom(16)
+    plaintext = os.urandom(1000)
+    ciphertext = encrypt(plaintext, iv)
+
+    decryptor = StreamDecryptor(KEY, iv)
+    output = b"".join(
+        decryptor.update(ciphertext[i : i + chunk_size])
+        for i in range(0, len(ciphertext), chunk_size)
+    )
+    assert output + decryptor.finalize() == plaintext
+
+
+def test_stream_decryptor_rejects_truncated_ciphertext():
+    iv = bytes(16)
+    decryptor = StreamDecryptor(KEY, iv)
+    decryptor.update(encrypt(b"x" * 40, iv)[:-3])
+    with pytest.raises(Exception, match="整数倍"):
+        decryptor.finalize()
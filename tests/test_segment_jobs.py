@@ -0,0 +1,157 @@
+from types import SimpleNamespace
+
+import pytest
+
+from services.segment_jobs import (
+    JobSplitter,
+    SegmentJob,
+    build_segment_jobs,
+    build_single_job,
+    parse_byterange,
+)
+
+
+def playlist(*entries):
+    """entries为(地址, 字节范围或None)，返回(segments, segment_urls)"""
+    segments = [SimpleNamespace(byterange=byterange) for _, byterange in entries]
+    return segments, [url for url, _ in entries]
+
+
+def describe(job):
+    return job.url, job.start, job.length, [(p.index, p.offset) for p in job.parts]
+
+
+class MemorySink:
+    def __init__(self, part, outputs):
+        self.index = part.index
+        self.data = bytearray()
+        self.aborted = False
+        outputs[part.index] = self
+
+    def feed(self, data):
+        self.data += data
+
+    def close(self):
+        return len(self.data)
+
+    def abort(self):
+        self.aborted = True
+
+
+def test_parse_byterange():
+    assert parse_byterange("100@20") == (100, 20)
+    assert parse_byterange("100") == (100, None)
+
+
+def test_plain_segments_are_one_job_each():
+    segments, urls = playlist(("a.ts", None), ("b.ts", None))
+    jobs = build_segment_jobs(segments, urls, coalesce_size=1 << 20)
+    assert [describe(job) for job in jobs] == [
+        ("a.ts", None, 0, [(0, 0)]),
+        ("b.ts", None, 0, [(1, 0)]),
+    ]
+    assert jobs[0].range_header() is None
+
+
+def test_adjacent_ranges_are_coalesced_up_to_limit():
+    segments, urls = playlist(
+        ("all.ts", "100@0"), ("all.ts", "100"), ("all.ts", "100"), ("all.ts", "100")
+    )
+    jobs = build_segment_jobs(segments, urls, coalesce_size=250)
+    assert [describe(job) for job in jobs] == [
+        ("all.ts", 0, 200, [(0, 0), (1, 100)]),
+        ("all.ts", 200, 200, [(2, 0), (3, 100)]),
+    ]
+    assert jobs[0].range_header() == "bytes=0-199"
+
+
+def test_ranges_are_not_coalesced_across_gaps_or_urls():
+    segments, urls = playlist(
+        ("a.ts", "100@0"), ("a.ts", "100@150"), ("b.ts", "100"), ("b.ts", "100")
+    )
+    jobs = build_segment_jobs(segments, urls, coalesce_size=1 << 20)
+    assert [describe(job) for job in jobs] == [
+        ("a.ts", 0, 100, [(0, 0)]),
+        ("a.ts", 150, 100, [(1, 0)]),
+        # 不同资源上未指定偏移的范围从0开始
+        ("b.ts", 0, 200, [(2, 0), (3, 100)]),
+    ]
+
+
+def test_no_coalescing_when_disabled():
+    segments, urls = playlist(("all.ts", "100@0"), ("all.ts", "100"))
+    jobs = build_segment_jobs(segments, urls)
+    assert [describe(job) for job in jobs] == [
+        ("all.ts", 0, 100, [(0, 0)]),
+        ("all.ts", 100, 100, [(1, 0)]),
+    ]
+
+
+def test_skipped_segments_still_advance_implicit_offsets():
+    segments, urls = playlist(("all.ts", "100@0"), ("all.ts", "50"), ("all.ts", "70"))
+    jobs = build_segment_jobs(segments, urls, coalesce_size=1 << 20, skip={0, 1})
+    assert [describe(job) for job in jobs] == [("all.ts", 150, 70, [(2, 0)])]
+
+
+def test_build_single_job_matches_full_planning():
+    segments, urls = playlist(
+        ("a.ts", "100@10"),
+        ("a.ts", "20"),
+        ("s.ts", None),
+        ("a.ts", "30"),
+        ("b.ts", "40@5"),
+        ("b.ts", "60"),
+        ("a.ts", "10"),
+    )
+    for index in range(len(segments)):
+        skip = set(range(len(segments))) - {index}
+        expected = build_segment_jobs(segments, urls, skip=skip)[0]
+        assert describe(build_single_job(segments, urls, index)) == describe(expected)
+
+
+def split(job, chunks, skip=0):
+    outputs = {}
+    splitter = JobSplitter(job, lambda part: MemorySink(part, outputs), skip)
+    done = [splitter.feed(chunk) for chunk in chunks]
+    return splitter, outputs, done
+
+
+def coalesced_job():
+    job = SegmentJob("all.ts", 100)
+    job.add_part(0, 3)
+    job.add_part(1, 4)
+    return job
+
+
+def test_splitter_cuts_response_at_part_boundaries():
+    splitter, outputs, done = split(coalesced_job(), [b"ab", b"cde", b"fg"])
+    assert splitter.close() == [(0, 3), (1, 4)]
+    assert outputs[0].data == b"abc"
+    assert outputs[1].data == b"defg"
+    assert done == [False, False, True]
+
+
+def test_splitter_skips_and_discards_data_outside_the_range():
+    # 服务器忽略Range时返回完整资源：跳过范围之前的数据，丢弃之后的数据
+    splitter, outputs, done = split(
+        coalesced_job(), [b"xx", b"xabcdefgyy", b"zz"], skip=3
+    )
+    assert splitter.close() == [(0, 3), (1, 4)]
+    assert bytes(outputs[0].data + outputs[1].data) == b"abcdefg"
+    assert done == [False, True, True]
+
+
+def test_splitter_reports_incomplete_response():
+    splitter, outputs, _ = split(coalesced_job(), [b"abcde"])
+    with pytest.raises(Exception, match="不完整"):
+        splitter.close()
+    splitter.abort()
+    assert outputs[1].aborted
+
+
+def test_splitter_passes_whole_segment_without_length():
+    job = SegmentJob("a.ts")
+    job.add_part(0)
+    splitter, outputs, done = split(job, [b"abc", b"def"])
+    assert done == [False, False]
+    assert splitter.close() == [(0, 6)]
@@ -0,0 +1,74 @@
+import io
+
+import pytest
+
+from services.segment_validator import (
+    TS_PACKET_SIZE,
+    TS_SYNC_BYTE,
+    check_content_length,
+    validate_segment,
+)
+
+PACKET = bytes([TS_SYNC_BYTE]) + bytes(TS_PACKET_SIZE - 1)
+
+
+def box(box_type, payload_size=0):
+    return (8 + payload_size).to_bytes(4, "big") + box_type + bytes(payload_size)
+
+
+def validate(data):
+    validate_segment(io.BytesIO(data), len(data))
+
+
+def test_valid_ts_segment():
+    validate(PACKET * 5000)  # 跨越多个读取块
+
+
+@pytest.mark.parametrize("tail", [b"\x00" * 50, b"G" * 3, PACKET[:187]])
+def test_ts_segment_with_partial_trailing_packet_is_accepted(tail):
+    validate(PACKET * 10 + tail)
+
+
+def test_ts_sync_byte_error_reports_offset():
+    data = bytearray(PACKET * 10)
+    data[TS_PACKET_SIZE * 6] = 0
+    with pytest.raises(Exception, match=f"偏移 {TS_PACKET_SIZE * 6}"):
+        validate(bytes(data))
+
+
+def test_valid_fmp4_segment():
+    validate(box(b"styp", 8) + box(b"moof", 40) + box(b"mdat", 1000))
+
+
+def test_fmp4_box_size_must_match_segment_size():
+    with pytest.raises(Exception, match="box大小无效"):
+        validate(box(b"moof", 40) + box(b"mdat", 1000)[:-10])
+
+
+def test_fmp4_large_and_open_ended_boxes():
+    large = (1).to_bytes(4, "big") + b"mdat" + (16 + 100).to_bytes(8, "big")
+    validate(box(b"moof", 8) + large + bytes(100))
+    validate(box(b"moof", 8) + (0).to_bytes(4, "big") + b"mdat" + bytes(50))
+
+
+@pytest.mark.parametrize("data", [b"<!DOCTYPE html><html>", b"  <html><body>"])
+def test_html_error_page_is_rejected(data):
+    with pytest.raises(Exception, match="HTML"):
+        validate(data)
+
+
+def test_empty_segment_is_rejected():
+    with pytest.raises(Exception, match="为空"):
+        validate(b"")
+
+
+def test_unknown_format_is_not_checked():
+    validate(b"\x89PNG\r\n\x1a\n" + bytes(100))
+
+
+def test_check_content_length():
+    check_content_length({"Content-Length": "10"}, 10)
+    check_content_length({"Content-Length": "10", "Content-Encoding": "gzip"}, 4)
+    check_content_length({}, 4)
+    with pytest.raises(Exception, match="不完整"):
+        check_content_length({"Content-Length": "10"}, 9)